@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the core request paths of the application.
+
+The application is created with `init_app()` against a temporary SQLite
+database seeded with users and roles.
+
+Usage:
+
+    python benchmark.py micro --users 1000 --save baseline.json
+    python benchmark.py micro --baseline baseline.json
+    python benchmark.py load --processes 4 --duration 10 --path /login
+    python benchmark.py load --asgi --slow-clients 500
+"""
+
+import datetime
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+import urllib.parse
+
+import click
+
+
+# Password of all the seeded users
+PASSWORD = 'benchmark'
+
+# Token used for the password reset scenario
+RESET_TOKEN = 'a' * 100
+
+CONFIG_TEMPLATE = """
+SECRET_KEY = 'benchmark'
+TESTING = True
+SITENAME = 'benchmark'
+SQLALCHEMY_DATABASE_URI = 'sqlite:///{db_path}'
+WTF_CSRF_ENABLED = False
+MAIL_DEFAULT_SENDER = 'benchmark@localhost'
+PASSLIB_ALG_BCRYPT_ROUNDS = {rounds}
+"""
+
+
+def create_app(directory, users, rounds):
+    """Create and seed an application in a temporary directory.
+
+    Args:
+        directory (str): Directory for the configuration and the database.
+        users (int): Number of users to create.
+        rounds (int): Bcrypt rounds used to hash passwords.
+
+    Returns:
+        Application instance.
+    """
+    config_path = os.path.join(directory, 'config.py')
+
+    with open(config_path, 'w') as f:
+        f.write(CONFIG_TEMPLATE.format(
+            db_path=os.path.join(directory, 'benchmark.sqlite'),
+            rounds=rounds
+        ))
+
+    os.environ['FLASK_APP_CONFIG'] = config_path
+
+    from flask_app_template import crypto_manager, db, init_app
+    from flask_app_template.models import Role, User, user_roles
+
+    app = init_app()
+
+    with app.app_context():
+        db.create_all()
+
+        if User.query.first():
+            return app
+
+        db.session.add_all([Role(name='admin'), Role(name='user')])
+        db.session.commit()
+
+        roles = {r.name: r.id for r in Role.query.all()}
+
+        # Hash once, all users share the same password
+        password = crypto_manager.hash(PASSWORD)
+
+        db.session.bulk_insert_mappings(User, [
+            {
+                'id': idx,
+                'username': 'user{}'.format(idx),
+                'email': 'user{}@localhost'.format(idx),
+                'password': password,
+                'is_active': True,
+            }
+            for idx in range(1, users + 1)
+        ])
+
+        db.session.execute(user_roles.insert(), [
+            {
+                'user_id': idx,
+                'role_id': roles['admin' if idx == 1 else 'user']
+            }
+            for idx in range(1, users + 1)
+        ])
+
+        # Valid password reset token for the first user
+        user = User.get_by_id(1)
+        user.reset_password_token = RESET_TOKEN
+        user.reset_expiration = (
+            datetime.datetime.utcnow() + datetime.timedelta(days=365)
+        )
+
+        db.session.commit()
+
+    return app
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return 0
+
+    values = sorted(values)
+    idx = max(0, int(round(percent / 100.0 * len(values))) - 1)
+
+    return values[idx]
+
+
+def summarize(latencies, elapsed):
+    """Summary statistics of a list of latencies (in seconds)."""
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else 0,
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def print_results(results):
+    line = '{:<24} {:>10} {:>10} {:>10} {:>10}'
+
+    click.echo(line.format('scenario', 'req/s', 'mean ms', 'p50 ms', 'p99 ms'))
+
+    for name, result in results.items():
+        click.echo(line.format(
+            name,
+            '{:.1f}'.format(result['throughput']),
+            '{:.2f}'.format(result['mean_ms']),
+            '{:.2f}'.format(result['p50_ms']),
+            '{:.2f}'.format(result['p99_ms'])
+        ))
+
+
+def micro_scenarios(users):
+    """Requests performed by the micro-benchmarks.
+
+    Returns:
+        List of `(name, method, path, data, logged_in)` tuples.
+    """
+    identity = 'user{}'.format(users)
+
+    return [
+        ('login_get', 'GET', '/login', None, False),
+        ('login_post', 'POST', '/login', {
+            'identity': identity,
+            'password': PASSWORD
+        }, False),
+        ('login_post_invalid', 'POST', '/login', {
+            'identity': identity,
+            'password': 'invalid'
+        }, False),
+        ('home', 'GET', '/', None, True),
+        ('forgot_password_get', 'GET', '/forgot-password', None, False),
+        ('forgot_password_post', 'POST', '/forgot-password', {
+            'email': 'unknown@localhost'
+        }, False),
+        ('reset_password_get', 'GET', '/reset-password/' + RESET_TOKEN, None,
+         False),
+    ]
+
+
+@click.group()
+def cli():
+    """Application benchmarks."""
+    pass
+
+
+@cli.command()
+@click.option('--users', default=1000, help='number of users to seed')
+@click.option('--iterations', default=200, help='requests per scenario')
+@click.option('--warmup', default=20, help='warmup requests per scenario')
+@click.option('--rounds', default=4, help='bcrypt rounds of the passwords')
+@click.option('--scenario', multiple=True, help='only run these scenarios')
+@click.option('--save', help='store the results in a JSON file')
+@click.option('--baseline', help='compare with results stored in a JSON file')
+@click.option(
+    '--tolerance',
+    default=10.0,
+    help='allowed p50 slowdown over the baseline (percent)'
+)
+def micro(users, iterations, warmup, rounds, scenario, save, baseline,
+          tolerance):
+    """Benchmark request paths with the Flask test client."""
+    directory = tempfile.mkdtemp(prefix='flask_app_template-bench-')
+    app = create_app(directory, users, rounds)
+
+    results = {}
+
+    for name, method, path, data, logged_in in micro_scenarios(users):
+        if scenario and name not in scenario:
+            continue
+
+        client = app.test_client()
+
+        if logged_in:
+            client.post('/login', data={
+                'identity': 'user1',
+                'password': PASSWORD
+            })
+
+        latencies = []
+
+        for idx in range(warmup + iterations):
+            start = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            latency = time.perf_counter() - start
+
+            if response.status_code >= 500:
+                raise click.ClickException(
+                    '{} returned {}'.format(name, response.status_code)
+                )
+
+            if idx >= warmup:
+                latencies.append(latency)
+
+        results[name] = summarize(latencies, sum(latencies))
+
+    print_results(results)
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if baseline:
+        with open(baseline) as f:
+            previous = json.load(f)
+
+        if compare(previous, results, tolerance):
+            raise SystemExit(1)
+
+
+def compare(baseline, results, tolerance):
+    """Compare results against a baseline.
+
+    Returns:
+        `True` if any scenario is slower than allowed.
+    """
+    regression = False
+
+    click.echo('')
+    click.echo('Comparison with baseline (p50):')
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        before = baseline[name]['p50_ms']
+        after = result['p50_ms']
+        change = (after - before) / before * 100 if before else 0
+
+        status = 'ok'
+
+        if change > tolerance:
+            status = 'REGRESSION'
+            regression = True
+
+        click.echo('{:<24} {:>9.2f} -> {:>9.2f} ms ({:+.1f}%) {}'.format(
+            name,
+            before,
+            after,
+            change,
+            status
+        ))
+
+    return regression
+
+
+def serve(directory, users, rounds, port, asgi):
+    """Run the application in a threaded development server or through the
+    ASGI adapter in uvicorn."""
+    app = create_app(directory, users, rounds)
+    app.config['DEBUG'] = False
+
+    if asgi:
+        import uvicorn
+        from flask_app_template.asgi import ASGIAdapter
+
+        uvicorn.run(ASGIAdapter(app), port=port, log_level='warning')
+        return
+
+    app.run(port=port, threaded=True, use_reloader=False)
+
+
+def drive(url, paths, deadline, output):
+    """Perform requests until the deadline, reporting latencies."""
+    parsed = urllib.parse.urlparse(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port)
+
+    latencies = []
+    errors = 0
+    idx = 0
+
+    while time.time() < deadline:
+        path = paths[idx % len(paths)]
+        idx += 1
+
+        start = time.perf_counter()
+
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection(
+                parsed.hostname,
+                parsed.port
+            )
+            continue
+
+        if response.status >= 500:
+            errors += 1
+
+        else:
+            latencies.append(time.perf_counter() - start)
+
+    output.put((latencies, errors))
+
+
+def wait_for_server(url, timeout=30):
+    """Wait until the server accepts connections."""
+    parsed = urllib.parse.urlparse(url)
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection(
+                parsed.hostname,
+                parsed.port,
+                timeout=1
+            )
+            connection.request('GET', '/login')
+            connection.getresponse().read()
+
+            return
+
+        except OSError:
+            time.sleep(0.2)
+
+    raise click.ClickException('Server did not start')
+
+
+def open_slow_clients(url, count):
+    """Open connections that never finish sending their request."""
+    parsed = urllib.parse.urlparse(url)
+    sockets = []
+
+    for _ in range(count):
+        sock = socket.create_connection((parsed.hostname, parsed.port))
+        sock.sendall(b'GET /login HTTP/1.1\r\nHost: localhost\r\n')
+
+        sockets.append(sock)
+
+    return sockets
+
+
+@cli.command()
+@click.option('--url', help='URL of a running server (started if not set)')
+@click.option('--port', default=5099, help='port of the started server')
+@click.option('--users', default=1000, help='number of users to seed')
+@click.option('--rounds', default=4, help='bcrypt rounds of the passwords')
+@click.option('--processes', default=4, help='number of driver processes')
+@click.option('--duration', default=10, help='duration in seconds')
+@click.option('--path', multiple=True, help='paths to request (GET)')
+@click.option('--asgi', is_flag=True, help='serve through ASGI (uvicorn)')
+@click.option(
+    '--slow-clients',
+    default=0,
+    help='connections kept open without completing their request'
+)
+def load(url, port, users, rounds, processes, duration, path, asgi,
+         slow_clients):
+    """Generate HTTP load from several processes."""
+    paths = list(path) or ['/login', '/forgot-password']
+    server = None
+    sockets = []
+
+    if not url:
+        url = 'http://127.0.0.1:{}'.format(port)
+        directory = tempfile.mkdtemp(prefix='flask_app_template-bench-')
+
+        server = multiprocessing.Process(
+            target=serve,
+            args=(directory, users, rounds, port, asgi)
+        )
+        server.daemon = True
+        server.start()
+
+    try:
+        wait_for_server(url)
+        sockets = open_slow_clients(url, slow_clients)
+
+        output = multiprocessing.Queue()
+        deadline = time.time() + duration
+        start = time.time()
+
+        drivers = [
+            multiprocessing.Process(
+                target=drive,
+                args=(url, paths, deadline, output)
+            )
+            for _ in range(processes)
+        ]
+
+        for driver in drivers:
+            driver.start()
+
+        latencies = []
+        errors = 0
+
+        for _ in drivers:
+            driver_latencies, driver_errors = output.get()
+            latencies.extend(driver_latencies)
+            errors += driver_errors
+
+        for driver in drivers:
+            driver.join()
+
+        elapsed = time.time() - start
+
+    finally:
+        for sock in sockets:
+            sock.close()
+
+        if server is not None:
+            server.terminate()
+
+    print_results({'load ' + ','.join(paths): summarize(latencies, elapsed)})
+    click.echo('Errors: {}'.format(errors))
+
+
+if __name__ == '__main__':
+    cli()
@@ -12,16 +12,22 @@ from flask_login import LoginManager, current_user
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_misaka import Misaka
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
 
 import flask
 import pytz
 import webassets
 
+from flask_app_template.activity import ActivityTracker
+from flask_app_template.audit import AuditLog
 from flask_app_template.bootstrap import BASE_CONFIG, LANGUAGES
+from flask_app_template.cache import Cache
 from flask_app_template.errors import forbidden, page_not_found, server_error
-from flask_app_template.util import CryptoManager, HashidsWrapper
+from flask_app_template.health import HealthChecks
+from flask_app_template.metrics import Metrics
+from flask_app_template.sessions import ServerSessionInterface
+from flask_app_template.util import AsyncMailer, CryptoManager, \
+    HashidsWrapper, MailQueue, QueryTracker, RequestProfiler, TunedSQLAlchemy
 
 __version__ = '0.1.0'
 
@@ -37,6 +43,18 @@ except ImportError:
     _USING_TOOLBAR = False
 
 
+# Sampling profiler
+profiler = RequestProfiler()
+
+# Server-side sessions
+session_store = ServerSessionInterface()
+
+# Metrics
+metrics_registry = Metrics()
+
+# Health checks
+health = HealthChecks()
+
 # Crypto
 crypto_manager = CryptoManager()
 
@@ -50,7 +68,17 @@ babel = Babel()
 csrf = CSRFProtect()
 
 # SQLAlchemy
-db = SQLAlchemy()
+db = TunedSQLAlchemy()
+query_tracker = QueryTracker()
+
+# In-process cache
+cache = Cache()
+
+# Authentication event log
+audit_log = AuditLog()
+
+# User activity
+activity_tracker = ActivityTracker()
 
 # Flask-Migrate
 migrate = Migrate()
@@ -58,6 +86,10 @@ migrate = Migrate()
 # Flask-Mail
 mail = Mail()
 
+# Background email delivery
+mail_queue = MailQueue()
+async_mailer = AsyncMailer()
+
 # Flask-Login
 login_manager = LoginManager()
 
@@ -149,6 +181,18 @@ def init_app():
     if app.config.get('DEBUG') and _USING_TOOLBAR:
         toolbar.init_app(app)
 
+    # Setup sampling profiler (optional)
+    profiler.init_app(app)
+
+    # Setup server-side sessions (optional)
+    session_store.init_app(app)
+
+    # Setup metrics (optional)
+    metrics_registry.init_app(app)
+
+    # Setup health checks (optional)
+    health.init_app(app)
+
     # Setup cryptography (passlib)
     crypto_manager.init_app(app)
 
@@ -167,9 +211,19 @@ def init_app():
 
     # Setup database
     db.init_app(app)
+    query_tracker.init_app(app)
     # Force model registration
     from flask_app_template import models
 
+    # Setup in-process cache (optional)
+    cache.init_app(app)
+
+    # Setup authentication event log (optional)
+    audit_log.init_app(app)
+
+    # Setup user activity tracking (optional)
+    activity_tracker.init_app(app)
+
     # Database migrations
     migrations_dir = os.path.join(app.root_path, 'migrations')
     migrate.init_app(app, db, migrations_dir)
@@ -177,6 +231,8 @@ def init_app():
 
     # Setup Flask-Mail
     mail.init_app(app)
+    mail_queue.init_app(app)
+    async_mailer.init_app(app)
 
 
     # Setup Flask-Login
@@ -192,7 +248,12 @@ def init_app():
 
     @login_manager.user_loader
     def load_user(user_id):
-        return models.User.get_by_id(user_id)
+        with db.read_only():
+            user = cache.get_instance(models.User, user_id)
+
+        activity_tracker.touch(user)
+
+        return user
 
 
     # Setup Flask-Misaka
@@ -231,6 +292,22 @@ def init_app():
     assets.register('css_pack', css_bundle)
     assets.register('js_pack', js_bundle)
 
+    # Per-locale messages (generated with `translate compile --js`), only
+    # for languages with a catalog
+    from flask_app_template.i18n import locales
+
+    catalogs = set(locales())
+
+    for lang in app.config.get('LANGUAGES', LANGUAGES):
+        if lang not in catalogs:
+            continue
+
+        assets.register('js_i18n_{}'.format(lang), Bundle(
+            'gen/i18n/{}.js'.format(lang),
+            filters='rjsmin',
+            output='gen/i18n/{}.min.js'.format(lang)
+        ))
+
 
     # Register blueprints
     from flask_app_template.views.auth import bp_auth
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the coalesced user activity tracker."""
+
+import atexit
+import datetime
+import os
+import threading
+
+from sqlalchemy import case
+
+
+class ActivityTracker(object):
+    """Track when users were last seen without writing on every request.
+
+    This is optional and can be enabled by setting the configuration
+    parameter `USE_ACTIVITY_TRACKING` to `True`. Touching a user only stores
+    the time in memory, and only if the stored `last_seen_at` is older than
+    `ACTIVITY_INTERVAL`, so each user is written at most once per interval.
+    A background thread writes the pending times of all users with a single
+    `UPDATE ... SET last_seen_at = CASE id WHEN ... END` per batch.
+
+    If used, the tracker expects the following configuration parameters:
+
+    - `ACTIVITY_INTERVAL`: Minimum seconds between writes of the same user
+        (defaults to 300).
+    - `ACTIVITY_FLUSH_INTERVAL`: Seconds between writes of pending times
+        (defaults to 10).
+    - `ACTIVITY_BATCH_SIZE`: Maximum number of users per statement (defaults
+        to 500).
+    """
+
+    def __init__(self):
+        self._app = None
+        self._pending = {}
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.enabled = False
+
+    def init_app(self, app):
+        """Initialize the tracker.
+
+        The flush thread is started on the first touch, in the process that
+        records it (e.g. after the server forks its workers).
+
+        Args:
+            app: Application instance
+        """
+        self.enabled = app.config.get('USE_ACTIVITY_TRACKING', False)
+
+        if not self.enabled:
+            return
+
+        self._app = app
+        self._interval = datetime.timedelta(
+            seconds=app.config.get('ACTIVITY_INTERVAL', 300)
+        )
+        self._flush_interval = app.config.get('ACTIVITY_FLUSH_INTERVAL', 10)
+        self._batch_size = app.config.get('ACTIVITY_BATCH_SIZE', 500)
+
+        atexit.register(self.shutdown)
+
+    def touch(self, user):
+        """Record that a user has been seen now.
+
+        Args:
+            user: User instance (with its current `last_seen_at`).
+        """
+        if not self.enabled or user is None:
+            return
+
+        now = datetime.datetime.utcnow()
+
+        if user.last_seen_at and now - user.last_seen_at < self._interval:
+            return
+
+        self._start()
+
+        with self._lock:
+            self._pending[user.id] = now
+
+    def last_seen(self, user):
+        """Obtain when a user was last seen, including pending times.
+
+        Args:
+            user: User instance.
+
+        Returns:
+            `datetime` (UTC) or `None` if never seen.
+        """
+        with self._lock:
+            pending = self._pending.get(user.id)
+
+        return pending or user.last_seen_at
+
+    def flush(self):
+        """Write the pending times.
+
+        Times that cannot be written are kept for the next flush.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return
+
+        items = sorted(pending.items())
+
+        for idx in range(0, len(items), self._batch_size):
+            try:
+                self._write(dict(items[idx:idx + self._batch_size]))
+
+            except Exception:
+                self._app.logger.exception('Failed to write user activity')
+
+                with self._lock:
+                    # Keep times touched in the meantime, they are newer
+                    for user_id, seen in items[idx:]:
+                        self._pending.setdefault(user_id, seen)
+
+                return
+
+    def shutdown(self):
+        """Stop the flush thread, writing pending times."""
+        if self._pid != os.getpid():
+            return
+
+        self._stopping.set()
+        self._thread.join(10)
+
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        """Start the flush thread for the current process."""
+        pid = os.getpid()
+
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            # Times touched in the parent belong to the parent
+            self._pending = {}
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+
+            self._pid = pid
+
+    def _work(self):
+        """Write pending times periodically until stopped."""
+        with self._app.app_context():
+            while not self._stopping.wait(self._flush_interval):
+                self.flush()
+
+            self.flush()
+
+    def _write(self, times):
+        """Update `last_seen_at` of several users in a single statement.
+
+        Args:
+            times (dict): Time by user ID.
+        """
+        from flask_app_template import cache, db
+        from flask_app_template.models import User
+
+        users = User.__table__
+
+        statement = (
+            users.update()
+            .where(users.c.id.in_(list(times)))
+            .values(last_seen_at=case(times, value=users.c.id))
+        )
+
+        with db.engine.begin() as connection:
+            connection.execute(statement)
+
+        cache.invalidate(keys=[User.cache_key(i) for i in times])
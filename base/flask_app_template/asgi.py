@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the ASGI entry point.
+
+The application can be served by an ASGI server (e.g. uvicorn) with:
+
+    uvicorn --factory flask_app_template.asgi:create_app
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import sys
+import threading
+
+from flask_app_template import async_mailer, init_app
+
+
+# Returned instead of the body when the client leaves while sending it
+_DISCONNECTED = object()
+
+
+class _ClientDisconnected(Exception):
+    """Raised in the view thread when the response can no longer be sent."""
+
+
+class ASGIAdapter(object):
+    """Serve a WSGI application through ASGI.
+
+    Connections are handled in the event loop: the request body is received
+    before the view is called and the response is sent once the view has
+    produced it, so slow clients do not hold a thread. Only the view itself
+    (hashing, database queries, rendering) runs in a thread of a bounded
+    pool.
+
+    The adapter expects the following configuration parameters:
+
+    - `ASGI_THREADS`: Number of threads running views (defaults to 10). It
+        should not exceed the size of the database connection pool.
+    - `ASGI_RESPONSE_BUFFER`: Number of response chunks buffered for each
+        request (defaults to 16). Views streaming faster than the client
+        reads wait for room in the buffer.
+
+    Args:
+        app: Flask application.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            app.config.get('ASGI_THREADS', 10),
+            thread_name_prefix='asgi'
+        )
+        self.buffer_size = app.config.get('ASGI_RESPONSE_BUFFER', 16)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported scope: {}'.format(scope['type']))
+
+        body = await self._receive_body(receive)
+
+        if body is _DISCONNECTED:
+            return
+
+        if body is None:
+            await self._send_error(send, 413, b'Request Entity Too Large')
+            return
+
+        await self._respond(self._environ(scope, body), send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                async_mailer.start(asyncio.get_event_loop())
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                await async_mailer.shutdown()
+                self.executor.shutdown(wait=False)
+
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _receive_body(self, receive):
+        """Receive the whole request body.
+
+        Returns:
+            Body, `None` if it exceeds `MAX_CONTENT_LENGTH` or
+            `_DISCONNECTED` if the client disconnected before sending all of
+            it.
+        """
+        limit = self.app.config.get('MAX_CONTENT_LENGTH')
+        chunks = []
+        size = 0
+
+        while True:
+            message = await receive()
+
+            if message['type'] == 'http.disconnect':
+                return _DISCONNECTED
+
+            chunk = message.get('body', b'')
+            size += len(chunk)
+
+            if limit is not None and size > limit:
+                return None
+
+            chunks.append(chunk)
+
+            if not message.get('more_body', False):
+                break
+
+        return b''.join(chunks)
+
+    def _environ(self, scope, body):
+        """Build the WSGI environment of a request."""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+
+        # Paths are decoded as latin-1 in WSGI (PEP 3333)
+        script_name = scope.get('root_path', '').encode('utf-8')
+        path = scope['path'].encode('utf-8')
+
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': script_name.decode('latin-1'),
+            'PATH_INFO': path.decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope['http_version']),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+                continue
+
+            if name == 'CONTENT_LENGTH':
+                environ['CONTENT_LENGTH'] = value
+                continue
+
+            key = 'HTTP_' + name
+
+            if key in environ:
+                value = environ[key] + ',' + value
+
+            environ[key] = value
+
+        return environ
+
+    async def _respond(self, environ, send):
+        """Run the application in the pool and send its output.
+
+        The view pushes the status, headers and body chunks to a bounded
+        queue, which is consumed here. Small responses release the thread as
+        soon as they have been produced, regardless of the speed of the
+        client, while large streamed responses wait for the client instead of
+        being buffered in memory.
+        """
+        loop = asyncio.get_event_loop()
+        messages = asyncio.Queue(self.buffer_size)
+        closed = threading.Event()
+
+        def push(message):
+            # The end of the response is always pushed, so the loop below
+            # never waits forever
+            if message is not None and closed.is_set():
+                raise _ClientDisconnected()
+
+            # Block the view until there is room in the queue
+            asyncio.run_coroutine_threadsafe(
+                messages.put(message),
+                loop
+            ).result()
+
+        future = loop.run_in_executor(self.executor, self._run, environ, push)
+
+        try:
+            while True:
+                message = await messages.get()
+
+                if message is None:
+                    break
+
+                await send(message)
+
+        except BaseException:
+            # Stop the view and let it finish without sending anything
+            closed.set()
+
+            while await messages.get() is not None:
+                pass
+
+            raise
+
+        await send({'type': 'http.response.body', 'body': b''})
+        await future
+
+    def _run(self, environ, push):
+        """Call the WSGI application (in a thread of the pool)."""
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (k.lower().encode('latin-1'), v.encode('latin-1'))
+                for k, v in headers
+            ]
+
+            return write
+
+        def write(data):
+            if not response.get('started'):
+                response['started'] = True
+                push({
+                    'type': 'http.response.start',
+                    'status': response['status'],
+                    'headers': response['headers']
+                })
+
+            if data:
+                push({
+                    'type': 'http.response.body',
+                    'body': bytes(data),
+                    'more_body': True
+                })
+
+        try:
+            result = self.app(environ, start_response)
+
+            try:
+                for data in result:
+                    write(data)
+
+                write(b'')
+
+            finally:
+                close = getattr(result, 'close', None)
+
+                if close is not None:
+                    close()
+
+        except _ClientDisconnected:
+            pass
+
+        except Exception:
+            self.app.logger.exception('Error running request')
+
+            if not response.get('started'):
+                response['status'] = 500
+                response['headers'] = [(b'content-type', b'text/plain')]
+                write(b'Internal Server Error')
+
+        finally:
+            push(None)
+
+    async def _send_error(self, send, status, body):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'text/plain')]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def create_app():
+    """Create the ASGI application."""
+    return ASGIAdapter(init_app())
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the authentication event log."""
+
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+from flask import has_request_context, request
+
+
+class AuditLog(object):
+    """Write-behind log of authentication events.
+
+    This is optional and can be enabled by setting the configuration
+    parameter `USE_AUDIT_LOG` to `True`. Recording an event only adds it to
+    an in-memory buffer. A background thread inserts buffered events in
+    batches (a single `executemany`) when enough events are pending or
+    after some time. Events that cannot be inserted (e.g. the database is
+    unavailable) are appended to a local file and inserted later. Pending
+    events are written when the process exits.
+
+    If used, the log expects the following configuration parameters:
+
+    - `AUDIT_LOG_BATCH_SIZE`: Number of events that triggers an insert
+        (defaults to 100).
+    - `AUDIT_LOG_FLUSH_INTERVAL`: Maximum seconds an event waits in the
+        buffer (defaults to 1).
+    - `AUDIT_LOG_BUFFER_SIZE`: Maximum number of events in the buffer, after
+        which events are written to the file directly (defaults to 10000).
+    - `AUDIT_LOG_SPILL_FILE`: File in which events are stored when they
+        cannot be inserted (defaults to `audit_spill.jsonl` in the instance
+        path).
+    """
+
+    def __init__(self):
+        self._app = None
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.enabled = False
+
+    def init_app(self, app):
+        """Initialize the log.
+
+        The flush thread is started on the first event, in the process that
+        records it (e.g. after the server forks its workers).
+
+        Args:
+            app: Application instance
+        """
+        self.enabled = app.config.get('USE_AUDIT_LOG', False)
+
+        if not self.enabled:
+            return
+
+        self._app = app
+        self._batch_size = app.config.get('AUDIT_LOG_BATCH_SIZE', 100)
+        self._interval = app.config.get('AUDIT_LOG_FLUSH_INTERVAL', 1)
+        self._spill_file = app.config.get(
+            'AUDIT_LOG_SPILL_FILE',
+            os.path.join(app.instance_path, 'audit_spill.jsonl')
+        )
+
+        os.makedirs(os.path.dirname(self._spill_file), exist_ok=True)
+        atexit.register(self.shutdown)
+
+    def record(self, event, user=None, identity=None):
+        """Record an authentication event.
+
+        The IP address and user agent are taken from the current request.
+
+        Args:
+            event (str): Name of the event (e.g. `'login_failure'`).
+            user: User the event refers to, if known.
+            identity (str): Identity provided by the client (e.g. username
+                or email used to log in).
+        """
+        if not self.enabled:
+            return
+
+        row = {
+            'event': event,
+            'user_id': user.id if user is not None else None,
+            'identity': identity[:255] if identity else None,
+            'ip': None,
+            'user_agent': None,
+            'created_at': datetime.datetime.utcnow(),
+        }
+
+        if has_request_context():
+            row['ip'] = request.remote_addr
+            row['user_agent'] = request.user_agent.string[:255] or None
+
+        self._start()
+
+        try:
+            self._queue.put_nowait(row)
+
+        except queue.Full:
+            self._spill([row])
+
+    def shutdown(self):
+        """Stop the flush thread, writing pending events."""
+        if self._pid != os.getpid():
+            return
+
+        self._stopping.set()
+        self._thread.join(10)
+
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        """Start the flush thread for the current process."""
+        pid = os.getpid()
+
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            self._queue = queue.Queue(
+                maxsize=self._app.config.get('AUDIT_LOG_BUFFER_SIZE', 10000)
+            )
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+
+            self._pid = pid
+
+    def _work(self):
+        """Insert buffered events until stopped."""
+        with self._app.app_context():
+            self._unspill()
+
+            while not self._stopping.is_set():
+                rows = self._collect()
+
+                if rows:
+                    self._insert(rows)
+
+            # Write whatever is left
+            rows = []
+
+            while True:
+                try:
+                    rows.append(self._queue.get_nowait())
+
+                except queue.Empty:
+                    break
+
+            if rows:
+                self._insert(rows)
+
+    def _collect(self):
+        """Wait for a batch of events or for the flush interval.
+
+        Returns:
+            List of events.
+        """
+        rows = []
+        deadline = time.monotonic() + self._interval
+
+        while len(rows) < self._batch_size:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0 or self._stopping.is_set():
+                break
+
+            try:
+                rows.append(self._queue.get(timeout=min(timeout, 0.5)))
+
+            except queue.Empty:
+                continue
+
+        return rows
+
+    def _write(self, rows):
+        """Insert events in a single statement."""
+        from flask_app_template import db
+        from flask_app_template.models import AuthEvent
+
+        with db.engine.begin() as connection:
+            connection.execute(AuthEvent.__table__.insert(), rows)
+
+    def _insert(self, rows):
+        """Insert events, storing them in the spill file on failure."""
+        try:
+            self._write(rows)
+
+        except Exception:
+            self._app.logger.exception('Failed to insert audit events')
+            self._spill(rows)
+            return
+
+        self._unspill()
+
+    def _spill(self, rows):
+        """Append events to the spill file."""
+        with self._spill_lock:
+            with open(self._spill_file, 'a') as f:
+                for row in rows:
+                    row = dict(
+                        row,
+                        created_at=row['created_at'].isoformat(
+                            timespec='microseconds'
+                        )
+                    )
+                    f.write(json.dumps(row) + '\n')
+
+    def _unspill(self):
+        """Insert the events stored in the spill file, if any."""
+        if not os.path.exists(self._spill_file):
+            return
+
+        claimed_path = '{}.{}'.format(self._spill_file, os.getpid())
+
+        with self._spill_lock:
+            try:
+                # Prevent other processes from taking the events
+                os.rename(self._spill_file, claimed_path)
+
+            except OSError:
+                return
+
+        with open(claimed_path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+        os.remove(claimed_path)
+
+        for row in rows:
+            row['created_at'] = datetime.datetime.strptime(
+                row['created_at'],
+                '%Y-%m-%dT%H:%M:%S.%f'
+            )
+
+        for idx in range(0, len(rows), self._batch_size):
+            try:
+                self._write(rows[idx:idx + self._batch_size])
+
+            except Exception:
+                # Still unavailable, keep the rest for later
+                self._spill(rows[idx:])
+                return
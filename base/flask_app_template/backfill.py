@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the data migration (backfill) runner.
+
+Backfills update existing rows in small transactions over ranges of primary
+keys instead of a single statement, so tables are never locked for long and
+the process can be interrupted and resumed. They are registered with the
+`backfill` decorator and run through the `backfill` CLI commands:
+
+    @backfill('unsupported_locales', User.__table__)
+    def unsupported_locales(connection, start, end):
+        ...
+        return result.rowcount
+
+The function receives a connection inside a transaction and must only
+process rows whose primary key is in `[start, end)`. The checkpoint of the
+range is stored in the same transaction, so a run that crashes (or is killed)
+resumes from the last committed batch, and the batch that was in progress is
+processed again. The in-process caches of all the processes are cleared when
+a run ends.
+
+Checkpoints are stored in the `backfill_checkpoints` table (see `models.py`),
+which is created through the database migrations like any other table.
+"""
+
+import concurrent.futures
+import datetime
+import threading
+import time
+
+from sqlalchemy import func, select
+
+from flask_app_template import cache, db
+from flask_app_template.bootstrap import LANGUAGES
+from flask_app_template.models import User, backfill_checkpoints
+
+
+_registry = {}
+
+
+class Backfill(object):
+    """Registered backfill.
+
+    Args:
+        name (str): Unique name.
+        table: Table whose rows are processed. Must have a single integer
+            primary key.
+        func: Function processing a range of primary keys.
+        batch_size (int): Number of primary keys processed per transaction.
+    """
+
+    def __init__(self, name, table, func, batch_size=1000):
+        self.name = name
+        self.table = table
+        self.func = func
+        self.batch_size = batch_size
+        self.description = (func.__doc__ or '').strip().split('\n')[0]
+
+        primary_key = list(table.primary_key.columns)
+
+        if len(primary_key) != 1:
+            raise ValueError(
+                'Backfill tables must have a single primary key column'
+            )
+
+        self.primary_key = primary_key[0]
+
+
+def backfill(name, table, batch_size=1000):
+    """Register a backfill.
+
+    Args:
+        name (str): Unique name.
+        table: Table whose rows are processed.
+        batch_size (int): Number of primary keys processed per transaction.
+    """
+    def decorator(func):
+        if name in _registry:
+            raise ValueError('Backfill {} already registered'.format(name))
+
+        _registry[name] = Backfill(name, table, func, batch_size)
+
+        return func
+
+    return decorator
+
+
+def get_backfill(name):
+    """Obtain a registered backfill or `None`."""
+    return _registry.get(name)
+
+
+def registered():
+    """Obtain all the registered backfills, sorted by name."""
+    return [_registry[name] for name in sorted(_registry)]
+
+
+def check_table():
+    """Make sure the checkpoint table exists.
+
+    Raises:
+        `RuntimeError` if the table was not created by the migrations.
+    """
+    with db.engine.connect() as connection:
+        exists = db.engine.dialect.has_table(
+            connection,
+            backfill_checkpoints.name
+        )
+
+    if not exists:
+        raise RuntimeError(
+            'Table {} does not exist, upgrade the database first'.format(
+                backfill_checkpoints.name
+            )
+        )
+
+
+def checkpoint_rows(name):
+    """Obtain the checkpoints of a backfill.
+
+    Returns:
+        List of rows of the checkpoint table, sorted by range.
+    """
+    query = (
+        select([backfill_checkpoints])
+        .where(backfill_checkpoints.c.name == name)
+        .order_by(backfill_checkpoints.c.range_start)
+    )
+
+    with db.engine.connect() as connection:
+        return connection.execute(query).fetchall()
+
+
+def reset(name):
+    """Remove the checkpoints of a backfill, so it starts over."""
+    with db.engine.begin() as connection:
+        connection.execute(
+            backfill_checkpoints.delete()
+            .where(backfill_checkpoints.c.name == name)
+        )
+
+
+class BackfillRunner(object):
+    """Run a backfill over primary key ranges, optionally in parallel.
+
+    The full range of primary keys is split in one contiguous range per
+    worker the first time the backfill runs. Each range stores its position
+    after every batch, so an interrupted backfill resumes where it stopped
+    (with the ranges it was started with).
+
+    Args:
+        app: Application instance.
+        backfill: `Backfill` to run.
+        workers (int): Number of threads processing ranges in parallel.
+        batch_size (int): Overrides the batch size of the backfill.
+        sleep (float): Seconds to wait between batches in each worker.
+    """
+
+    def __init__(self, app, backfill, workers=1, batch_size=None, sleep=0):
+        self.app = app
+        self.backfill = backfill
+        self.workers = workers
+        self.batch_size = batch_size or backfill.batch_size
+        self.sleep = sleep
+
+        self.stopping = threading.Event()
+
+        self._lock = threading.Lock()
+        self._ranges = []
+        self._total = 0
+        self._done = 0
+        self._rows = 0
+        self._started_at = None
+
+    def prepare(self):
+        """Create the checkpoints of the ranges if needed.
+
+        Returns:
+            `True` if there is anything left to process.
+        """
+        name = self.backfill.name
+        rows = checkpoint_rows(name)
+
+        if not rows:
+            self._create_ranges()
+            rows = checkpoint_rows(name)
+
+        self._ranges = [r for r in rows if not r.finished]
+        self._total = sum(r.range_end - r.range_start for r in rows)
+        self._done = sum(r.position - r.range_start for r in rows)
+        self._rows = sum(r.affected_rows for r in rows)
+
+        return bool(self._ranges)
+
+    def _create_ranges(self):
+        pk = self.backfill.primary_key
+
+        with db.engine.connect() as connection:
+            low, high = connection.execute(
+                select([func.min(pk), func.max(pk)])
+            ).first()
+
+        if low is None:
+            bounds = [(0, 0)]
+
+        else:
+            high += 1
+            step = -(-(high - low) // self.workers)
+            bounds = [
+                (start, min(start + step, high))
+                for start in range(low, high, step)
+            ]
+
+        now = datetime.datetime.utcnow()
+
+        with db.engine.begin() as connection:
+            connection.execute(backfill_checkpoints.insert(), [
+                {
+                    'name': self.backfill.name,
+                    'range_start': start,
+                    'range_end': end,
+                    'position': start,
+                    'affected_rows': 0,
+                    'finished': start >= end,
+                    'updated_at': now,
+                }
+                for start, end in bounds
+            ])
+
+    def run(self, report=None, interval=5):
+        """Process the pending ranges.
+
+        Args:
+            report: Callable receiving the progress (see `progress()`)
+                every `interval` seconds and when finished.
+            interval (float): Seconds between reports.
+
+        Returns:
+            `True` if all the ranges were completed, `False` if stopped.
+        """
+        self._started_at = time.monotonic()
+        started_done = self._done
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                futures = [
+                    pool.submit(self._process_range, r) for r in self._ranges
+                ]
+
+                try:
+                    while True:
+                        finished, pending = concurrent.futures.wait(
+                            futures,
+                            timeout=interval,
+                            return_when=concurrent.futures.FIRST_EXCEPTION
+                        )
+
+                        if not pending:
+                            break
+
+                        if any(f.exception() for f in finished):
+                            # Do not start more batches after a failure
+                            self.stopping.set()
+                            concurrent.futures.wait(futures)
+                            break
+
+                        if report:
+                            report(self.progress(started_done))
+
+                except KeyboardInterrupt:
+                    # Let workers finish their current batch
+                    self.stopping.set()
+                    concurrent.futures.wait(futures)
+
+                # Propagate errors
+                for future in futures:
+                    future.result()
+
+        finally:
+            # Rows were updated without the ORM, even if the run failed
+            if self._rows:
+                cache.clear()
+
+        if report:
+            report(self.progress(started_done))
+
+        return not self.stopping.is_set()
+
+    def progress(self, started_done=0):
+        """Obtain the current progress.
+
+        Args:
+            started_done (int): Primary keys already processed when the run
+                started, excluded from the rate.
+
+        Returns:
+            Dictionary with the processed and total primary keys, the
+            affected rows, the percentage, the rate (primary keys per second)
+            and the estimated seconds left (or `None`).
+        """
+        with self._lock:
+            done, rows = self._done, self._rows
+
+        elapsed = time.monotonic() - self._started_at
+        rate = (done - started_done) / elapsed if elapsed > 0 else 0
+        left = self._total - done
+
+        return {
+            'done': done,
+            'total': self._total,
+            'rows': rows,
+            'percent': 100.0 * done / self._total if self._total else 100.0,
+            'rate': rate,
+            'eta': left / rate if rate else None,
+        }
+
+    def _process_range(self, checkpoint):
+        """Process a range in batches (in a worker thread)."""
+        with self.app.app_context():
+            position = checkpoint.position
+            end = checkpoint.range_end
+
+            while position < end and not self.stopping.is_set():
+                batch_end = min(position + self.batch_size, end)
+
+                with db.engine.begin() as connection:
+                    rows = self.backfill.func(
+                        connection,
+                        position,
+                        batch_end
+                    ) or 0
+
+                    connection.execute(
+                        backfill_checkpoints.update()
+                        .where(
+                            backfill_checkpoints.c.name ==
+                            checkpoint.name
+                        )
+                        .where(
+                            backfill_checkpoints.c.range_start ==
+                            checkpoint.range_start
+                        )
+                        .values(
+                            position=batch_end,
+                            affected_rows=(
+                                backfill_checkpoints.c.affected_rows + rows
+                            ),
+                            finished=batch_end >= end,
+                            updated_at=datetime.datetime.utcnow()
+                        )
+                    )
+
+                with self._lock:
+                    self._done += batch_end - position
+                    self._rows += rows
+
+                position = batch_end
+
+                if self.sleep and position < end:
+                    self.stopping.wait(self.sleep)
+
+
+# Backfills
+@backfill('unsupported_locales', User.__table__)
+def unsupported_locales(connection, start, end):
+    """Reset the locale of users whose locale is no longer available."""
+    users = User.__table__
+
+    result = connection.execute(
+        users.update()
+        .where(users.c.id >= start)
+        .where(users.c.id < end)
+        .where(~users.c.locale.in_(LANGUAGES))
+        .values(locale='en')
+    )
+
+    return result.rowcount
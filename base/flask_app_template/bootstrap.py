@@ -20,6 +20,26 @@ BASE_CONFIG = {
 
     # Flask-SQLAlchemy
     'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    'SQLALCHEMY_ENGINE_OPTIONS': {
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 10,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    },
+    'SQLALCHEMY_SQLITE_PRAGMAS': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,
+        'cache_size': -64000,
+        'busy_timeout': 5000,
+    },
+
+    # Query tracking
+    'USE_QUERY_TRACKING': True,
+
+    # Liveness/readiness probes
+    'USE_HEALTH_CHECKS': True,
 
     # Flask-Login
     'SESSION_PROTECTION': 'strong',
@@ -41,6 +61,9 @@ DEV_CONFIG = {
 
     # Database path
     'SQLALCHEMY_DATABASE_URI': 'sqlite:////{}'.format(os.path.join(os.getcwd(), "testdb.sqlite")),
+    'SQLALCHEMY_ENGINE_OPTIONS': {
+        'pool_pre_ping': False,
+    },
 
     # Debug toolbar
     'DEBUG_TB_INTERCEPT_REDIRECTS': False,
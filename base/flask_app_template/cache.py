@@ -0,0 +1,551 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the in-process cache and its invalidation bus.
+
+Every process keeps its own cache. When data changes, the affected keys and
+tags are evicted locally and published on a bus, so the other processes
+(workers, nodes, CLI commands) evict them too:
+
+    cache.set('roles:admins', ids, tags=['roles', 'user_roles'])
+    ...
+    cache.invalidate(tags=['roles'])
+
+Changes made through the ORM are published automatically after the session
+commits (see `BaseModel.cache_tags()`). Changes made with Core statements
+must call `invalidate()` themselves.
+"""
+
+import atexit
+import collections
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+
+_MISSING = object()
+
+
+class LocalCache(object):
+    """Thread-safe LRU cache with expiration and tags.
+
+    Args:
+        size (int): Maximum number of entries.
+        ttl (float): Default seconds an entry is kept.
+    """
+
+    def __init__(self, size=10000, ttl=300):
+        self._size = size
+        self._ttl = ttl
+        self._data = collections.OrderedDict()
+        self._tags = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+        # Incremented on every eviction (see `set()`)
+        self.generation = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None:
+                return default
+
+            if item[1] < time.monotonic():
+                self._remove(key)
+                return default
+
+            self._data.move_to_end(key)
+
+            return item[0]
+
+    def set(self, key, value, tags=(), ttl=None, generation=None):
+        """Store a value.
+
+        Args:
+            key (str): Key of the entry.
+            value: Value to store.
+            tags (list): Tags the entry is evicted with.
+            ttl (float): Seconds the entry is kept.
+            generation (int): If given, the value is only stored if nothing
+                was evicted since `generation` was read, because the value
+                may have been loaded before the eviction.
+        """
+        expires = time.monotonic() + (ttl or self._ttl)
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._remove(key)
+            self._data[key] = (value, expires, tuple(tags))
+
+            for tag in tags:
+                self._tags[tag].add(key)
+
+            while len(self._data) > self._size:
+                self._remove(next(iter(self._data)))
+
+    def evict(self, keys=(), tags=()):
+        with self._lock:
+            self.generation += 1
+
+            for key in keys:
+                self._remove(key)
+
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self._tags.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+
+        if item is None:
+            return
+
+        for tag in item[2]:
+            keys = self._tags.get(tag)
+
+            if keys is not None:
+                keys.discard(key)
+
+                if not keys:
+                    del self._tags[tag]
+
+
+class SocketTransport(object):
+    """Bus between the processes of a single host.
+
+    Each subscribed process binds a UNIX datagram socket in a shared
+    directory. Messages are sent to every socket in the directory; sockets
+    of processes that are gone are removed.
+
+    Args:
+        directory (str): Shared directory. Its path must be short, since
+            socket paths are limited to about 100 characters.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+
+        self._directory = directory
+        self._path = None
+        self._logger = None
+
+        self.dropped = 0
+
+    def publish(self, payload):
+        """Send a message to the other processes without blocking.
+
+        A message is dropped for a process whose socket buffer is full (e.g.
+        it is busy), so that the others still receive it and the publishing
+        request does not wait. Drops are counted in `dropped`.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+
+        try:
+            for name in os.listdir(self._directory):
+                path = os.path.join(self._directory, name)
+
+                if not name.endswith('.sock') or path == self._path:
+                    continue
+
+                try:
+                    sock.sendto(payload, path)
+
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Nobody is listening anymore
+                    try:
+                        os.remove(path)
+
+                    except OSError:
+                        pass
+
+                except OSError as e:
+                    self.dropped += 1
+
+                    if self._logger:
+                        self._logger.warning(
+                            'Cache message to %s dropped: %s', name, e
+                        )
+
+        finally:
+            sock.close()
+
+    def subscribe(self, callback, logger, on_connect=None):
+        """Deliver the messages to `callback` from a background thread."""
+        self._logger = logger
+        self._path = os.path.join(
+            self._directory,
+            '{}-{}.sock'.format(os.getpid(), uuid.uuid4().hex[:8])
+        )
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self._path)
+
+        if on_connect:
+            on_connect()
+
+        def listen():
+            while True:
+                try:
+                    callback(sock.recv(65536))
+
+                except Exception:
+                    logger.exception('Failed to process cache message')
+
+        threading.Thread(target=listen, daemon=True).start()
+
+    def close(self):
+        if self._path:
+            try:
+                os.remove(self._path)
+
+            except OSError:
+                pass
+
+
+class RedisTransport(object):
+    """Bus based on Redis (or Redis protocol compatible) pub/sub.
+
+    Args:
+        url (str): URL of the server.
+        channel (str): Channel the messages are published on.
+    """
+
+    def __init__(self, url, channel):
+        import redis
+
+        self._client = redis.StrictRedis.from_url(url)
+        self._channel = channel
+
+    def publish(self, payload):
+        self._client.publish(self._channel, payload)
+
+    def subscribe(self, callback, logger, on_connect=None):
+        """Deliver the messages to `callback` from a background thread.
+
+        `on_connect` is called after every (re)connection, since messages
+        published while disconnected are lost.
+        """
+        def listen():
+            delay = 1
+
+            while True:
+                try:
+                    pubsub = self._client.pubsub(
+                        ignore_subscribe_messages=True
+                    )
+                    pubsub.subscribe(self._channel)
+
+                    if on_connect:
+                        on_connect()
+
+                    delay = 1
+
+                    for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            callback(message['data'])
+
+                except Exception:
+                    logger.exception('Cache bus disconnected')
+
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+        threading.Thread(target=listen, daemon=True).start()
+
+    def close(self):
+        pass
+
+
+class Cache(object):
+    """In-process cache invalidated across processes.
+
+    This is optional and can be enabled by setting the configuration
+    parameter `USE_CACHE` to `True`. If disabled, nothing is cached and
+    loaders are always called. If used, it expects the following
+    configuration parameters:
+
+    - `CACHE_SIZE`: Maximum number of entries per process (defaults to
+        10000).
+    - `CACHE_TTL`: Default seconds an entry is kept (defaults to 300). It
+        also bounds how long an entry may be stale if a message is lost.
+    - `CACHE_BUS`: `'local'` (UNIX sockets, single host), `'redis'` or
+        `None` for a single process (defaults to `'local'`).
+    - `CACHE_BUS_DIR`: Directory of the sockets of the local bus (defaults
+        to `cache_bus` in the instance path).
+    - `CACHE_BUS_REDIS_URL`: URL of the Redis bus (defaults to
+        `'redis://localhost:6379/0'`).
+    - `CACHE_BUS_CHANNEL`: Channel of the Redis bus (defaults to
+        `'cache-invalidation'`).
+    """
+
+    def __init__(self):
+        self._app = None
+        self._store = None
+        self._transport = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._origin = uuid.uuid4().hex
+        self.enabled = False
+
+    def init_app(self, app):
+        """Initialize the cache and the ORM hooks.
+
+        Each process subscribes to the bus the first time it uses the cache
+        (e.g. after the server forks its workers).
+
+        Args:
+            app: Application instance.
+        """
+        self.enabled = app.config.get('USE_CACHE', False)
+
+        if not self.enabled:
+            return
+
+        self._app = app
+        self._store = LocalCache(
+            app.config.get('CACHE_SIZE', 10000),
+            app.config.get('CACHE_TTL', 300)
+        )
+
+        bus = app.config.get('CACHE_BUS', 'local')
+
+        if bus == 'local':
+            self._transport = SocketTransport(
+                app.config.get(
+                    'CACHE_BUS_DIR',
+                    os.path.join(app.instance_path, 'cache_bus')
+                )
+            )
+
+        elif bus == 'redis':
+            self._transport = RedisTransport(
+                app.config.get(
+                    'CACHE_BUS_REDIS_URL',
+                    'redis://localhost:6379/0'
+                ),
+                app.config.get('CACHE_BUS_CHANNEL', 'cache-invalidation')
+            )
+
+        elif bus:
+            raise ValueError('Unknown cache bus: {}'.format(bus))
+
+        from flask_app_template import db
+
+        event.listen(db.session, 'after_flush', self._after_flush)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_rollback', self._after_rollback)
+
+        atexit.register(self._close)
+
+    def get(self, key, default=None):
+        """Obtain a cached value.
+
+        Args:
+            key (str): Key of the entry.
+            default: Value returned if not cached.
+        """
+        if not self.enabled:
+            return default
+
+        self._subscribe()
+
+        return self._store.get(key, default)
+
+    def set(self, key, value, tags=(), ttl=None):
+        """Cache a value.
+
+        Args:
+            key (str): Key of the entry.
+            value: Value to cache. It is shared between threads and must
+                not be modified.
+            tags (list): Tags the entry is evicted with.
+            ttl (float): Seconds the entry is kept.
+        """
+        if not self.enabled:
+            return
+
+        self._subscribe()
+        self._store.set(key, value, tags, ttl)
+
+    def get_or_load(self, key, loader, tags=(), ttl=None):
+        """Obtain a cached value, calling `loader` to obtain it if missing.
+
+        The result is not cached if an eviction happened while loading.
+
+        Args:
+            key (str): Key of the entry.
+            loader: Callable returning the value.
+            tags (list): Tags the entry is evicted with.
+            ttl (float): Seconds the entry is kept.
+        """
+        if not self.enabled:
+            return loader()
+
+        self._subscribe()
+
+        value = self._store.get(key, _MISSING)
+
+        if value is not _MISSING:
+            return value
+
+        generation = self._store.generation
+        value = loader()
+        self._store.set(key, value, tags, ttl, generation)
+
+        return value
+
+    def get_instance(self, model, id):
+        """Obtain a model instance by ID, caching its column values.
+
+        The instance is attached to the current session without querying
+        the database. Relationships are loaded as usual.
+
+        Args:
+            model: Model class (see `BaseModel`).
+            id: ID of the instance.
+
+        Returns:
+            Instance or `None` if not found.
+        """
+        if not self.enabled:
+            return model.get_by_id(id)
+
+        from flask_app_template import db
+
+        def load():
+            instance = model.get_by_id(id)
+
+            if instance is None:
+                return None
+
+            return {
+                attr.key: getattr(instance, attr.key)
+                for attr in inspect(model).column_attrs
+            }
+
+        key = model.cache_key(id)
+        values = self.get_or_load(key, load, tags=[key])
+
+        if values is None:
+            return None
+
+        instance = model(**values)
+        make_transient_to_detached(instance)
+
+        return db.session.merge(instance, load=False)
+
+    def invalidate(self, keys=(), tags=()):
+        """Evict entries in this process and publish the eviction.
+
+        Args:
+            keys (list): Keys of the entries.
+            tags (list): Tags of the entries.
+        """
+        if not self.enabled or not (keys or tags):
+            return
+
+        keys, tags = list(keys), list(tags)
+
+        self._store.evict(keys, tags)
+
+        # Keep messages small enough for a datagram
+        for idx in range(0, max(len(keys), len(tags)), 500):
+            self._publish({
+                'keys': keys[idx:idx + 500],
+                'tags': tags[idx:idx + 500],
+            })
+
+    def clear(self):
+        """Evict all the entries in all the processes."""
+        if not self.enabled:
+            return
+
+        self._store.clear()
+        self._publish({'clear': True})
+
+    def _publish(self, message):
+        if self._transport is None:
+            return
+
+        message['origin'] = self._origin
+
+        try:
+            self._transport.publish(json.dumps(message).encode('utf-8'))
+
+        except Exception:
+            self._app.logger.exception('Failed to publish cache eviction')
+
+    def _receive(self, payload):
+        message = json.loads(payload.decode('utf-8'))
+
+        if message.get('origin') == self._origin:
+            return
+
+        if message.get('clear'):
+            self._store.clear()
+
+        else:
+            self._store.evict(message.get('keys', ()), message.get('tags', ()))
+
+    def _subscribe(self):
+        """Subscribe the current process to the bus."""
+        pid = os.getpid()
+
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            self._origin = uuid.uuid4().hex
+
+            if self._transport is not None:
+                # Evictions missed before subscribing (e.g. sent to the
+                # parent after forking) are not received
+                self._transport.subscribe(
+                    self._receive,
+                    self._app.logger,
+                    on_connect=self._store.clear
+                )
+
+            self._pid = pid
+
+    def _close(self):
+        if self._pid == os.getpid() and self._transport is not None:
+            self._transport.close()
+
+    # ORM hooks
+    def _after_flush(self, session, flush_context):
+        tags = session.info.setdefault('cache_tags', set())
+
+        for instance in session.new | session.dirty | session.deleted:
+            if hasattr(instance, 'cache_tags'):
+                tags.update(instance.cache_tags())
+
+    def _after_commit(self, session):
+        tags = session.info.pop('cache_tags', None)
+
+        if tags:
+            self.invalidate(tags=sorted(tags))
+
+    def _after_rollback(self, session):
+        session.info.pop('cache_tags', None)
@@ -2,11 +2,13 @@
 
 """This file contains custom CLI commands."""
 
+import io
 import os
+import pstats
 
-from flask.cli import FlaskGroup
+from flask.cli import FlaskGroup, pass_script_info, with_appcontext
 
-from flask_app_template import db, crypto_manager, init_app
+from flask_app_template import db, crypto_manager, i18n, init_app, profiler
 from flask_app_template.models import Role, User
 
 import click
@@ -258,6 +260,249 @@ def roles(username):
     click.echo('Roles of user "{}}": {}'.format(username, roles))
 
 
+@user.command()
+@click.argument('query')
+@click.option('--limit', default=20, help='number of results')
+@click.option('--cursor', help='cursor of the page to show')
+def search(query, limit, cursor):
+    """Search users by username or email.
+
+    \b
+    Args:
+        query: text to search
+    """
+    try:
+        users, next_cursor = User.search(query, limit=limit, cursor=cursor)
+
+    except ValueError as e:
+        click.echo(str(e))
+        return
+
+    if not users:
+        click.echo('No users found')
+        return
+
+    for user in users:
+        click.echo('{:>8}  {:<30} {}{}'.format(
+            user.id,
+            user.username,
+            user.email,
+            '' if user.is_active else ' (inactive)'
+        ))
+
+    if next_cursor:
+        click.echo('\nNext page: --cursor {}'.format(next_cursor))
+
+
+@user.command()
+def reindex():
+    """Create (or rebuild) the user search index."""
+    from flask_app_template.search import create_index
+
+    try:
+        with db.engine.begin() as connection:
+            create_index(connection)
+
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+    click.echo('Search index created')
+
+
+# Begin server commands
+@cli.command(with_appcontext=False)
+@click.option('--bind', '-b', help='address to listen on (e.g. 0.0.0.0:8000)')
+@click.option('--workers', '-w', type=int, help='number of worker processes')
+@click.option('--threads', type=int, help='number of threads per worker')
+@click.option('--pid', help='file in which the PID of the master is stored')
+@pass_script_info
+def serve(info, bind, workers, threads, pid):
+    """Serve the application in production (requires gunicorn).
+
+    The application is loaded once and shared by the worker processes.
+    Sending `HUP` to the master gracefully replaces the workers, while
+    `USR2` starts a new master with updated code (the old one can then be
+    stopped with `TERM`, letting its in-flight requests finish).
+    """
+    from flask_app_template.server import Server, preload
+
+    app = info.load_app()
+    preload(app)
+
+    Server(
+        app,
+        bind=bind,
+        workers=workers,
+        threads=threads,
+        pidfile=pid
+    ).run()
+
+
+# Begin backfill commands
+@cli.group()
+@with_appcontext
+def backfill():
+    """Data migration commands."""
+    from flask_app_template.backfill import check_table
+
+    try:
+        check_table()
+
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+
+def _format_duration(seconds):
+    """Format a number of seconds as `1h 2m 3s`."""
+    if seconds is None:
+        return '?'
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if hours:
+        return '{}h {}m {}s'.format(hours, minutes, seconds)
+
+    if minutes:
+        return '{}m {}s'.format(minutes, seconds)
+
+    return '{}s'.format(seconds)
+
+
+@backfill.command('list')
+def backfill_list():
+    """List backfills and their progress."""
+    from flask_app_template.backfill import checkpoint_rows, registered
+
+    for item in registered():
+        rows = checkpoint_rows(item.name)
+
+        if not rows:
+            status = 'not started'
+
+        elif all(r.finished for r in rows):
+            status = 'finished'
+
+        else:
+            total = sum(r.range_end - r.range_start for r in rows)
+            done = sum(r.position - r.range_start for r in rows)
+            status = 'in progress ({:.1f}%)'.format(100.0 * done / total)
+
+        click.echo('{}: {} [{}]'.format(item.name, item.description, status))
+
+
+@backfill.command('run')
+@click.argument('name')
+@click.option('--workers', default=1, help='number of ranges in parallel')
+@click.option('--batch-size', type=int, help='primary keys per transaction')
+@click.option('--sleep', default=0.0, help='seconds between batches')
+@click.option('--restart', is_flag=True, help='discard previous progress')
+def backfill_run(name, workers, batch_size, sleep, restart):
+    """Run (or resume) a backfill.
+
+    \b
+    Args:
+        name: name of the backfill
+    """
+    from flask import current_app
+    from flask_app_template.backfill import BackfillRunner, get_backfill, \
+        reset
+
+    item = get_backfill(name)
+
+    if not item:
+        click.echo('Backfill does not exist')
+        return
+
+    if restart:
+        reset(name)
+
+    runner = BackfillRunner(
+        current_app._get_current_object(),
+        item,
+        workers=workers,
+        batch_size=batch_size,
+        sleep=sleep
+    )
+
+    if not runner.prepare():
+        click.echo('Backfill already finished (use --restart to run again)')
+        return
+
+    def report(progress):
+        click.echo(
+            '{percent:.1f}% ({done}/{total} ids, {rows} rows updated), '
+            '{rate:.0f} ids/s, ETA {eta}'.format(
+                eta=_format_duration(progress['eta']),
+                **{k: v for k, v in progress.items() if k != 'eta'}
+            )
+        )
+
+    if runner.run(report):
+        click.echo('Backfill finished')
+
+    else:
+        click.echo('Backfill interrupted, run again to resume')
+
+
+@backfill.command('reset')
+@click.argument('name')
+def backfill_reset(name):
+    """Discard the progress of a backfill.
+
+    \b
+    Args:
+        name: name of the backfill
+    """
+    from flask_app_template.backfill import reset
+
+    reset(name)
+    click.echo('Progress discarded')
+
+
+# Begin profiling commands
+@cli.group()
+def profile():
+    """Profiling commands."""
+    pass
+
+
+@profile.command()
+@click.option('--directory', help='directory containing the dumps')
+@click.option('--endpoint', help='only include dumps of this endpoint')
+@click.option('--top', default=30, help='number of functions to show')
+@click.option(
+    '--sort',
+    default='cumulative',
+    type=click.Choice(['cumulative', 'tottime', 'ncalls']),
+    help='sort order'
+)
+def report(directory, endpoint, top, sort):
+    """Aggregate profiler dumps into a report of the hottest functions."""
+    directory = directory or profiler.directory
+
+    if not directory or not os.path.isdir(directory):
+        click.echo('Profile directory does not exist')
+        return
+
+    dumps = [
+        os.path.join(directory, f) for f in sorted(os.listdir(directory))
+        if f.endswith('.prof') and
+        (not endpoint or '-{}-'.format(endpoint) in f)
+    ]
+
+    if not dumps:
+        click.echo('No profiles found')
+        return
+
+    output = io.StringIO()
+    stats = pstats.Stats(*dumps, stream=output)
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+
+    click.echo('Aggregated {} profiles'.format(len(dumps)))
+    click.echo(output.getvalue())
+
+
 # Begin translation commands
 @cli.group()
 def translate():
@@ -266,64 +511,53 @@ def translate():
 
 
 @translate.command()
-def compile():
+@click.option('--jobs', type=int, help='number of worker processes')
+@click.option('--js', is_flag=True, help='also write per-locale JS bundles')
+@click.option('--use-fuzzy', is_flag=True, help='include fuzzy translations')
+@click.option('--force', is_flag=True, help='compile unchanged catalogs')
+def compile(jobs, js, use_fuzzy, force):
     """Compile all languages."""
-    compile_cmd = (
-        'pybabel compile '
-        '-d flask_app_template/translations'
-    )
+    results = i18n.compile_catalogs(jobs, js, use_fuzzy, force)
+
+    if not results:
+        click.echo('Catalogs are up to date')
+        return
 
-    if os.system(compile_cmd):
-        raise RuntimeError('compile command failed')
+    for locale, errors in sorted(results.items()):
+        click.echo('Compiled {}'.format(locale))
+
+        for error in errors:
+            click.echo('  {}'.format(error))
 
 
 @translate.command()
 @click.argument('lang')
 def init(lang):
     """Initialize a new language."""
-    extract_cmd = (
-        'pybabel extract '
-        '-F babel.cfg '
-        '-k "lazy_gettext _l" '
-        '-o flask_app_template/translations/messages.pot .'
-    )
-
-    init_cmd = (
-        'pybabel init '
-        '-i flask_app_template/translations/messages.pot '
-        '-d flask_app_template/translations '
-        '-l {}'
-    )
+    if lang in i18n.locales():
+        click.echo('Language already exists')
+        return
 
-    if os.system(extract_cmd):
-        raise RuntimeError('extract command failed')
+    i18n.extract_messages()
+    i18n.init_catalog(lang)
 
-    if os.system(init_cmd.format(lang)):
-        raise RuntimeError('init command failed')
+    click.echo('Created catalog for {}'.format(lang))
 
 
 @translate.command()
-def update():
+@click.option('--force', is_flag=True, help='update unchanged catalogs')
+def update(force):
     """Update message catalog."""
-    extract_cmd = (
-        'pybabel extract '
-        '-F babel.cfg '
-        '-k "lazy_gettext _l" '
-        '-o flask_app_template/translations/messages.pot .'
-    )
-
-    update_cmd = (
-        'pybabel update '
-        '-i flask_app_template/translations/messages.pot '
-        '-d flask_app_template/translations'
-    )
+    if not i18n.extract_messages(force):
+        click.echo('Sources did not change since last extraction')
 
+    updated = i18n.update_catalogs(force)
 
-    if os.system(extract_cmd):
-        raise RuntimeError('extract command failed')
+    for locale in updated:
+        click.echo('Updated {}'.format(locale))
 
-    if os.system(update_cmd):
-        raise RuntimeError('update command failed')
+    if not updated:
+        click.echo('Catalogs are up to date')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the liveness and readiness endpoints."""
+
+import json
+import threading
+import time
+
+from sqlalchemy import text
+
+from flask_app_template.util import skip_session
+
+
+class HealthChecks(object):
+    """Liveness and readiness probes answered before the Flask pipeline.
+
+    Probes are handled by a WSGI middleware, so no request context is created
+    and no request hook (session, Flask-Login, Babel, CSRF, metrics...) runs.
+    The liveness probe always succeeds while the process is able to respond.
+    The readiness probe checks that the database pool is not exhausted and
+    that the database answers a query. Its result is cached for a short time,
+    so frequent probes do not add load to the database.
+
+    In addition, the session is not loaded for static files.
+
+    This is optional and can be enabled by setting the configuration
+    parameter `USE_HEALTH_CHECKS` to `True`. If used, it expects the
+    following configuration parameters:
+
+    - `HEALTH_LIVENESS_PATH`: Path of the liveness probe (defaults to
+        `'/healthz'`).
+    - `HEALTH_READINESS_PATH`: Path of the readiness probe (defaults to
+        `'/readyz'`).
+    - `HEALTH_READINESS_TTL`: Seconds the result of the readiness check is
+        cached (defaults to 2).
+    """
+
+    def __init__(self):
+        self._app = None
+        self._lock = threading.Lock()
+        self._ready = None
+        self._checked_at = 0
+
+    def init_app(self, app):
+        """Install the middleware and skip the session for static files.
+
+        Args:
+            app: Application instance.
+        """
+        if not app.config.get('USE_HEALTH_CHECKS', False):
+            return
+
+        self._app = app
+        self._ttl = app.config.get('HEALTH_READINESS_TTL', 2)
+        self._paths = {
+            app.config.get('HEALTH_LIVENESS_PATH', '/healthz'): self.live,
+            app.config.get('HEALTH_READINESS_PATH', '/readyz'): self.ready,
+        }
+
+        skip_session(app, endpoint='static')
+
+        wsgi_app = app.wsgi_app
+
+        def middleware(environ, start_response):
+            check = self._paths.get(environ.get('PATH_INFO'))
+
+            if check is None:
+                return wsgi_app(environ, start_response)
+
+            return self._respond(check(), start_response)
+
+        app.wsgi_app = middleware
+
+    def live(self):
+        """Liveness check.
+
+        Returns:
+            Dictionary with the status.
+        """
+        return {'status': 'ok'}
+
+    def ready(self):
+        """Readiness check, cached for `HEALTH_READINESS_TTL` seconds.
+
+        While a check is running, other threads obtain the previous result.
+
+        Returns:
+            Dictionary with the status and the result of each check.
+        """
+        now = time.monotonic()
+
+        if self._ready is not None and now - self._checked_at < self._ttl:
+            return self._ready
+
+        if not self._lock.acquire(blocking=self._ready is None):
+            return self._ready
+
+        try:
+            checks = {'database': self._check_database()}
+            ok = all(v == 'ok' for v in checks.values())
+
+            self._ready = {'status': 'ok' if ok else 'fail', 'checks': checks}
+            self._checked_at = time.monotonic()
+
+        finally:
+            self._lock.release()
+
+        return self._ready
+
+    def _check_database(self):
+        """Check the pool and the connection of the default engine.
+
+        Returns:
+            `'ok'` or a description of the problem.
+        """
+        from flask_app_template import db
+
+        with self._app.app_context():
+            engine = db.engine
+            pool = engine.pool
+
+            # Do not wait for a connection if there are none left
+            checkedout = getattr(pool, 'checkedout', None)
+            max_overflow = getattr(pool, '_max_overflow', -1)
+
+            if checkedout and max_overflow >= 0 and \
+                    checkedout() >= pool.size() + max_overflow:
+                return 'pool exhausted'
+
+            try:
+                with engine.connect() as connection:
+                    connection.execute(text('SELECT 1'))
+
+            except Exception as e:
+                self._app.logger.warning('Readiness check failed: %s', e)
+                return 'unavailable'
+
+        return 'ok'
+
+    def _respond(self, result, start_response):
+        body = json.dumps(result).encode('utf-8')
+        status = '200 OK' if result['status'] == 'ok' else \
+            '503 Service Unavailable'
+
+        start_response(status, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-store'),
+        ])
+
+        return [body]
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the translation catalog build.
+
+Catalogs are handled through the Babel API. The hashes of the inputs of each
+step are stored in the translations directory, so that steps whose inputs did
+not change are skipped.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+
+from babel import Locale
+from babel.messages.catalog import Catalog
+from babel.messages.extract import DEFAULT_KEYWORDS, extract_from_dir
+from babel.messages.frontend import parse_mapping
+from babel.messages.mofile import write_mo
+from babel.messages.pofile import read_po, write_po
+from babel.util import pathmatch
+
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Directory from which messages are extracted
+ROOT_DIR = os.path.dirname(PACKAGE_DIR)
+
+MAPPING_FILE = os.path.join(ROOT_DIR, 'babel.cfg')
+TRANSLATIONS_DIR = os.path.join(PACKAGE_DIR, 'translations')
+TEMPLATE_FILE = os.path.join(TRANSLATIONS_DIR, 'messages.pot')
+STATE_FILE = os.path.join(TRANSLATIONS_DIR, '.build-state.json')
+
+# Per-locale JS message bundles
+JS_DIR = os.path.join(PACKAGE_DIR, 'static', 'gen', 'i18n')
+
+KEYWORDS = dict(DEFAULT_KEYWORDS, lazy_gettext=None, _l=None)
+
+
+def _load_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(state):
+    with open(STATE_FILE, 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+
+
+def _hash_files(*paths):
+    digest = hashlib.sha1()
+
+    for path in paths:
+        digest.update(path.encode('utf-8'))
+
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def _po_path(locale):
+    return os.path.join(TRANSLATIONS_DIR, locale, 'LC_MESSAGES', 'messages.po')
+
+
+def _mo_path(locale):
+    return os.path.join(TRANSLATIONS_DIR, locale, 'LC_MESSAGES', 'messages.mo')
+
+
+def _js_path(locale):
+    return os.path.join(JS_DIR, '{}.js'.format(locale))
+
+
+def locales():
+    """Obtain the locales that have a catalog.
+
+    Returns:
+        Sorted list of locale identifiers.
+    """
+    if not os.path.isdir(TRANSLATIONS_DIR):
+        return []
+
+    return sorted(
+        l for l in os.listdir(TRANSLATIONS_DIR)
+        if os.path.isfile(_po_path(l))
+    )
+
+
+def _source_files(method_map):
+    """Files that are considered for extraction, in the same way as
+    `extract_from_dir()` walks the tree."""
+    for root, dirnames, filenames in os.walk(ROOT_DIR):
+        dirnames[:] = sorted(
+            d for d in dirnames if not d.startswith(('.', '_'))
+        )
+
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            relative = os.path.relpath(path, ROOT_DIR).replace(os.sep, '/')
+
+            if any(pathmatch(pattern, relative) for pattern, _ in method_map):
+                yield path
+
+
+def extract_messages(force=False):
+    """Extract messages into the template catalog.
+
+    Args:
+        force (bool): Extract even if no source file changed.
+
+    Returns:
+        `True` if the template was written, `False` if skipped.
+    """
+    with open(MAPPING_FILE) as f:
+        method_map, options_map = parse_mapping(f)
+
+    state = _load_state()
+    digest = _hash_files(MAPPING_FILE, *_source_files(method_map))
+
+    if (not force and state.get('sources') == digest and
+            os.path.isfile(TEMPLATE_FILE)):
+        return False
+
+    catalog = Catalog(charset='utf-8')
+
+    for filename, lineno, message, comments, context in extract_from_dir(
+            ROOT_DIR, method_map, options_map, keywords=KEYWORDS):
+        catalog.add(
+            message,
+            None,
+            [(filename, lineno)],
+            auto_comments=comments,
+            context=context
+        )
+
+    with open(TEMPLATE_FILE, 'wb') as f:
+        write_po(f, catalog, width=76)
+
+    state['sources'] = digest
+    _save_state(state)
+
+    return True
+
+
+def init_catalog(locale):
+    """Create the catalog of a new locale from the template.
+
+    Args:
+        locale (str): Locale identifier (e.g. `'es'`).
+    """
+    with open(TEMPLATE_FILE, 'rb') as f:
+        catalog = read_po(f, locale=locale)
+
+    catalog.locale = Locale.parse(locale)
+    catalog.revision_date = catalog.creation_date
+    catalog.fuzzy = False
+
+    path = _po_path(locale)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'wb') as f:
+        write_po(f, catalog, width=76)
+
+
+def update_catalogs(force=False):
+    """Merge the template into the catalog of each locale.
+
+    Args:
+        force (bool): Update even if neither the template nor the catalog
+            changed.
+
+    Returns:
+        List of updated locales.
+    """
+    state = _load_state()
+    updated = []
+
+    with open(TEMPLATE_FILE, 'rb') as f:
+        template = read_po(f)
+
+    for locale in locales():
+        path = _po_path(locale)
+        key = 'update:{}'.format(locale)
+
+        if not force and state.get(key) == _hash_files(TEMPLATE_FILE, path):
+            continue
+
+        with open(path, 'rb') as f:
+            catalog = read_po(f, locale=locale)
+
+        catalog.update(template)
+
+        with open(path, 'wb') as f:
+            write_po(f, catalog, width=76)
+
+        state[key] = _hash_files(TEMPLATE_FILE, path)
+        updated.append(locale)
+
+    _save_state(state)
+
+    return updated
+
+
+def _compile_locale(locale, js, use_fuzzy):
+    """Compile the catalog of a locale (run in a worker process).
+
+    Returns:
+        Tuple with the locale, whether it was compiled and a list of error
+        messages.
+    """
+    with open(_po_path(locale), 'rb') as f:
+        catalog = read_po(f, locale=locale)
+
+    if catalog.fuzzy and not use_fuzzy:
+        return locale, False, ['catalog is marked as fuzzy, not compiled']
+
+    errors = [
+        '{}: {}'.format(message.id, error)
+        for message, message_errors in catalog.check()
+        for error in message_errors
+    ]
+
+    with open(_mo_path(locale), 'wb') as f:
+        write_mo(f, catalog, use_fuzzy=use_fuzzy)
+
+    if js:
+        _write_js(catalog, locale, use_fuzzy)
+
+    return locale, True, errors
+
+
+def _write_js(catalog, locale, use_fuzzy):
+    """Write the translated messages of a catalog as a JS bundle."""
+    messages = {}
+
+    for message in catalog:
+        if message.pluralizable:
+            translated = all(message.string)
+
+        else:
+            translated = bool(message.string)
+
+        if not message.id or not translated:
+            continue
+
+        if message.fuzzy and not use_fuzzy:
+            continue
+
+        if message.pluralizable:
+            messages[message.id[0]] = list(message.string)
+
+        else:
+            messages[message.id] = message.string
+
+    data = {
+        'locale': locale,
+        'plural': catalog.plural_expr,
+        'messages': messages
+    }
+
+    os.makedirs(JS_DIR, exist_ok=True)
+
+    with open(_js_path(locale), 'w', encoding='utf-8') as f:
+        f.write('window.I18N = {};\n'.format(
+            json.dumps(data, ensure_ascii=False, sort_keys=True)
+        ))
+
+
+def compile_catalogs(jobs=None, js=False, use_fuzzy=False, force=False):
+    """Compile the catalogs of all locales in parallel.
+
+    Locales whose catalog did not change since they were last compiled with
+    the same options are skipped.
+
+    Args:
+        jobs (int): Number of worker processes (defaults to the number of
+            CPUs).
+        js (bool): Also write a JS bundle with the messages of each locale.
+        use_fuzzy (bool): Include fuzzy translations.
+        force (bool): Compile even if the catalogs did not change.
+
+    Returns:
+        Dictionary with the errors of each compiled locale.
+    """
+    state = _load_state()
+    pending = {}
+
+    for locale in locales():
+        key = 'compile:{}'.format(locale)
+        # Outputs also depend on the options
+        digest = '{}:js={:d}:fuzzy={:d}'.format(
+            _hash_files(_po_path(locale)),
+            js,
+            use_fuzzy
+        )
+
+        outputs = [_mo_path(locale)] + ([_js_path(locale)] if js else [])
+
+        if (not force and state.get(key) == digest and
+                all(os.path.isfile(p) for p in outputs)):
+            continue
+
+        pending[locale] = digest
+
+    results = {}
+
+    if not pending:
+        return results
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        futures = [
+            executor.submit(_compile_locale, locale, js, use_fuzzy)
+            for locale in pending
+        ]
+
+        for future in concurrent.futures.as_completed(futures):
+            locale, compiled, errors = future.result()
+            results[locale] = errors
+
+            if compiled:
+                state['compile:{}'.format(locale)] = pending[locale]
+
+    _save_state(state)
+
+    return results
@@ -0,0 +1,654 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the in-process metrics registry."""
+
+import atexit
+import contextlib
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from flask import Response, g, request
+from flask.signals import before_render_template, template_rendered
+
+from flask_app_template.util import TimedQueuePool, skip_session
+
+
+# Default buckets of histograms (seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Buckets used for number of queries
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+
+# Buckets used for database connection waits (seconds)
+POOL_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10)
+
+# Files of the multiprocess directory: `<pid>-<random suffix>.json` for each
+# process and a single file with the metrics of processes that exited
+_PROCESS_FILE = re.compile(r'^(\d+)-[0-9a-f]+\.json(\.tmp)?$')
+_ARCHIVE_FILE = 'archive.json'
+
+
+class _Metric(object):
+    """Base class for metrics.
+
+    Args:
+        registry: Registry the metric belongs to.
+        name (str): Name of the metric.
+        documentation (str): Description of the metric.
+        labelnames (tuple): Names of the labels of the metric.
+    """
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self._lock = registry._lock
+        self._values = {}
+
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(l, '')) for l in self.labelnames)
+
+    def snapshot(self):
+        """Obtain the current values of the metric.
+
+        Returns:
+            Dictionary describing the metric and its samples.
+        """
+        with self._lock:
+            samples = [
+                [list(key), self._copy(value)]
+                for key, value in self._values.items()
+            ]
+
+        return {
+            'type': self.type,
+            'help': self.documentation,
+            'labelnames': list(self.labelnames),
+            'samples': samples,
+        }
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(_Metric):
+    """Monotonically increasing value."""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter."""
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        """Increase the gauge."""
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Decrease the gauge."""
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        """Set the value of the gauge."""
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values.
+
+    Args:
+        buckets (tuple): Upper bounds of the buckets, in ascending order.
+    """
+    type = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(
+            registry,
+            name,
+            documentation,
+            labelnames
+        )
+
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Record a new value."""
+        key = self._key(labels)
+
+        with self._lock:
+            entry = self._values.get(key)
+
+            if entry is None:
+                # [bucket counts (last one is +Inf), sum, count]
+                entry = self._values[key] = [
+                    [0] * (len(self.buckets) + 1), 0, 0
+                ]
+
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][idx] += 1
+                    break
+
+            else:
+                entry[0][-1] += 1
+
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the time spent in a block (in seconds)."""
+        start = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        snapshot = super(Histogram, self).snapshot()
+        snapshot['buckets'] = list(self.buckets)
+
+        return snapshot
+
+    def _copy(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+
+class Metrics(object):
+    """In-process metrics registry with Prometheus text exposition.
+
+    Records request latency and in-flight requests per endpoint, as well as
+    the time spent hashing passwords, sending emails, rendering templates,
+    waiting for database connections and querying the database (the latter
+    requires `USE_QUERY_TRACKING`).
+    Metrics are exposed in a route that does not require login nor loads
+    the session.
+
+    This is optional and can be enabled by setting the configuration
+    parameter `USE_METRICS` to `True`.
+
+    If used, the registry expects the following configuration parameters:
+
+    - `METRICS_PATH`: Path of the metrics route (defaults to `/metrics`).
+    - `METRICS_TOKEN`: If set, the route requires an
+        `Authorization: Bearer <token>` header.
+    - `METRICS_MULTIPROCESS_DIR`: Directory in which each process stores its
+        metrics, so that they are aggregated among all the workers of the
+        server. Counters and histograms of processes that exited are merged
+        into a single file, and their gauges are dropped. The directory
+        should be emptied when the server starts.
+    - `METRICS_FLUSH_INTERVAL`: Seconds between writes of the metrics of a
+        process to the directory (defaults to 5).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._directory = None
+        self._pid = None
+        self._path = None
+        self._path_pid = None
+
+        self.request_duration = self.histogram(
+            'http_request_duration_seconds',
+            'Request latency',
+            ('endpoint', 'method', 'status')
+        )
+        self.requests_in_flight = self.gauge(
+            'http_requests_in_flight',
+            'Requests being processed',
+            ('endpoint',)
+        )
+        self.crypto_duration = self.histogram(
+            'crypto_duration_seconds',
+            'Time spent hashing and verifying passwords',
+            ('operation',),
+            buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8)
+        )
+        self.mail_duration = self.histogram(
+            'mail_send_duration_seconds',
+            'Time spent sending (or enqueuing) emails'
+        )
+        self.template_duration = self.histogram(
+            'template_render_duration_seconds',
+            'Time spent rendering templates',
+            ('template',)
+        )
+        self.db_duration = self.histogram(
+            'db_request_duration_seconds',
+            'Time spent in database queries per request',
+            ('endpoint',)
+        )
+        self.db_queries = self.histogram(
+            'db_request_queries',
+            'Database queries per request',
+            ('endpoint',),
+            buckets=QUERY_BUCKETS
+        )
+        self.db_pool_wait = self.histogram(
+            'db_pool_wait_seconds',
+            'Time spent waiting for database connections',
+            buckets=POOL_BUCKETS
+        )
+        self.db_pool_timeouts = self.counter(
+            'db_pool_timeouts_total',
+            'Database connection checkouts that timed out'
+        )
+        self.db_pool_timeouts.inc(0)
+
+    def counter(self, name, documentation, labelnames=()):
+        """Obtain (or create) a counter."""
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Obtain (or create) a gauge."""
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        """Obtain (or create) a histogram."""
+        return self._register(
+            Histogram,
+            name,
+            documentation,
+            labelnames,
+            buckets=buckets
+        )
+
+    def init_app(self, app):
+        """Register the request hooks and the metrics route.
+
+        Args:
+            app: Application instance.
+        """
+        if not app.config.get('USE_METRICS', False):
+            return
+
+        self._directory = app.config.get('METRICS_MULTIPROCESS_DIR')
+        self._interval = app.config.get('METRICS_FLUSH_INTERVAL', 5)
+        self._token = app.config.get('METRICS_TOKEN')
+
+        if self._directory:
+            os.makedirs(self._directory, exist_ok=True)
+
+        path = app.config.get('METRICS_PATH', '/metrics')
+        app.add_url_rule(path, 'metrics', self._view)
+
+        # The route does not need the session
+        skip_session(app, path=path)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+        before_render_template.connect(self._before_render, app, weak=False)
+        template_rendered.connect(self._after_render, app, weak=False)
+
+        if self._pool_checkout not in TimedQueuePool.stats.listeners:
+            TimedQueuePool.stats.listeners.append(self._pool_checkout)
+
+    def collect(self):
+        """Obtain the metrics of all processes.
+
+        Returns:
+            Dictionary with the snapshot of each metric.
+        """
+        snapshot = self._snapshot()
+
+        if not self._directory:
+            return snapshot
+
+        self._write(snapshot)
+
+        merged = {}
+
+        # Collectors in other processes may be archiving files
+        with _locked(os.path.join(self._directory, '.lock')):
+            for name in os.listdir(self._directory):
+                match = _PROCESS_FILE.match(name)
+
+                if match is None:
+                    continue
+
+                path = os.path.join(self._directory, name)
+
+                if not _pid_alive(int(match.group(1))):
+                    self._archive(path)
+                    continue
+
+                if match.group(2):
+                    continue
+
+                data = _load(path)
+
+                if data is not None:
+                    _merge(merged, data)
+
+            data = _load(os.path.join(self._directory, _ARCHIVE_FILE))
+
+            if data is not None:
+                _merge(merged, data)
+
+        return merged
+
+    def expose(self):
+        """Obtain the metrics in Prometheus text format.
+
+        Returns:
+            Text exposition of all the metrics.
+        """
+        lines = []
+
+        for name, metric in sorted(self.collect().items()):
+            lines.append('# HELP {} {}'.format(name, metric['help']))
+            lines.append('# TYPE {} {}'.format(name, metric['type']))
+
+            labelnames = metric['labelnames']
+
+            for labelvalues, value in metric['samples']:
+                labels = list(zip(labelnames, labelvalues))
+
+                if metric['type'] != 'histogram':
+                    lines.append('{}{} {}'.format(
+                        name,
+                        _format_labels(labels),
+                        value
+                    ))
+                    continue
+
+                counts, total, count = value
+                cumulative = 0
+                bounds = metric['buckets'] + ['+Inf']
+
+                for bound, bucket_count in zip(bounds, counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{} {}'.format(
+                        name,
+                        _format_labels(labels + [('le', bound)]),
+                        cumulative
+                    ))
+
+                lines.append('{}_sum{} {}'.format(
+                    name,
+                    _format_labels(labels),
+                    total
+                ))
+                lines.append('{}_count{} {}'.format(
+                    name,
+                    _format_labels(labels),
+                    count
+                ))
+
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(
+                    self,
+                    name,
+                    documentation,
+                    labelnames,
+                    **kwargs
+                )
+
+            return self._metrics[name]
+
+    def _snapshot(self):
+        return {
+            name: metric.snapshot()
+            for name, metric in list(self._metrics.items())
+        }
+
+    def _write(self, snapshot=None):
+        """Store the metrics of this process in the directory."""
+        if snapshot is None:
+            snapshot = self._snapshot()
+
+        pid = os.getpid()
+
+        # The suffix tells processes apart even if a PID is reused
+        if self._path_pid != pid:
+            self._path = os.path.join(
+                self._directory,
+                '{}-{}.json'.format(pid, uuid.uuid4().hex[:8])
+            )
+            self._path_pid = pid
+
+        _dump(self._path, snapshot)
+
+    def _archive(self, path):
+        """Merge the file of a process that exited into the archive."""
+        if not path.endswith('.tmp'):
+            data = _load(path)
+
+            if data is not None:
+                archive_path = os.path.join(self._directory, _ARCHIVE_FILE)
+                archived = _load(archive_path) or {}
+
+                # Gauges of dead processes are no longer valid
+                _merge(archived, data, gauges=False)
+                _dump(archive_path, archived)
+
+        try:
+            os.remove(path)
+
+        except OSError:
+            pass
+
+    def _start(self):
+        """Start writing metrics of this process periodically."""
+        pid = os.getpid()
+
+        if not self._directory or self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            thread = threading.Thread(target=self._flush_loop, daemon=True)
+            thread.start()
+
+            atexit.register(self._write)
+
+            self._pid = pid
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self._interval)
+
+            try:
+                self._write()
+
+            except OSError:
+                pass
+
+    def _view(self):
+        """Metrics route."""
+        if self._token:
+            expected = 'Bearer {}'.format(self._token)
+
+            if request.headers.get('Authorization') != expected:
+                return Response('', 403)
+
+        return Response(
+            self.expose(),
+            mimetype='text/plain; version=0.0.4; charset=utf-8'
+        )
+
+    def _before_request(self):
+        self._start()
+
+        g._metrics_start = time.perf_counter()
+        g._metrics_endpoint = request.endpoint or 'none'
+        self.requests_in_flight.inc(endpoint=g._metrics_endpoint)
+
+    def _after_request(self, response):
+        start = g.get('_metrics_start')
+
+        if start is None:
+            return response
+
+        endpoint = g._metrics_endpoint
+
+        self.request_duration.observe(
+            time.perf_counter() - start,
+            endpoint=endpoint,
+            method=request.method,
+            status=response.status_code
+        )
+
+        from flask_app_template import query_tracker
+
+        queries = query_tracker.stats()
+
+        if queries is not None:
+            self.db_duration.observe(queries.duration, endpoint=endpoint)
+            self.db_queries.observe(queries.count, endpoint=endpoint)
+
+        return response
+
+    def _teardown_request(self, exc=None):
+        endpoint = g.pop('_metrics_endpoint', None)
+
+        if endpoint is not None:
+            self.requests_in_flight.dec(endpoint=endpoint)
+
+    def _pool_checkout(self, wait, timeout):
+        """Record a checkout of the database pool."""
+        self.db_pool_wait.observe(wait)
+
+        if timeout:
+            self.db_pool_timeouts.inc()
+
+    def _before_render(self, sender, template, context, **extra):
+        g.setdefault('_metrics_templates', []).append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra):
+        starts = g.get('_metrics_templates')
+
+        if starts:
+            self.template_duration.observe(
+                time.perf_counter() - starts.pop(),
+                template=template.name
+            )
+
+
+def _merge(merged, snapshot, gauges=True):
+    """Add the samples of a snapshot to the merged metrics."""
+    for name, metric in snapshot.items():
+        if metric['type'] == 'gauge' and not gauges:
+            continue
+
+        target = merged.setdefault(name, dict(metric, samples=[]))
+        samples = {tuple(labels): value for labels, value in target['samples']}
+
+        for labels, value in metric['samples']:
+            key = tuple(labels)
+            current = samples.get(key)
+
+            if current is None:
+                samples[key] = value
+
+            elif metric['type'] == 'histogram':
+                samples[key] = [
+                    [a + b for a, b in zip(current[0], value[0])],
+                    current[1] + value[1],
+                    current[2] + value[2]
+                ]
+
+            else:
+                samples[key] = current + value
+
+        target['samples'] = [
+            [list(labels), value] for labels, value in samples.items()
+        ]
+
+
+def _load(path):
+    """Read a metrics file, if it exists and is valid."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+        return None
+
+
+def _dump(path, data):
+    """Replace a metrics file atomically."""
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """Hold an exclusive lock on a file."""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        try:
+            yield
+
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _pid_alive(pid):
+    """Check whether a process is running."""
+    if pid == os.getpid():
+        return True
+
+    try:
+        os.kill(pid, 0)
+
+    except ProcessLookupError:
+        return False
+
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _format_labels(labels):
+    """Format labels for the text exposition."""
+    if not labels:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+        for name, value in labels
+    ) + '}'
@@ -2,10 +2,13 @@
 
 """This file contains SQLAlchemy model declarations."""
 
+import datetime
+
 from flask_login import UserMixin
+from sqlalchemy import or_
 from sqlalchemy.ext.associationproxy import association_proxy
 
-from flask_app_template import db, hashids_hasher
+from flask_app_template import db, hashids_hasher, search
 
 
 # Intermediate user-role table
@@ -24,6 +27,19 @@ user_roles = db.Table(
 )
 
 
+# Progress of data migrations (see `backfill.py`)
+backfill_checkpoints = db.Table(
+    'backfill_checkpoints',
+    db.Column('name', db.String(100), primary_key=True),
+    db.Column('range_start', db.BigInteger, primary_key=True),
+    db.Column('range_end', db.BigInteger, nullable=False),
+    db.Column('position', db.BigInteger, nullable=False),
+    db.Column('affected_rows', db.BigInteger, nullable=False, default=0),
+    db.Column('finished', db.Boolean, nullable=False, default=False),
+    db.Column('updated_at', db.DateTime(), nullable=False)
+)
+
+
 class BaseModel(db.Model):
     """Base class used to implement common methods."""
     __abstract__ = True
@@ -33,6 +49,20 @@ class BaseModel(db.Model):
         """Obtain the HashId token on the fly."""
         return hashids_hasher.encode(self.id)
 
+    @classmethod
+    def cache_key(cls, id):
+        """Obtain the cache key of an instance (see `cache.py`)."""
+        return '{}:{}'.format(cls.__tablename__, id)
+
+    def cache_tags(self):
+        """Obtain the cache tags evicted when the instance changes.
+
+        Returns:
+            List with the key of the instance and the name of the table, so
+            that entries derived from several rows may be tagged with it.
+        """
+        return [self.cache_key(self.id), self.__tablename__]
+
     @classmethod
     def exists(cls, id):
         """Check whether an instance exists.
@@ -111,6 +141,8 @@ class User(BaseModel, UserMixin):
         is_active (bool): Whether the user is active in the application.
         locale (str): Locale code.
         timezone (str): Timezone used to localize dates.
+        last_seen_at (datetime): Last time the user was seen (UTC, see
+            `activity.py`). It may lag behind by `ACTIVITY_INTERVAL`.
         roles (set(Role)): Roles assigned to the user.
     """
     __tablename__ = 'users'
@@ -131,6 +163,9 @@ class User(BaseModel, UserMixin):
     locale = db.Column(db.String(12), nullable=False, default='en')
     timezone = db.Column(db.String(50), nullable=False, default='UTC')
 
+    # Activity information
+    last_seen_at = db.Column(db.DateTime(), nullable=True, index=True)
+
     # Relationships
     roles = db.relationship(
         'Role', secondary='user_roles',
@@ -155,4 +190,92 @@ class User(BaseModel, UserMixin):
         Returns:
             User instance or `None` if not found.
         """
-        return User.query.filter_by(username=username).first()
\ No newline at end of file
+        return User.query.filter_by(username=username).first()
+
+    @classmethod
+    def search(cls, q, limit=20, cursor=None):
+        """Search users by username or email (see `search.py`).
+
+        Args:
+            q (str): Text to search.
+            limit (int): Maximum number of results.
+            cursor (str): Cursor returned by a previous search, to obtain
+                the next page.
+
+        Returns:
+            Tuple with the list of users, ranked by relevance, and the
+            cursor of the next page (`None` if there are no more results).
+        """
+        ids, next_cursor = search.search_users(
+            db.session.connection(),
+            q,
+            limit=limit,
+            cursor=cursor
+        )
+
+        users = {u.id: u for u in cls.query.filter(cls.id.in_(ids))}
+
+        return [users[i] for i in ids if i in users], next_cursor
+
+    @classmethod
+    def seen_since(cls, since):
+        """Query the users seen since a given time.
+
+        Args:
+            since: `datetime` (UTC) or `timedelta` before the current time.
+
+        Returns:
+            Query of users, most recently seen first.
+        """
+        if isinstance(since, datetime.timedelta):
+            since = datetime.datetime.utcnow() - since
+
+        return (
+            cls.query
+            .filter(cls.last_seen_at >= since)
+            .order_by(cls.last_seen_at.desc())
+        )
+
+    @classmethod
+    def not_seen_since(cls, since):
+        """Query the users not seen since a given time (or never seen).
+
+        Args:
+            since: `datetime` (UTC) or `timedelta` before the current time.
+
+        Returns:
+            Query of users, least recently seen first.
+        """
+        if isinstance(since, datetime.timedelta):
+            since = datetime.datetime.utcnow() - since
+
+        return (
+            cls.query
+            .filter(
+                or_(cls.last_seen_at.is_(None), cls.last_seen_at < since)
+            )
+            .order_by(cls.last_seen_at.asc())
+        )
+
+
+class AuthEvent(BaseModel):
+    """Authentication event (see `audit.py`).
+
+    Attributes:
+        event (str): Name of the event (e.g. `'login_failure'`).
+        user_id (int): ID of the user, if known.
+        identity (str): Identity provided by the client.
+        ip (str): IP address of the client.
+        user_agent (str): User agent of the client.
+        created_at (datetime): Time of the event (UTC).
+    """
+    __tablename__ = 'auth_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    event = db.Column(db.String(32), nullable=False)
+    user_id = db.Column(db.Integer, nullable=True, index=True)
+    identity = db.Column(db.String(255), nullable=True)
+    ip = db.Column(db.String(45), nullable=True)
+    user_agent = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime(), nullable=False, index=True)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the user search index.
+
+Users are searched by substrings of their username or email:
+
+- SQLite: an FTS5 table with the trigram tokenizer (SQLite 3.34 or newer),
+  kept in sync with `users` by triggers.
+- PostgreSQL: trigram (`pg_trgm`) GIN indexes on `users`.
+- Other databases, or if the index was not created: a scan with `LIKE`.
+
+The index is optional and created with `flask_app_template user reindex`.
+
+Exact and prefix matches of the username always rank first. Terms shorter
+than 3 characters cannot use trigrams, so queries with only short terms match
+username prefixes instead (using the unique index of the username).
+"""
+
+import base64
+import json
+import threading
+
+from flask import current_app
+from sqlalchemy import text
+
+
+MIN_TERM_LENGTH = 3
+
+# Minimum SQLite version with the trigram tokenizer
+MIN_SQLITE_VERSION = (3, 34, 0)
+
+# Engines known to have the index (see `has_index()`)
+_indexed = set()
+_indexed_lock = threading.Lock()
+
+
+# SQLite
+_SQLITE_INDEX = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_search USING fts5(
+        username, email,
+        content='users', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON users
+    BEGIN
+        INSERT INTO users_search (rowid, username, email)
+        VALUES (new.id, new.username, new.email);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users
+    BEGIN
+        INSERT INTO users_search (users_search, rowid, username, email)
+        VALUES ('delete', old.id, old.username, old.email);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_search_update
+    AFTER UPDATE OF username, email ON users
+    BEGIN
+        INSERT INTO users_search (users_search, rowid, username, email)
+        VALUES ('delete', old.id, old.username, old.email);
+        INSERT INTO users_search (rowid, username, email)
+        VALUES (new.id, new.username, new.email);
+    END
+    """,
+]
+
+_SQLITE_EXISTS = """
+    SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_search'
+"""
+
+# Exact and prefix username matches are found through the unique index of
+# the username, and rank before any other match (the shorter, the better)
+_USERNAME_MATCHES = """
+    SELECT id, CASE
+        WHEN username = :query THEN -2000000.0
+        ELSE -1000000.0 + length(username)
+    END AS score
+    FROM users
+    WHERE username >= :query AND username < :upper
+    ORDER BY username
+    LIMIT :candidates
+"""
+
+# Username matches weigh twice as much as email matches
+_SQLITE_SEARCH = """
+    SELECT id, score FROM (
+        SELECT id, min(score) AS score FROM (
+            SELECT * FROM (
+                SELECT rowid AS id, bm25(users_search, 2.0, 1.0) AS score
+                FROM users_search
+                WHERE users_search MATCH :match
+                ORDER BY score
+                LIMIT :candidates
+            )
+            UNION ALL
+            SELECT * FROM ({})
+        )
+        GROUP BY id
+    )
+    WHERE :after_id IS NULL OR score > :after_score OR
+        (score = :after_score AND id > :after_id)
+    ORDER BY score, id
+    LIMIT :limit
+""".format(_USERNAME_MATCHES)
+
+
+# PostgreSQL
+_POSTGRESQL_INDEX = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    """
+    CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+    ON users USING gin (username gin_trgm_ops)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_users_email_trgm
+    ON users USING gin (email gin_trgm_ops)
+    """,
+]
+
+_POSTGRESQL_EXISTS = """
+    SELECT 1 FROM pg_indexes
+    WHERE tablename = 'users' AND indexname = 'ix_users_username_trgm'
+"""
+
+# Similarity is negated so that lower scores are better in all databases
+_POSTGRESQL_SEARCH = """
+    SELECT id, score FROM (
+        SELECT id, min(score) AS score FROM (
+            (
+                SELECT id, -greatest(
+                    similarity(username, :query),
+                    similarity(email, :query)
+                ) AS score
+                FROM users
+                WHERE username ILIKE :like ESCAPE '\\' OR
+                    email ILIKE :like ESCAPE '\\' OR
+                    username % :query OR email % :query
+                ORDER BY score
+                LIMIT :candidates
+            )
+            UNION ALL
+            ({})
+        ) AS matches
+        GROUP BY id
+    ) AS candidates
+    WHERE CAST(:after_id AS integer) IS NULL OR
+        score > :after_score OR (score = :after_score AND id > :after_id)
+    ORDER BY score, id
+    LIMIT :limit
+""".format(_USERNAME_MATCHES)
+
+
+# Databases without index and short queries
+_LIKE_SEARCH = """
+    SELECT id, 0 AS score FROM users
+    WHERE (username LIKE :like ESCAPE '\\' OR
+            email LIKE :like ESCAPE '\\') AND
+        (:after_id IS NULL OR id > :after_id)
+    ORDER BY id
+    LIMIT :limit
+"""
+
+_PREFIX_SEARCH = """
+    SELECT id, username AS score FROM users
+    WHERE username >= :query AND username < :upper AND
+        (:after_id IS NULL OR username > :after_score OR
+            (username = :after_score AND id > :after_id))
+    ORDER BY username, id
+    LIMIT :limit
+"""
+
+
+def create_index(connection):
+    """Create the search index if it does not exist.
+
+    In SQLite, the index is also filled with the existing users.
+
+    Args:
+        connection: Database connection.
+
+    Raises:
+        `RuntimeError` if the database does not support the index.
+    """
+    dialect = connection.dialect.name
+
+    if dialect == 'sqlite':
+        version = connection.dialect.dbapi.sqlite_version_info
+
+        if version < MIN_SQLITE_VERSION:
+            raise RuntimeError(
+                'The search index requires SQLite {} or newer'.format(
+                    '.'.join(str(v) for v in MIN_SQLITE_VERSION)
+                )
+            )
+
+        for statement in _SQLITE_INDEX:
+            connection.execute(text(statement))
+
+        connection.execute(text(
+            "INSERT INTO users_search (users_search) VALUES ('rebuild')"
+        ))
+
+    elif dialect == 'postgresql':
+        for statement in _POSTGRESQL_INDEX:
+            connection.execute(text(statement))
+
+    else:
+        raise RuntimeError(
+            'The search index is not supported in {}'.format(dialect)
+        )
+
+
+def has_index(connection):
+    """Check whether the search index exists.
+
+    Only positive results are remembered, so an index created later is used
+    without restarting the application.
+
+    Args:
+        connection: Database connection.
+    """
+    key = str(connection.engine.url)
+
+    if key in _indexed:
+        return True
+
+    dialect = connection.dialect.name
+
+    if dialect == 'sqlite':
+        statement = _SQLITE_EXISTS
+
+    elif dialect == 'postgresql':
+        statement = _POSTGRESQL_EXISTS
+
+    else:
+        return False
+
+    if connection.execute(text(statement)).first() is None:
+        return False
+
+    with _indexed_lock:
+        _indexed.add(key)
+
+    return True
+
+
+def search_users(connection, query, limit=20, cursor=None):
+    """Search users by username or email.
+
+    Results are ranked by relevance. Only the best `SEARCH_MAX_CANDIDATES`
+    matches (defaults to 1000) and the usernames starting with the query are
+    returned, so queries matching most users (e.g. a common email domain)
+    remain fast. Without index, all the matches are returned by ID.
+
+    Args:
+        connection: Database connection.
+        query (str): Text to search.
+        limit (int): Maximum number of results.
+        cursor (str): Cursor returned by a previous search, to obtain the
+            next page.
+
+    Returns:
+        Tuple with the list of matching user IDs and the cursor of the next
+        page (`None` if there are no more results).
+    """
+    terms = [t for t in query.split() if len(t) >= MIN_TERM_LENGTH]
+    after_score, after_id = _decode_cursor(cursor)
+    dialect = connection.dialect.name
+
+    params = {
+        'query': query.strip(),
+        'limit': limit + 1,
+        'candidates': current_app.config.get('SEARCH_MAX_CANDIDATES', 1000),
+        'after_score': after_score,
+        'after_id': after_id,
+    }
+
+    params['upper'] = params['query'] + '\uffff'
+    params['like'] = '%{}%'.format(_escape_like(params['query']))
+
+    if not terms:
+        statement = _PREFIX_SEARCH
+
+    elif not has_index(connection):
+        statement = _LIKE_SEARCH
+
+    elif dialect == 'sqlite':
+        statement = _SQLITE_SEARCH
+        params['match'] = ' '.join(
+            '"{}"'.format(t.replace('"', '""')) for t in terms
+        )
+
+    else:
+        statement = _POSTGRESQL_SEARCH
+
+    rows = connection.execute(text(statement), params).fetchall()
+
+    next_cursor = None
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].score, rows[-1].id)
+
+    return [row.id for row in rows], next_cursor
+
+
+def _escape_like(value):
+    return (
+        value
+        .replace('\\', '\\\\')
+        .replace('%', '\\%')
+        .replace('_', '\\_')
+    )
+
+
+def _encode_cursor(score, id):
+    data = json.dumps([score, id]).encode('utf-8')
+
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    """Obtain the score and ID of the last result of the previous page."""
+    if not cursor:
+        return None, None
+
+    try:
+        score, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+    except (TypeError, ValueError):
+        raise ValueError('Invalid search cursor')
+
+    return score, id
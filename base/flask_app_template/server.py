@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the production server (based on gunicorn).
+
+The application is loaded once in the master process and shared with the
+forked workers. Objects created while loading are moved to the permanent
+generation of the garbage collector, so that collections in the workers do
+not touch (and copy) their memory pages.
+"""
+
+import gc
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+from webassets.exceptions import BundleError
+
+from flask_app_template import assets, db
+
+
+def worker_count(app):
+    """Number of worker processes.
+
+    Defaults to `2 * CPUs + 1` unless set in `SERVE_WORKERS`.
+    """
+    return (
+        app.config.get('SERVE_WORKERS') or
+        multiprocessing.cpu_count() * 2 + 1
+    )
+
+
+def thread_count(app):
+    """Number of threads per worker.
+
+    Defaults to 4 unless set in `SERVE_THREADS`, but never more than the
+    connections the database pool can provide.
+    """
+    threads = app.config.get('SERVE_THREADS') or 4
+    options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+
+    if 'pool_size' in options:
+        threads = min(
+            threads,
+            options['pool_size'] + options.get('max_overflow', 0)
+        )
+
+    return max(threads, 1)
+
+
+def dispose_engines(app):
+    """Close the connections of all the database engines.
+
+    Engines (and their pools) are recreated on first use, so that connections
+    are never shared between processes.
+    """
+    state = app.extensions['sqlalchemy']
+
+    for bind in list(state.connectors):
+        db.get_engine(app, bind).dispose()
+
+
+def preload(app):
+    """Prepare the application before forking the workers.
+
+    Builds the asset bundles and compiles all the templates once, closes any
+    database connection and freezes the objects created so far.
+
+    Args:
+        app: Application instance.
+    """
+    with app.app_context():
+        if app.config.get('SERVE_BUILD_ASSETS', True):
+            for bundle in assets:
+                try:
+                    bundle.build()
+
+                except BundleError as e:
+                    app.logger.warning('Failed to build bundle: %s', e)
+
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+
+    dispose_engines(app)
+
+    gc.collect()
+    gc.freeze()
+
+
+class Server(BaseApplication):
+    """Gunicorn application serving a preloaded Flask application.
+
+    The server expects the following configuration parameters:
+
+    - `SERVE_BIND`: Address to listen on (defaults to `'127.0.0.1:8000'`).
+    - `SERVE_WORKERS`: Number of worker processes (see `worker_count()`).
+    - `SERVE_THREADS`: Number of threads per worker (see `thread_count()`).
+    - `SERVE_TIMEOUT`: Seconds after which a silent worker is restarted
+        (defaults to 30).
+    - `SERVE_GRACEFUL_TIMEOUT`: Seconds workers have to finish in-flight
+        requests when restarting or stopping (defaults to 30).
+    - `SERVE_KEEPALIVE`: Seconds to wait for requests on a keep-alive
+        connection (defaults to 5).
+    - `SERVE_MAX_REQUESTS`: Requests after which a worker is gracefully
+        restarted, `0` to disable (defaults to 0).
+    - `SERVE_BUILD_ASSETS`: Build asset bundles before forking (defaults to
+        `True`).
+
+    Args:
+        app: Application instance.
+        options (dict): Gunicorn settings that override the configuration.
+    """
+
+    def __init__(self, app, **options):
+        self.application = app
+        self.options = self._default_options(app)
+        self.options.update(
+            {k: v for k, v in options.items() if v is not None}
+        )
+
+        if self.options['threads'] > 1:
+            self.options.setdefault('worker_class', 'gthread')
+
+        super(Server, self).__init__()
+
+    def _default_options(self, app):
+        config = app.config
+        max_requests = config.get('SERVE_MAX_REQUESTS', 0)
+
+        return {
+            'bind': config.get('SERVE_BIND', '127.0.0.1:8000'),
+            'workers': worker_count(app),
+            'threads': thread_count(app),
+            'timeout': config.get('SERVE_TIMEOUT', 30),
+            'graceful_timeout': config.get('SERVE_GRACEFUL_TIMEOUT', 30),
+            'keepalive': config.get('SERVE_KEEPALIVE', 5),
+            'max_requests': max_requests,
+            'max_requests_jitter': max_requests // 10,
+            'preload_app': True,
+            'pre_fork': self._pre_fork,
+            'post_fork': self._post_fork,
+        }
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+    def _pre_fork(self, server, worker):
+        # Include objects created since the application was loaded
+        gc.freeze()
+
+    def _post_fork(self, server, worker):
+        dispose_engines(self.application)
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains the server-side session interface and its stores."""
+
+import collections
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session whose data is only fetched from the store when accessed.
+
+    Args:
+        sid (str): Session identifier received in the cookie, if any.
+        loader: Callable returning the data of the session (or `None`).
+    """
+
+    def __init__(self, sid=None, loader=None):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, on_update=on_update)
+
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.expires = None
+
+        # Nothing to fetch for new sessions
+        self.loaded = sid is None
+        self._loader = loader
+
+    #: Keys that are set and removed within the same request, so they are
+    #: never stored (e.g. `remember`, checked by Flask-Login after every
+    #: request). Looking them up does not fetch the session.
+    transient_keys = frozenset(['remember'])
+
+    def _load(self):
+        if self.loaded:
+            return
+
+        self.loaded = True
+        stored = self._loader(self.sid)
+
+        if stored is None:
+            # Unknown or expired identifier, never reuse it
+            self.sid = None
+            self.new = True
+            return
+
+        data, self.expires = stored
+        dict.update(self, data)
+
+    def regenerate(self):
+        """Assign a new identifier to the session, keeping its data.
+
+        The previous identifier is removed from the store when the session
+        is saved.
+        """
+        self._load()
+
+        self.previous_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+    def __contains__(self, key):
+        # Any write loads the session first, so an unloaded session holds
+        # none of these keys
+        if not self.loaded and key in self.transient_keys:
+            return False
+
+        self._load()
+
+        return CallbackDict.__contains__(self, key)
+
+
+def _load_first(name):
+    method = getattr(CallbackDict, name)
+
+    def wrapper(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+
+    return wrapper
+
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__iter__',
+              '__len__', '__repr__', 'get', 'keys', 'values', 'items', 'copy',
+              'pop', 'popitem', 'setdefault', 'update', 'clear'):
+    setattr(ServerSession, _name, _load_first(_name))
+
+
+class MemorySessionStore(object):
+    """In-process LRU store.
+
+    Sessions are not shared between processes, so this store is meant for
+    development or single process deployments.
+
+    Args:
+        size (int): Maximum number of sessions kept.
+    """
+
+    def __init__(self, size=10000):
+        self._size = size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            stored = self._data.get(sid)
+
+            if stored is None:
+                return None
+
+            if stored[1] < time.time():
+                del self._data[sid]
+                return None
+
+            self._data.move_to_end(sid)
+
+            return stored
+
+    def set(self, sid, value, ttl):
+        with self._lock:
+            self._data[sid] = (value, time.time() + ttl)
+            self._data.move_to_end(sid)
+
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+
+class SQLiteSessionStore(object):
+    """Store backed by a SQLite database shared by all processes.
+
+    Each thread uses its own connection. Expired sessions are purged from
+    time to time when sessions are written.
+
+    Args:
+        path (str): Path of the database.
+    """
+
+    # Probability of purging expired sessions on each write
+    PURGE_PROBABILITY = 0.01
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            'id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)'
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        # Connections are not shared with forked processes
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self._path,
+                timeout=5,
+                isolation_level=None
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    def get(self, sid):
+        row = self._connection().execute(
+            'SELECT data, expires FROM sessions WHERE id = ? AND expires > ?',
+            (sid, time.time())
+        ).fetchone()
+
+        return tuple(row) if row else None
+
+    def set(self, sid, value, ttl):
+        connection = self._connection()
+        now = time.time()
+
+        connection.execute(
+            'INSERT OR REPLACE INTO sessions (id, data, expires) '
+            'VALUES (?, ?, ?)',
+            (sid, value, now + ttl)
+        )
+
+        if random.random() < self.PURGE_PROBABILITY:
+            connection.execute(
+                'DELETE FROM sessions WHERE expires <= ?',
+                (now,)
+            )
+
+    def delete(self, sid):
+        self._connection().execute(
+            'DELETE FROM sessions WHERE id = ?',
+            (sid,)
+        )
+
+
+class RedisSessionStore(object):
+    """Store backed by a Redis (or Redis protocol compatible) server.
+
+    Expiration is handled by the server.
+
+    Args:
+        url (str): URL of the server.
+        prefix (str): Prefix of the keys.
+    """
+
+    def __init__(self, url, prefix='session:'):
+        import redis
+
+        self._client = redis.StrictRedis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, sid):
+        pipe = self._client.pipeline(transaction=False)
+        pipe.get(self._prefix + sid)
+        pipe.ttl(self._prefix + sid)
+        value, ttl = pipe.execute()
+
+        if value is None:
+            return None
+
+        return value.decode('utf-8'), time.time() + max(ttl, 0)
+
+    def set(self, sid, value, ttl):
+        self._client.setex(self._prefix + sid, int(ttl), value)
+
+    def delete(self, sid):
+        self._client.delete(self._prefix + sid)
+
+
+class ServerSessionInterface(SessionInterface):
+    """Session interface that stores session data on the server.
+
+    This is optional and can be enabled by setting the configuration
+    parameter `USE_SERVER_SESSION` to `True`. The cookie only contains a
+    random identifier. Data is fetched from the store the first time the
+    session is accessed during a request and written back only when it was
+    modified (or when more than half of its lifetime has passed, so that
+    active sessions do not expire). The identifier is regenerated when a
+    user logs in.
+
+    Sessions expire after `PERMANENT_SESSION_LIFETIME` in the store, even if
+    they are not permanent.
+
+    If used, the interface expects the following configuration parameters:
+
+    - `SESSION_BACKEND`: One of `'memory'`, `'sqlite'` or `'redis'`
+        (defaults to `'memory'`).
+    - `SESSION_MEMORY_SIZE`: Maximum number of sessions in the memory store
+        (defaults to 10000).
+    - `SESSION_SQLITE_PATH`: Path of the SQLite store (defaults to
+        `sessions.sqlite` in the instance path).
+    - `SESSION_REDIS_URL`: URL of the Redis store (defaults to
+        `'redis://localhost:6379/0'`).
+    - `SESSION_KEY_PREFIX`: Prefix of the keys in the Redis store (defaults
+        to `'session:'`).
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self):
+        self.store = None
+
+    def init_app(self, app):
+        """Initialize the store and set the interface of the app.
+
+        Args:
+            app: Application instance.
+        """
+        if not app.config.get('USE_SERVER_SESSION', False):
+            return
+
+        backend = app.config.get('SESSION_BACKEND', 'memory')
+
+        if backend == 'memory':
+            self.store = MemorySessionStore(
+                app.config.get('SESSION_MEMORY_SIZE', 10000)
+            )
+
+        elif backend == 'sqlite':
+            path = app.config.get('SESSION_SQLITE_PATH')
+
+            if not path:
+                os.makedirs(app.instance_path, exist_ok=True)
+                path = os.path.join(app.instance_path, 'sessions.sqlite')
+
+            self.store = SQLiteSessionStore(path)
+
+        elif backend == 'redis':
+            self.store = RedisSessionStore(
+                app.config.get(
+                    'SESSION_REDIS_URL',
+                    'redis://localhost:6379/0'
+                ),
+                app.config.get('SESSION_KEY_PREFIX', 'session:')
+            )
+
+        else:
+            raise ValueError('Unknown session backend: {}'.format(backend))
+
+        app.session_interface = self
+
+        # Prevent session fixation
+        from flask_login import user_logged_in
+        user_logged_in.connect(self._regenerate, app, weak=False)
+
+    def _regenerate(self, sender, **kwargs):
+        from flask import session
+
+        if isinstance(session._get_current_object(), ServerSession):
+            session.regenerate()
+
+    def _load(self, sid):
+        stored = self.store.get(sid)
+
+        if stored is None:
+            return None
+
+        value, expires = stored
+
+        try:
+            return self.serializer.loads(value), expires
+
+        except ValueError:
+            return None
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+
+        return ServerSession(sid or None, self._load)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        name = app.session_cookie_name
+
+        # Untouched during the request, nothing to do
+        if not session.loaded:
+            return
+
+        response.vary.add('Cookie')
+
+        previous_sid = getattr(session, 'previous_sid', None)
+
+        if previous_sid:
+            self.store.delete(previous_sid)
+
+        if not session:
+            if session.modified and session.sid:
+                self.store.delete(session.sid)
+
+            if session.modified or previous_sid:
+                response.delete_cookie(name, domain=domain, path=path)
+
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        refresh = (
+            session.expires is not None
+            and self.should_set_cookie(app, session)
+            and session.expires - time.time() < lifetime / 2
+        )
+
+        if not (session.modified or session.new or refresh):
+            return
+
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+
+        self.store.set(
+            session.sid,
+            self.serializer.dumps(dict(session)),
+            lifetime
+        )
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
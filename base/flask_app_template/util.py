@@ -2,10 +2,38 @@
 
 """This file contains utility code."""
 
+import asyncio
+import atexit
+import contextlib
+import cProfile
+import itertools
+import base64
+import json
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
 from urllib.parse import urlparse, urljoin
 
-from flask import request
-from flask_mail import Message
+from flask import Response, current_app, g, has_request_context, request, \
+    stream_with_context
+from flask.sessions import SessionInterface
+from flask.signals import before_render_template, template_rendered
+from flask_mail import Attachment, Message
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from markupsafe import Markup
+from sqlalchemy import event, exc as sa_exc, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import TextClause, UpdateBase
+
+
+# Marker used by templates to force a flush of the streamed output
+STREAM_FLUSH_MARKER = '<!-- stream-flush -->'
 
 
 class CryptoManager(object):
@@ -77,6 +105,20 @@ class CryptoManager(object):
 
         self._context = CryptContext(**params)
 
+    def hash(self, secret, **kwargs):
+        """Hash a secret, recording the time spent in the metrics."""
+        from flask_app_template import metrics_registry
+
+        with metrics_registry.crypto_duration.time(operation='hash'):
+            return self._context.hash(secret, **kwargs)
+
+    def verify(self, secret, hash, **kwargs):
+        """Verify a secret, recording the time spent in the metrics."""
+        from flask_app_template import metrics_registry
+
+        with metrics_registry.crypto_duration.time(operation='verify'):
+            return self._context.verify(secret, hash, **kwargs)
+
 
 class HashidsWrapper(object):
     """Wrapper for deferred initialization of Hashids.
@@ -142,6 +184,1056 @@ class HashidsWrapper(object):
             self._initialized = True
 
 
+class MailQueue(object):
+    """Background delivery of emails through a pool of threads.
+
+    This is optional and can be enabled by setting the configuration
+    parameter `USE_MAIL_QUEUE` to `True`. Each thread keeps its own SMTP
+    connection open while there are messages to deliver. If the queue is
+    full, messages are stored on disk (as JSON) and moved back to the queue
+    periodically, as soon as there is room for them. Pending messages are
+    delivered (or stored on disk) when the process exits.
+
+    If used, the queue expects the following configuration parameters:
+
+    - `MAIL_QUEUE_SIZE`: Maximum number of messages in the queue (defaults
+        to 100).
+    - `MAIL_QUEUE_WORKERS`: Number of delivery threads (defaults to 2).
+    - `MAIL_QUEUE_RETRIES`: Number of retries for each message (defaults
+        to 3).
+    - `MAIL_QUEUE_BACKOFF`: Base delay in seconds between retries, doubled
+        on each attempt (defaults to 1).
+    - `MAIL_QUEUE_IDLE_TIMEOUT`: Seconds after which idle SMTP connections
+        are closed (defaults to 30).
+    - `MAIL_QUEUE_DRAIN_TIMEOUT`: Seconds to wait for pending messages on
+        shutdown (defaults to 10).
+    - `MAIL_SPOOL_DIR`: Directory in which messages are stored when the queue
+        is full (defaults to `mail_spool` in the instance path).
+    - `MAIL_SPOOL_INTERVAL`: Seconds between checks for stored messages
+        (defaults to 5).
+    """
+
+    def __init__(self):
+        self._app = None
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self.enabled = False
+
+    def init_app(self, app):
+        """Initialize the queue.
+
+        Threads are started on the first message rather than here, so that
+        they are created in the process that delivers the email (e.g. after
+        the server forks its workers).
+
+        Args:
+            app: Application instance
+        """
+        self.enabled = app.config.get('USE_MAIL_QUEUE', False)
+
+        if not self.enabled:
+            return
+
+        self._app = app
+        self._spool_dir = app.config.get(
+            'MAIL_SPOOL_DIR',
+            os.path.join(app.instance_path, 'mail_spool')
+        )
+
+        os.makedirs(self._spool_dir, exist_ok=True)
+        atexit.register(self.shutdown)
+
+    def put(self, message):
+        """Enqueue a message for delivery.
+
+        If the queue is full, the message is stored on disk instead.
+
+        Args:
+            message: Flask-Mail `Message` instance.
+        """
+        self._start()
+
+        try:
+            self._queue.put_nowait(message)
+
+        except queue.Full:
+            self._spool(message)
+
+    def shutdown(self):
+        """Deliver pending messages and stop the delivery threads.
+
+        Messages that could not be delivered before `MAIL_QUEUE_DRAIN_TIMEOUT`
+        are stored on disk.
+        """
+        if self._pid != os.getpid():
+            return
+
+        timeout = self._app.config.get('MAIL_QUEUE_DRAIN_TIMEOUT', 10)
+        deadline = time.monotonic() + timeout
+
+        # Stop threads after pending messages
+        for _ in self._threads:
+            try:
+                self._queue.put(
+                    None,
+                    timeout=max(0, deadline - time.monotonic())
+                )
+
+            except queue.Full:
+                break
+
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+        # Keep whatever was not delivered
+        while True:
+            try:
+                message = self._queue.get_nowait()
+
+            except queue.Empty:
+                break
+
+            if message is not None:
+                self._spool(message)
+
+        self._threads = []
+        self._pid = None
+
+    def _start(self):
+        """Start the delivery threads for the current process."""
+        pid = os.getpid()
+
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            self._queue = queue.Queue(
+                maxsize=self._app.config.get('MAIL_QUEUE_SIZE', 100)
+            )
+            self._threads = []
+
+            for _ in range(self._app.config.get('MAIL_QUEUE_WORKERS', 2)):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+
+                self._threads.append(thread)
+
+            self._pid = pid
+
+    def _work(self):
+        """Deliver messages from the queue until stopped."""
+        from flask_app_template import mail
+
+        idle_timeout = self._app.config.get('MAIL_QUEUE_IDLE_TIMEOUT', 30)
+        spool_interval = self._app.config.get('MAIL_SPOOL_INTERVAL', 5)
+        connection = None
+        last_used = next_unspool = time.monotonic()
+
+        with self._app.app_context():
+            while True:
+                now = time.monotonic()
+
+                # Check for stored messages even if the queue is never idle
+                if now >= next_unspool:
+                    self._unspool()
+                    next_unspool = now + spool_interval
+
+                if connection is not None and \
+                        now - last_used >= idle_timeout:
+                    connection = self._close(connection)
+
+                try:
+                    message = self._queue.get(timeout=spool_interval)
+
+                except queue.Empty:
+                    continue
+
+                if message is None:
+                    self._queue.task_done()
+                    break
+
+                connection = self._deliver(mail, connection, message)
+                last_used = time.monotonic()
+                self._queue.task_done()
+
+            self._close(connection)
+
+    def _deliver(self, mail, connection, message):
+        """Send a message, reconnecting and retrying on failure.
+
+        Returns:
+            Connection to reuse for the next message or `None`.
+        """
+        retries = self._app.config.get('MAIL_QUEUE_RETRIES', 3)
+        backoff = self._app.config.get('MAIL_QUEUE_BACKOFF', 1)
+
+        for attempt in range(retries + 1):
+            try:
+                if connection is None:
+                    connection = mail.connect().__enter__()
+
+                connection.send(message)
+
+                return connection
+
+            except Exception:
+                connection = self._close(connection)
+
+                if attempt < retries:
+                    time.sleep(backoff * 2 ** attempt)
+
+        self._app.logger.error(
+            'Failed to deliver email to %s' % message.recipients
+        )
+
+        return None
+
+    def _close(self, connection):
+        """Close an SMTP connection, ignoring errors.
+
+        Returns:
+            `None`
+        """
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+
+            except Exception:
+                pass
+
+        return None
+
+    def _spool(self, message):
+        """Store a message on disk."""
+        name = uuid.uuid4().hex
+        tmp_path = os.path.join(self._spool_dir, name + '.tmp')
+
+        with open(tmp_path, 'w') as f:
+            json.dump(_message_to_dict(message), f)
+
+        os.rename(tmp_path, os.path.join(self._spool_dir, name + '.json'))
+
+    def _unspool(self):
+        """Move messages stored on disk back to the queue."""
+        for name in os.listdir(self._spool_dir):
+            if not name.endswith('.json'):
+                continue
+
+            path = os.path.join(self._spool_dir, name)
+            claimed_path = '{}.{}'.format(path, threading.get_ident())
+
+            try:
+                # Prevent other threads/processes from taking the message
+                os.rename(path, claimed_path)
+
+            except OSError:
+                continue
+
+            try:
+                with open(claimed_path) as f:
+                    message = _message_from_dict(json.load(f))
+
+            except (OSError, ValueError, TypeError, KeyError):
+                self._app.logger.exception(
+                    'Invalid spooled email %s' % claimed_path
+                )
+                continue
+
+            os.remove(claimed_path)
+
+            try:
+                self._queue.put_nowait(message)
+
+            except queue.Full:
+                self._spool(message)
+                return
+
+
+def _message_to_dict(message):
+    """Obtain a JSON serializable representation of a Flask-Mail message."""
+    return {
+        'subject': message.subject,
+        'recipients': message.recipients,
+        'body': message.body,
+        'html': message.html,
+        'sender': message.sender,
+        'cc': message.cc,
+        'bcc': message.bcc,
+        'reply_to': message.reply_to,
+        'date': message.date,
+        'charset': message.charset,
+        'extra_headers': message.extra_headers,
+        'mail_options': message.mail_options,
+        'rcpt_options': message.rcpt_options,
+        'msgId': message.msgId,
+        'attachments': [
+            {
+                'filename': a.filename,
+                'content_type': a.content_type,
+                'data': base64.b64encode(
+                    a.data.encode('utf-8') if isinstance(a.data, str)
+                    else a.data
+                ).decode('ascii'),
+                'disposition': a.disposition,
+                'headers': a.headers,
+            }
+            for a in message.attachments
+        ],
+    }
+
+
+def _message_from_dict(data):
+    """Rebuild a Flask-Mail message stored with `_message_to_dict()`."""
+    def address(value):
+        # (name, address) pairs are stored as lists
+        return tuple(value) if isinstance(value, list) else value
+
+    message = Message(
+        subject=data['subject'],
+        recipients=[address(r) for r in data['recipients']],
+        body=data['body'],
+        html=data['html'],
+        sender=address(data['sender']),
+        cc=[address(r) for r in data['cc'] or []],
+        bcc=[address(r) for r in data['bcc'] or []],
+        reply_to=address(data['reply_to']),
+        date=data['date'],
+        charset=data['charset'],
+        extra_headers=data['extra_headers'],
+        mail_options=data['mail_options'],
+        rcpt_options=data['rcpt_options'],
+        attachments=[
+            Attachment(
+                a['filename'],
+                a['content_type'],
+                base64.b64decode(a['data']),
+                a['disposition'],
+                a['headers']
+            )
+            for a in data['attachments']
+        ]
+    )
+    message.msgId = data['msgId']
+
+    return message
+
+
+class AsyncMailer(object):
+    """Delivery of emails in an asyncio event loop through `aiosmtplib`.
+
+    This is optional and can be enabled by setting the configuration
+    parameter `USE_ASYNC_MAIL` to `True`. It only takes effect when the
+    application is served through the ASGI adapter (see `asgi.py`), which
+    binds the mailer to its event loop on startup. Messages are rendered in
+    the request thread and sent in the event loop, so no thread waits for
+    the SMTP server.
+
+    If used, the mailer expects the following configuration parameters:
+
+    - `ASYNC_MAIL_CONCURRENCY`: Maximum number of simultaneous SMTP
+        connections (defaults to 10).
+    - `MAIL_QUEUE_RETRIES`: Number of retries for each message (defaults
+        to 3).
+    - `MAIL_QUEUE_BACKOFF`: Base delay in seconds between retries, doubled
+        on each attempt (defaults to 1).
+    - `MAIL_QUEUE_DRAIN_TIMEOUT`: Seconds to wait for pending messages on
+        shutdown (defaults to 10).
+    """
+
+    def __init__(self):
+        self._app = None
+        self._loop = None
+        self._semaphore = None
+        self._tasks = set()
+        self.enabled = False
+
+    @property
+    def running(self):
+        """Whether the mailer is bound to an event loop."""
+        return self.enabled and self._loop is not None
+
+    def init_app(self, app):
+        """Initialize the mailer.
+
+        Args:
+            app: Application instance
+        """
+        self.enabled = app.config.get('USE_ASYNC_MAIL', False)
+        self._app = app
+
+    def start(self, loop):
+        """Bind the mailer to an event loop.
+
+        Must be called from the event loop.
+
+        Args:
+            loop: Event loop in which emails are sent.
+        """
+        if not self.enabled:
+            return
+
+        self._loop = loop
+        self._semaphore = asyncio.Semaphore(
+            self._app.config.get('ASYNC_MAIL_CONCURRENCY', 10)
+        )
+
+    async def shutdown(self):
+        """Wait for pending messages and unbind the mailer."""
+        if self._tasks:
+            await asyncio.wait(
+                self._tasks,
+                timeout=self._app.config.get('MAIL_QUEUE_DRAIN_TIMEOUT', 10)
+            )
+
+        self._loop = None
+
+    def put(self, message):
+        """Schedule the delivery of a message.
+
+        Must be called within an application context. If sending is
+        suppressed (e.g. when testing), the message is handed to Flask-Mail.
+
+        Args:
+            message: Flask-Mail `Message` instance.
+        """
+        from flask_mail import sanitize_address, sanitize_addresses
+
+        state = current_app.extensions['mail']
+
+        if state.suppress:
+            return state.send(message)
+
+        data = message.as_bytes()
+        sender = sanitize_address(message.sender)
+        recipients = list(sanitize_addresses(message.send_to))
+
+        self._loop.call_soon_threadsafe(
+            self._schedule,
+            data,
+            sender,
+            recipients
+        )
+
+        return None
+
+    def _schedule(self, data, sender, recipients):
+        task = self._loop.create_task(self._send(data, sender, recipients))
+
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, data, sender, recipients):
+        """Send a message, retrying on failure."""
+        import aiosmtplib
+
+        config = self._app.config
+        retries = config.get('MAIL_QUEUE_RETRIES', 3)
+        backoff = config.get('MAIL_QUEUE_BACKOFF', 1)
+
+        for attempt in range(retries + 1):
+            try:
+                async with self._semaphore:
+                    await aiosmtplib.send(
+                        data,
+                        sender=sender,
+                        recipients=recipients,
+                        hostname=config.get('MAIL_SERVER', 'localhost'),
+                        port=config.get('MAIL_PORT', 25),
+                        username=config.get('MAIL_USERNAME') or None,
+                        password=config.get('MAIL_PASSWORD') or None,
+                        use_tls=config.get('MAIL_USE_SSL', False),
+                        start_tls=config.get('MAIL_USE_TLS', False)
+                    )
+
+                return
+
+            except Exception:
+                if attempt < retries:
+                    await asyncio.sleep(backoff * 2 ** attempt)
+
+        self._app.logger.error('Failed to deliver email to %s' % recipients)
+
+
+class PoolStats(object):
+    """Time spent waiting for database connections."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+        # Callables receiving each checkout (e.g. the metrics registry)
+        self.listeners = []
+
+    def record(self, wait, timeout=False):
+        """Record a connection checkout.
+
+        Args:
+            wait (float): Seconds spent waiting for the connection.
+            timeout (bool): Whether the checkout timed out.
+        """
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+            if timeout:
+                self.timeouts += 1
+
+        for listener in self.listeners:
+            listener(wait, timeout)
+
+    def to_dict(self):
+        """Obtain the recorded statistics.
+
+        Returns:
+            Dictionary with the number of checkouts and timeouts, and the
+            total, average and maximum wait times.
+        """
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total': self.wait_total,
+                'wait_avg': (
+                    self.wait_total / self.checkouts if self.checkouts else 0
+                ),
+                'wait_max': self.wait_max,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """Connection pool recording the time spent waiting for connections.
+
+    Statistics are shared among all pools of the process (pools are
+    recreated when the engine is disposed).
+    """
+    stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timeout = False
+
+        try:
+            return super(TimedQueuePool, self)._do_get()
+
+        except sa_exc.TimeoutError:
+            timeout = True
+            raise
+
+        finally:
+            self.stats.record(time.perf_counter() - start, timeout)
+
+
+class RoutingSession(SignallingSession):
+    """Session sending reads to replicas when possible.
+
+    Queries are sent to a replica only while the session is in read-only
+    mode (see `TunedSQLAlchemy.read_only`). As soon as the session writes
+    anything, it sticks to the primary database until it is removed at the
+    end of the request.
+    """
+
+    def __init__(self, db, **options):
+        super(RoutingSession, self).__init__(db, **options)
+
+        self.read_only = False
+        self._db = db
+        self._use_primary = False
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        """Select the engine to use."""
+        if mapper is not None:
+            info = getattr(mapper.mapped_table, 'info', {})
+
+            if info.get('bind_key') is not None:
+                # Explicit bind
+                return super(RoutingSession, self).get_bind(mapper, clause)
+
+        if self._flushing or _is_write(clause):
+            self._use_primary = True
+
+        if self.read_only and not self._use_primary:
+            if self._replica is None:
+                self._replica = self._db.get_replica_engine(self.app)
+
+            if self._replica is not None:
+                return self._replica
+
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+def _is_write(clause):
+    """Check whether a statement modifies data."""
+    if isinstance(clause, UpdateBase):
+        return True
+
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().upper().startswith('SELECT')
+
+    return False
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension with configurable engine options.
+
+    The extension uses the following configuration parameters:
+
+    - `SQLALCHEMY_ENGINE_OPTIONS`: Keyword arguments passed to
+        `create_engine()`, such as `pool_size`, `max_overflow`,
+        `pool_timeout`, `pool_recycle` or `pool_pre_ping`. Pool sizing
+        options are ignored for in-memory SQLite databases.
+    - `SQLALCHEMY_SQLITE_PRAGMAS`: Dictionary of PRAGMAs applied to every
+        new SQLite connection (e.g. `{'journal_mode': 'WAL'}`).
+    - `SQLALCHEMY_REPLICA_BINDS`: List of bind keys (defined in
+        `SQLALCHEMY_BINDS`) of read replicas. Reads performed in read-only
+        mode are sent to one of them.
+    - `SQLALCHEMY_REPLICA_STRATEGY`: How to choose a replica, either
+        `'round-robin'` or `'least-busy'` (fewest checked out connections).
+        Defaults to `'round-robin'`.
+    - `SQLALCHEMY_READ_ONLY_BLUEPRINTS`: Names of the blueprints whose views
+        are run in read-only mode.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._replica_counter = itertools.count()
+
+        super(TunedSQLAlchemy, self).__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        """Initialize the extension.
+
+        Args:
+            app: Application instance.
+        """
+        super(TunedSQLAlchemy, self).init_app(app)
+
+        self._sqlite_pragmas = app.config.get('SQLALCHEMY_SQLITE_PRAGMAS', {})
+
+        if not event.contains(Engine, 'connect', self._apply_sqlite_pragmas):
+            event.listen(Engine, 'connect', self._apply_sqlite_pragmas)
+
+        read_only_blueprints = set(
+            app.config.get('SQLALCHEMY_READ_ONLY_BLUEPRINTS', ())
+        )
+
+        if read_only_blueprints:
+            @app.before_request
+            def read_only_blueprint():
+                if request.blueprint in read_only_blueprints:
+                    self.session().read_only = True
+
+    def create_session(self, options):
+        """Create the session factory using `RoutingSession`."""
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    @contextlib.contextmanager
+    def read_only(self):
+        """Send reads to a replica (if any) within a block or view.
+
+        May be used as a context manager or as a decorator:
+
+            @bp_general.route('/')
+            @db.read_only()
+            def home():
+                ...
+
+        Reads that follow a write in the same request are still sent to the
+        primary database.
+        """
+        session = self.session()
+        previous = session.read_only
+        session.read_only = True
+
+        try:
+            yield
+
+        finally:
+            session.read_only = previous
+
+    def get_replica_engine(self, app=None):
+        """Choose the engine of a replica.
+
+        Args:
+            app: Application instance.
+
+        Returns:
+            Engine or `None` if there are no replicas.
+        """
+        app = self.get_app(app)
+        keys = app.config.get('SQLALCHEMY_REPLICA_BINDS', ())
+
+        if not keys:
+            return None
+
+        strategy = app.config.get('SQLALCHEMY_REPLICA_STRATEGY', 'round-robin')
+
+        if strategy == 'least-busy':
+            engines = [self.get_engine(app, bind=key) for key in keys]
+
+            return min(engines, key=_checked_out_connections)
+
+        key = keys[next(self._replica_counter) % len(keys)]
+
+        return self.get_engine(app, bind=key)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        """Add the configured engine options."""
+        rv = super(TunedSQLAlchemy, self).apply_driver_hacks(
+            app,
+            sa_url,
+            options
+        )
+
+        # Newer versions of Flask-SQLAlchemy return the URL and options
+        if isinstance(rv, tuple):
+            sa_url, options = rv
+
+        engine_options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+        if not sa_url.drivername.startswith('sqlite'):
+            if 'poolclass' not in options:
+                engine_options.setdefault('poolclass', TimedQueuePool)
+
+        elif sa_url.database in (None, '', ':memory:'):
+            # In-memory databases use a single connection (static pool)
+            for key in ('pool_size', 'max_overflow', 'pool_timeout'):
+                engine_options.pop(key, None)
+
+        else:
+            # Flask-SQLAlchemy uses no pool for SQLite files, so every
+            # checkout would open a connection and apply the PRAGMAs again
+            options['poolclass'] = engine_options.pop(
+                'poolclass',
+                TimedQueuePool
+            )
+
+            # Pooled connections are used by one thread at a time, but not
+            # always the one that opened them
+            connect_args = dict(options.get('connect_args', {}))
+            connect_args.update(engine_options.pop('connect_args', {}))
+            connect_args.setdefault('check_same_thread', False)
+            options['connect_args'] = connect_args
+
+        options.update(engine_options)
+
+        return rv
+
+    def pool_stats(self):
+        """Obtain statistics of the connection pool.
+
+        Returns:
+            Dictionary with the checkout wait times (see `PoolStats`) and the
+            status of the pool of the default engine.
+        """
+        stats = TimedQueuePool.stats.to_dict()
+        stats['status'] = self.engine.pool.status()
+
+        return stats
+
+    def _apply_sqlite_pragmas(self, dbapi_connection, connection_record):
+        """Apply configured PRAGMAs to new SQLite connections."""
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+
+        cursor = dbapi_connection.cursor()
+
+        for name, value in self._sqlite_pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+        cursor.close()
+
+
+class RequestQueries(object):
+    """Queries executed during a request."""
+    __slots__ = ('count', 'duration', 'statements')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+        # Statement -> number of executions
+        self.statements = {}
+
+
+class QueryTracker(object):
+    """Per-request SQL instrumentation.
+
+    Counts the queries executed in each request and the time spent on them,
+    logging statements that are repeated many times in the same request
+    (usually a sign of N+1 queries). The totals are sent to the client in a
+    `Server-Timing` header.
+
+    This is enabled by default and can be disabled by setting the
+    configuration parameter `USE_QUERY_TRACKING` to `False`.
+
+    If used, the tracker expects the following configuration parameters:
+
+    - `QUERY_TRACKING_REPEAT_THRESHOLD`: Number of executions of the same
+        statement in a request after which it is logged (defaults to 10).
+    - `QUERY_TRACKING_SERVER_TIMING`: Whether to add the `Server-Timing`
+        header to responses (defaults to `True`).
+    """
+
+    def __init__(self):
+        self._threshold = 10
+        self._server_timing = True
+
+    def init_app(self, app):
+        """Register the SQLAlchemy and request hooks.
+
+        Args:
+            app: Application instance.
+        """
+        if not app.config.get('USE_QUERY_TRACKING', False):
+            return
+
+        self._threshold = app.config.get('QUERY_TRACKING_REPEAT_THRESHOLD', 10)
+        self._server_timing = app.config.get(
+            'QUERY_TRACKING_SERVER_TIMING',
+            True
+        )
+
+        if not event.contains(Engine, 'before_cursor_execute', self._before):
+            event.listen(Engine, 'before_cursor_execute', self._before)
+            event.listen(Engine, 'after_cursor_execute', self._after)
+
+        app.after_request(self._report)
+
+    def stats(self):
+        """Obtain the queries of the current request.
+
+        Returns:
+            `RequestQueries` instance or `None` if there is no request or no
+            queries were executed.
+        """
+        if not has_request_context():
+            return None
+
+        return g.get('_request_queries')
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        context._query_start = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        if not has_request_context():
+            return
+
+        queries = g.get('_request_queries')
+
+        if queries is None:
+            queries = g._request_queries = RequestQueries()
+
+        queries.count += 1
+        queries.duration += time.perf_counter() - context._query_start
+        queries.statements[statement] = (
+            queries.statements.get(statement, 0) + 1
+        )
+
+    def _report(self, response):
+        """Log repeated statements and add the `Server-Timing` header."""
+        queries = g.get('_request_queries')
+
+        if queries is None:
+            return response
+
+        for statement, count in queries.statements.items():
+            if count >= self._threshold:
+                current_app.logger.warning(
+                    'Statement executed %d times in %s: %s' % (
+                        count,
+                        request.endpoint,
+                        statement
+                    )
+                )
+
+        if self._server_timing:
+            response.headers.add(
+                'Server-Timing',
+                'db;dur={:.2f};desc="{} queries"'.format(
+                    queries.duration * 1000,
+                    queries.count
+                )
+            )
+
+        return response
+
+
+class RequestProfiler(object):
+    """Sampling profiler for requests.
+
+    Profiles a sample of the requests with `cProfile` and stores the results
+    as `pstats` dumps in a directory, which can be aggregated later with the
+    `profile report` command. Only the most recent dumps are kept.
+
+    This is optional and can be enabled by setting the configuration
+    parameter `USE_PROFILER` to `True`.
+
+    If used, the profiler expects the following configuration parameters:
+
+    - `PROFILER_SAMPLE_RATE`: Profile one in every N requests (defaults to
+        100). Set to 0 to disable sampling.
+    - `PROFILER_ENDPOINTS`: List of endpoints that are always profiled.
+    - `PROFILER_HEADER`: Header that triggers profiling of a request
+        (defaults to `X-Profile`). Its value must match `PROFILER_TOKEN`.
+    - `PROFILER_TOKEN`: Secret value of the header. Profiling through the
+        header is disabled if not set.
+    - `PROFILER_DIR`: Directory in which dumps are stored (defaults to
+        `profiles` in the instance path).
+    - `PROFILER_MAX_FILES`: Maximum number of dumps to keep (defaults to
+        500).
+    """
+
+    def __init__(self):
+        self.directory = None
+
+    def init_app(self, app):
+        """Register the request hooks.
+
+        Args:
+            app: Application instance.
+        """
+        if not app.config.get('USE_PROFILER', False):
+            return
+
+        self._sample_rate = app.config.get('PROFILER_SAMPLE_RATE', 100)
+        self._endpoints = set(app.config.get('PROFILER_ENDPOINTS', ()))
+        self._header = app.config.get('PROFILER_HEADER', 'X-Profile')
+        self._token = app.config.get('PROFILER_TOKEN')
+        self._max_files = app.config.get('PROFILER_MAX_FILES', 500)
+
+        self.directory = app.config.get(
+            'PROFILER_DIR',
+            os.path.join(app.instance_path, 'profiles')
+        )
+        os.makedirs(self.directory, exist_ok=True)
+
+        app.before_request(self._start)
+        app.teardown_request(self._stop)
+
+    def _should_profile(self):
+        """Check whether the current request should be profiled."""
+        if request.endpoint in self._endpoints:
+            return True
+
+        if self._token and request.headers.get(self._header) == self._token:
+            return True
+
+        return bool(self._sample_rate) and \
+            random.randrange(self._sample_rate) == 0
+
+    def _start(self):
+        if not self._should_profile():
+            return
+
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+
+        except ValueError:
+            # Another profiler is active
+            return
+
+        g._profile = profile
+
+    def _stop(self, exc=None):
+        profile = g.pop('_profile', None)
+
+        if profile is None:
+            return
+
+        profile.disable()
+
+        name = '{:.6f}-{}-{}.prof'.format(
+            time.time(),
+            request.endpoint or 'unknown',
+            os.getpid()
+        )
+
+        profile.dump_stats(os.path.join(self.directory, name))
+
+        self._rotate()
+
+    def _rotate(self):
+        """Remove the oldest dumps."""
+        dumps = sorted(
+            f for f in os.listdir(self.directory) if f.endswith('.prof')
+        )
+
+        for name in dumps[:max(0, len(dumps) - self._max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+
+            except OSError:
+                pass
+
+
+class SessionSkipInterface(SessionInterface):
+    """Session interface that does not load the session for some requests.
+
+    Requests to the paths in `skip_paths` or the endpoints in
+    `skip_endpoints` get a null session, so the session cookie is neither
+    parsed nor written, and Flask-Login never loads the user. Other requests
+    are handled by the wrapped interface.
+
+    Args:
+        interface: Session interface to wrap.
+    """
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.skip_paths = set()
+        self.skip_endpoints = set()
+
+    def open_session(self, app, request):
+        if request.path in self.skip_paths or \
+                request.endpoint in self.skip_endpoints:
+            return self.make_null_session(app)
+
+        return self.interface.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        return self.interface.save_session(app, session, response)
+
+
+def skip_session(app, path=None, endpoint=None):
+    """Do not load the session for a path or an endpoint.
+
+    The session interface of the application is wrapped in a
+    `SessionSkipInterface` if needed.
+
+    Args:
+        app: Application instance.
+        path (str): Path of the requests.
+        endpoint (str): Endpoint of the requests (e.g. `'static'`).
+    """
+    if not isinstance(app.session_interface, SessionSkipInterface):
+        app.session_interface = SessionSkipInterface(app.session_interface)
+
+    if path:
+        app.session_interface.skip_paths.add(path)
+
+    if endpoint:
+        app.session_interface.skip_endpoints.add(endpoint)
+
+
+def _checked_out_connections(engine):
+    """Number of connections in use for an engine."""
+    checkedout = getattr(engine.pool, 'checkedout', None)
+
+    return checkedout() if checkedout else 0
+
+
 def is_safe_url(target):
     """Check whether the target is safe for redirection.
 
@@ -162,15 +1254,111 @@ def send_email(*args, **kwargs):
     """Send an email.
 
     This function may be extended in case the Celery recipe is used
-    in order to use the asynchronous email delivery.
+    in order to use the asynchronous email delivery. If `USE_MAIL_QUEUE` is
+    enabled, the email is delivered in the background instead. When served
+    through ASGI with `USE_ASYNC_MAIL` enabled, the email is sent in the
+    event loop.
 
     All arguments are passed as-is to Flask-Mail.
 
     Returns:
-        Mail send result.
+        Mail send result or `None` if the email was enqueued.
     """
-    from flask_app_template import mail
+    from flask_app_template import async_mailer, mail, mail_queue, \
+        metrics_registry
 
     message = Message(*args, **kwargs)
 
-    return mail.send(message)
+    with metrics_registry.mail_duration.time():
+        if async_mailer.running:
+            return async_mailer.put(message)
+
+        if mail_queue.enabled:
+            mail_queue.put(message)
+            return None
+
+        return mail.send(message)
+
+
+def stream_template(template_name_or_list, **context):
+    """Render a template progressively.
+
+    Works like `render_template`, but returns a streamed response that sends
+    the output of the template as it is being rendered instead of building the
+    whole page in memory first. The request context is preserved until the
+    response has been sent, so `url_for`, `current_user`, etc. remain
+    available in the template.
+
+    Output is grouped in chunks of `STREAM_BUFFER_SIZE` characters (defaults
+    to 8192). Templates may force a flush by outputting the `_stream_flush`
+    variable (the default layout does this after `<head>` and the navbar).
+
+    Args:
+        template_name_or_list: Name of the template (or list of names) to
+            render.
+        context: Variables that should be available in the template.
+
+    Returns:
+        Streamed response.
+    """
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    context['_stream_flush'] = Markup(STREAM_FLUSH_MARKER)
+
+    template = app.jinja_env.get_or_select_template(template_name_or_list)
+    buffer_size = app.config.get('STREAM_BUFFER_SIZE', 8192)
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)
+
+        buffer = []
+        length = 0
+
+        for chunk in template.generate(context):
+            flush = STREAM_FLUSH_MARKER in chunk
+
+            if flush:
+                # Chunk may be `Markup`, which would escape the arguments
+                chunk = str.replace(chunk, STREAM_FLUSH_MARKER, '')
+
+            buffer.append(chunk)
+            length += len(chunk)
+
+            if flush or length >= buffer_size:
+                yield ''.join(buffer)
+
+                buffer = []
+                length = 0
+
+        if buffer:
+            yield ''.join(buffer)
+
+        template_rendered.send(app, template=template, context=context)
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+
+def stream_query(query, batch_size=None):
+    """Iterate over the results of a query in batches.
+
+    Rows are fetched from the database through `yield_per()` instead of
+    loading the whole result set at once. This is intended to be combined
+    with `stream_template`, for instance:
+
+        stream_template('users.html', users=stream_query(User.query))
+
+    Note that `yield_per()` is not compatible with eager loading of
+    collections.
+
+    Args:
+        query: SQLAlchemy query to iterate.
+        batch_size (int): Number of rows to fetch on each round-trip. Defaults
+            to `STREAM_QUERY_BATCH_SIZE` (100).
+
+    Returns:
+        Query that yields results in batches.
+    """
+    if batch_size is None:
+        batch_size = current_app.config.get('STREAM_QUERY_BATCH_SIZE', 100)
+
+    return query.yield_per(batch_size)
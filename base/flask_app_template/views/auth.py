@@ -12,7 +12,7 @@ from flask_login import confirm_login, current_user, login_user, logout_user, \
 from passlib import pwd
 from sqlalchemy import or_
 
-from flask_app_template import db, crypto_manager
+from flask_app_template import audit_log, db, crypto_manager
 from flask_app_template.forms import LoginForm, ForgotPasswordForm, \
     ReauthenticationForm, PasswordResetForm
 from flask_app_template.models import User
@@ -40,6 +40,12 @@ def login():
         ).first()
 
         if not user or not crypto_manager.verify(form.password.data, user.password):
+            audit_log.record(
+                'login_failure',
+                user=user,
+                identity=form.identity.data
+            )
+
             # Show invalid credentials message
             flash(_('Invalid credentials'), 'error')
 
@@ -47,6 +53,12 @@ def login():
 
         # Log the user in
         if login_user(user, remember=form.remember_me.data):
+            audit_log.record(
+                'login_success',
+                user=user,
+                identity=form.identity.data
+            )
+
             flash(_('Logged in successfully'), 'success')
 
             # Validate destination
@@ -58,6 +70,12 @@ def login():
             return redirect(url_for('general.home'))
 
         # User is not allowed
+        audit_log.record(
+            'login_failure',
+            user=user,
+            identity=form.identity.data
+        )
+
         flash(_('Invalid credentials'), 'error')
 
     return render_template('auth/login.html', form=form)
@@ -67,6 +85,7 @@ def login():
 @login_required
 def logout():
     """Log the user out."""
+    audit_log.record('logout', user=current_user)
     logout_user()
 
     return redirect(url_for('auth.login'))
@@ -80,7 +99,9 @@ def reauthenticate():
 
     if form.validate_on_submit():
         # Check credentials
-        if crypto_manager.verify(form.password.data, current_user.password):
+        if not crypto_manager.verify(form.password.data, current_user.password):
+            audit_log.record('reauthentication_failure', user=current_user)
+
             # Show invalid credentials message
             flash(_('Invalid credentials'), 'error')
 
@@ -88,6 +109,7 @@ def reauthenticate():
 
         # Refresh session
         confirm_login()
+        audit_log.record('reauthentication_success', user=current_user)
 
         # Validate destination
         next_url = request.args.get('next')
@@ -120,6 +142,12 @@ def forgot_password():
             .filter_by(is_active=True)
         ).first()
 
+        audit_log.record(
+            'password_reset_request',
+            user=user,
+            identity=form.email.data
+        )
+
         if not user:
             # Don't let the user know
             flash(_('A password reset token has been sent'), 'success')
@@ -201,6 +229,7 @@ def reset_password(token):
         try:
             correct = True
             db.session.commit()
+            audit_log.record('password_reset', user=user)
 
             # Send notification email
             send_email(
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains tests of the routing of reads to replicas.
+
+Run them with `python -m unittest discover tests`.
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from flask import Flask
+
+from flask_app_template.util import TunedSQLAlchemy
+
+
+db = TunedSQLAlchemy()
+
+
+class Item(db.Model):
+    __tablename__ = 'items'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(32), nullable=False)
+
+
+class RoutingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        # Each database tells where rows are read from
+        for name in ('primary', 'replica1', 'replica2'):
+            connection = sqlite3.connect(self._path(name))
+            connection.execute(
+                'CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)'
+            )
+            connection.execute(
+                'INSERT INTO items (id, name) VALUES (1, ?)',
+                (name,)
+            )
+            connection.commit()
+            connection.close()
+
+        self.app = Flask(__name__)
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + self._path('primary'),
+            SQLALCHEMY_BINDS={
+                'replica1': 'sqlite:///' + self._path('replica1'),
+                'replica2': 'sqlite:///' + self._path('replica2'),
+            },
+            SQLALCHEMY_REPLICA_BINDS=['replica1', 'replica2'],
+            SQLALCHEMY_TRACK_MODIFICATIONS=False
+        )
+        db.init_app(self.app)
+
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        db.session.remove()
+
+        for engine in self.app.extensions['sqlalchemy'].connectors.values():
+            engine.get_engine().dispose()
+
+        self.context.pop()
+        shutil.rmtree(self.directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.db')
+
+    def _read(self):
+        """Name of the database the first item is read from."""
+        return db.session.query(Item.name).filter(Item.id == 1).scalar()
+
+    def test_reads_use_replica_in_read_only_mode(self):
+        self.assertEqual(self._read(), 'primary')
+
+        with db.read_only():
+            self.assertIn(self._read(), ('replica1', 'replica2'))
+
+        db.session.remove()
+        self.assertEqual(self._read(), 'primary')
+
+    def test_reads_stick_to_primary_after_write(self):
+        with db.read_only():
+            self.assertIn(self._read(), ('replica1', 'replica2'))
+
+            db.session.add(Item(id=2, name='new'))
+            db.session.flush()
+
+            self.assertEqual(self._read(), 'primary')
+            self.assertEqual(
+                db.session.query(Item.name).filter(Item.id == 2).scalar(),
+                'new'
+            )
+
+        db.session.commit()
+        db.session.remove()
+
+        with db.read_only():
+            self.assertIsNone(
+                db.session.query(Item.name).filter(Item.id == 2).scalar()
+            )
+
+    def test_round_robin(self):
+        reads = []
+
+        for _ in range(4):
+            with db.read_only():
+                reads.append(self._read())
+
+            db.session.remove()
+
+        self.assertEqual(reads[0::2], [reads[0]] * 2)
+        self.assertEqual(reads[1::2], [reads[1]] * 2)
+        self.assertEqual(set(reads), {'replica1', 'replica2'})
+
+    def test_least_busy(self):
+        self.app.config['SQLALCHEMY_REPLICA_STRATEGY'] = 'least-busy'
+
+        busy = db.get_engine(self.app, bind='replica1').connect()
+
+        try:
+            for _ in range(3):
+                with db.read_only():
+                    self.assertEqual(self._read(), 'replica2')
+
+                db.session.remove()
+
+        finally:
+            busy.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains tests of the user search.
+
+Run them with `python -m unittest discover tests`.
+"""
+
+import sqlite3
+import unittest
+
+from flask import Flask
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine
+
+from flask_app_template import search
+
+
+metadata = MetaData()
+
+users = Table(
+    'users',
+    metadata,
+    Column('id', Integer, primary_key=True),
+    Column('username', String(64), unique=True, nullable=False),
+    Column('email', String(128), unique=True, nullable=False)
+)
+
+
+class SearchTestCase(unittest.TestCase):
+
+    candidates = 10
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SEARCH_MAX_CANDIDATES'] = self.candidates
+
+        self.engine = create_engine('sqlite://')
+        metadata.create_all(self.engine)
+
+        # More matches than candidates, inserted before the best ones
+        rows = [
+            {'username': 'user{}'.format(i), 'email': 'alice{}@x.org'.format(i)}
+            for i in range(5 * self.candidates)
+        ]
+        rows += [
+            {'username': 'malice', 'email': 'm@x.org'},
+            {'username': 'alice_smith', 'email': 'as@x.org'},
+            {'username': 'alice', 'email': 'a@x.org'},
+            {'username': 'al%ce', 'email': 'p@x.org'},
+        ]
+
+        with self.engine.begin() as connection:
+            connection.execute(users.insert(), rows)
+
+    def tearDown(self):
+        search._indexed.discard(str(self.engine.url))
+
+    def _search(self, query, limit=20, cursor=None):
+        with self.app.app_context(), self.engine.connect() as connection:
+            ids, cursor = search.search_users(
+                connection,
+                query,
+                limit=limit,
+                cursor=cursor
+            )
+
+            names = {
+                row.id: row.username
+                for row in connection.execute(users.select())
+            }
+
+        return [names[i] for i in ids], cursor
+
+    def _search_all(self, query, limit):
+        results, cursor = self._search(query, limit)
+
+        while cursor:
+            more, cursor = self._search(query, limit, cursor)
+            results += more
+
+        return results
+
+    @unittest.skipIf(
+        sqlite3.sqlite_version_info < search.MIN_SQLITE_VERSION,
+        'SQLite without trigram tokenizer'
+    )
+    def test_username_matches_beyond_candidates(self):
+        with self.engine.begin() as connection:
+            search.create_index(connection)
+
+        results = self._search_all('alice', limit=3)
+
+        self.assertEqual(results[:2], ['alice', 'alice_smith'])
+        self.assertIn('malice', results)
+        self.assertLessEqual(len(results), self.candidates + 2)
+        self.assertEqual(len(set(results)), len(results))
+
+    def test_like_without_index(self):
+        results = self._search_all('alice', limit=7)
+
+        self.assertEqual(len(results), 5 * self.candidates + 3)
+        self.assertEqual(results[-3:], ['malice', 'alice_smith', 'alice'])
+
+    def test_like_escapes_wildcards(self):
+        results, cursor = self._search('al%ce')
+
+        self.assertEqual(results, ['al%ce'])
+        self.assertIsNone(cursor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""This file contains tests of the server-side sessions.
+
+Run them with `python -m unittest discover tests`.
+"""
+
+import unittest
+
+from flask import Flask, session
+from flask_login import LoginManager, UserMixin, login_user
+
+from flask_app_template.sessions import MemorySessionStore, \
+    ServerSessionInterface
+
+
+class CountingStore(MemorySessionStore):
+    """Memory store counting the calls to each method."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = {'get': 0, 'set': 0, 'delete': 0}
+
+    def get(self, sid):
+        self.calls['get'] += 1
+        return super().get(sid)
+
+    def set(self, sid, value, ttl):
+        self.calls['set'] += 1
+        super().set(sid, value, ttl)
+
+    def delete(self, sid):
+        self.calls['delete'] += 1
+        super().delete(sid)
+
+
+class User(UserMixin):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class ServerSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.config.update(SECRET_KEY='test', USE_SERVER_SESSION=True)
+
+        interface = ServerSessionInterface()
+        interface.init_app(app)
+        self.store = interface.store = CountingStore()
+
+        login_manager = LoginManager(app)
+        login_manager.user_loader(User)
+
+        @app.route('/login')
+        def login():
+            login_user(User('1'), remember=True)
+            return 'ok'
+
+        @app.route('/counter')
+        def counter():
+            session['counter'] = session.get('counter', 0) + 1
+            return str(session['counter'])
+
+        @app.route('/ping')
+        def ping():
+            return 'pong'
+
+        self.client = app.test_client()
+
+    def test_session_free_route_does_not_use_store(self):
+        self.client.get('/login')
+        self.store.calls.update(get=0, set=0, delete=0)
+
+        response = self.client.get('/ping')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.store.calls, {'get': 0, 'set': 0, 'delete': 0})
+        self.assertNotIn('Set-Cookie', response.headers)
+
+    def test_login_sets_remember_cookie(self):
+        response = self.client.get('/login')
+
+        cookies = response.headers.getlist('Set-Cookie')
+        self.assertTrue(any(c.startswith('remember_token=') for c in cookies))
+        self.assertEqual(self.store.calls['set'], 1)
+
+    def test_data_is_kept_between_requests(self):
+        self.client.get('/counter')
+        response = self.client.get('/counter')
+
+        self.assertEqual(response.get_data(as_text=True), '2')
+        self.assertEqual(self.store.calls['get'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,4 +20,5 @@ def init_app():
         celery.make_celery(app)
 
         # Import tasks
-        from flask_app_template.async_tasks import async_mail
+        from flask_app_template.async_tasks import async_mail, \
+            async_mail_batch
@@ -3,13 +3,52 @@
 """This file contains celery tasks."""
 
 
+from flask import current_app
 from flask_mail import Message
 
 from flask_app_template import celery, mail
+from flask_app_template.util import log_undelivered, send_batch
 
 
-@celery.task()
+@celery.task(ignore_result=True)
 def async_mail(*args, **kwargs):
     """Send Flask-Mail emails asynchronously."""
     message = Message(*args, **kwargs)
     mail.send(message)
+
+
+
+@celery.task(bind=True, ignore_result=True, max_retries=None)
+def async_mail_batch(self, messages):
+    """Send several Flask-Mail emails over a single connection.
+
+    Messages that could not be delivered are sent again in a new attempt of
+    the task, with only those messages, up to `MAIL_BATCH_REQUEUES` times
+    (defaults to 3) and waiting `MAIL_BATCH_REQUEUE_DELAY` seconds (defaults
+    to 60, doubled on each attempt). Messages still undelivered after that
+    are logged as errors.
+
+    Args:
+        messages (list): Dictionaries containing the `args` and `kwargs` that
+            should be passed to `Message`.
+    """
+    failed = send_batch(messages)
+
+    if not failed:
+        return
+
+    requeues = current_app.config.get('MAIL_BATCH_REQUEUES', 3)
+
+    if self.request.retries < requeues:
+        current_app.logger.warning(
+            'Failed to deliver %d emails, retrying later' % len(failed)
+        )
+
+        delay = current_app.config.get('MAIL_BATCH_REQUEUE_DELAY', 60)
+
+        raise self.retry(
+            args=[failed],
+            countdown=delay * 2 ** self.request.retries
+        )
+
+    log_undelivered(failed)
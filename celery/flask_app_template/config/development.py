@@ -8,3 +8,34 @@
 USE_CELERY = False
 CELERY_BROKER_URL = 'redis://localhost:6379/1'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/1'
+CELERY_TASK_METRICS = False
+CELERY_SLOW_TASK_THRESHOLD = 5
+CELERY_REUSE_APP_CONTEXT = False
+
+# Celery routing and worker tuning
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_ROUTES = {
+    'flask_app_template.async_tasks.async_mail': {
+        'queue': 'mail',
+        'priority': 5,
+    },
+    'flask_app_template.async_tasks.async_mail_batch': {
+        'queue': 'mail',
+        'priority': 9,
+    },
+}
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'queue_order_strategy': 'priority',
+}
+CELERY_TASK_IGNORE_RESULT = False
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+
+# Batched email delivery
+MAIL_BATCH_SIZE = 50
+MAIL_BATCH_RATE = 0
+MAIL_BATCH_RETRIES = 3
+MAIL_BATCH_BACKOFF = 1
+MAIL_BATCH_REQUEUES = 3
+MAIL_BATCH_REQUEUE_DELAY = 60
@@ -1,19 +1,70 @@
 # -*- coding: utf-8 -*-
 
+# INCLUDE IN THE IMPORTS SECTION
+
+import contextlib
+import threading
+import time
+
+from flask import current_app
+
 # ...
 
 # INCLUDE AT THE END OF THE FILE
+
+# Buckets used for task durations (tasks may run longer than requests)
+TIME_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+
+
+# Settings of the wrapper itself, which are not copied to Celery
+WRAPPER_SETTINGS = frozenset([
+    'CELERY_TASK_METRICS',
+    'CELERY_SLOW_TASK_THRESHOLD',
+    'CELERY_REUSE_APP_CONTEXT',
+])
+
+
+def _add_enqueue_timestamp(headers=None, **kwargs):
+    """Add the time at which a task was sent to the message headers."""
+    if headers is not None:
+        headers.setdefault('enqueued_at', time.time())
+
+
 class CeleryWrapper(object):
     """Wrapper for deferred initialization of Celery.
 
     The wrapper expects the following configuration parameters:
 
-    - `CELERY_RESULT_BACKEND`: URL to the backend used for obtaining results.
     - `CELERY_BROKER_URL`: URL to the broker.
+
+    Any other Celery setting may be specified by prefixing its name with
+    `CELERY_` (for instance, `CELERY_TASK_ROUTES` or
+    `CELERY_WORKER_PREFETCH_MULTIPLIER`). Other keys of the application
+    configuration, as well as the settings of the wrapper listed below, are
+    not copied to Celery.
+
+    Optionally, the following parameters may be set:
+
+    - `CELERY_RESULT_BACKEND`: URL to the backend used for obtaining results.
+
+    - `CELERY_TASK_METRICS`: Record queue wait time, execution time, app
+        context setup time and number of DB queries of each task in the
+        metrics registry (see `metrics.py`, defaults to `False`). Obtain them
+        through `stats()` or by running `celery inspect task_stats`.
+    - `CELERY_SLOW_TASK_THRESHOLD`: Execution time in seconds after which a
+        task is logged as slow when metrics are enabled (defaults to 5).
+    - `CELERY_REUSE_APP_CONTEXT`: Reuse a single app context per worker
+        instead of pushing a new one for each task (defaults to `False`).
+        This can also be set per task with
+        `@celery.task(reuse_app_context=True)`.
     """
 
     def __init__(self):
         self._celery = None
+        self._local = threading.local()
+        self._histograms = {}
         self.task = None
 
     def __getattr__(self, attr):
@@ -37,20 +88,377 @@ class CeleryWrapper(object):
 
         celery_instance = Celery(
             app.import_name,
-            backend=app.config['CELERY_RESULT_BACKEND'],
+            backend=app.config.get('CELERY_RESULT_BACKEND'),
             broker=app.config['CELERY_BROKER_URL']
         )
 
-        celery_instance.conf.update(app.config)
+        # Only copy Celery settings, using their lowercase names
+        # (e.g. `CELERY_TASK_ROUTES` becomes `task_routes`)
+        celery_instance.conf.update({
+            key[len('CELERY_'):].lower(): value
+            for key, value in app.config.items()
+            if key.startswith('CELERY_') and key not in WRAPPER_SETTINGS
+        })
         TaskBase = celery_instance.Task
+        wrapper = self
+
+        instrumented = app.config.get('CELERY_TASK_METRICS', False)
+
+        if instrumented:
+            self._setup_instrumentation()
 
         class ContextTask(TaskBase):
             abstract = True
+            reuse_app_context = app.config.get(
+                'CELERY_REUSE_APP_CONTEXT',
+                False
+            )
+
             def __call__(self, *args, **kwargs):
-                with app.app_context():
+                if instrumented:
+                    return wrapper._instrumented_call(
+                        app, self, TaskBase, args, kwargs
+                    )
+
+                with wrapper._task_context(app, self.reuse_app_context):
                     return TaskBase.__call__(self, *args, **kwargs)
 
         celery_instance.Task = ContextTask
 
         self._celery = celery_instance
         self.task = self._celery.task
+
+    def stats(self):
+        """Obtain task metrics recorded in this process.
+
+        Returns:
+            Dictionary with the snapshot of each histogram (labelled by task
+            name), as returned by the metrics registry.
+        """
+        return {
+            histogram.name: histogram.snapshot()
+            for histogram in self._histograms.values()
+        }
+
+    @contextlib.contextmanager
+    def _task_context(self, app, reuse):
+        """Provide an app context for a task.
+
+        Args:
+            app: Application instance.
+            reuse (bool): Whether to reuse the app context of the worker.
+        """
+        if not reuse:
+            with app.app_context():
+                yield
+
+            return
+
+        from flask_app_template import db
+
+        if getattr(self._local, 'app_context', None) is None:
+            self._local.app_context = app.app_context()
+            self._local.app_context.push()
+
+        try:
+            yield
+
+        except Exception:
+            db.session.rollback()
+            raise
+
+        finally:
+            # The context is never torn down, so do what its teardown does
+            db.session.remove()
+
+    def _setup_instrumentation(self):
+        """Register signal handlers and inspect commands for metrics."""
+        from celery.signals import before_task_publish
+        from celery.worker.control import inspect_command
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        from flask_app_template import metrics_registry
+        from flask_app_template.metrics import QUERY_BUCKETS
+
+        for metric, documentation in (
+                ('queue_wait', 'Time since tasks were sent until started'),
+                ('context_setup', 'Time spent pushing the app context'),
+                ('execution', 'Time spent running tasks')):
+            self._histograms[metric] = metrics_registry.histogram(
+                'celery_task_{}_seconds'.format(metric),
+                documentation,
+                ('task',),
+                buckets=TIME_BUCKETS
+            )
+
+        self._histograms['queries'] = metrics_registry.histogram(
+            'celery_task_queries',
+            'Database queries per task',
+            ('task',),
+            buckets=QUERY_BUCKETS
+        )
+
+        before_task_publish.connect(_add_enqueue_timestamp, weak=False)
+
+        if not event.contains(
+                Engine, 'before_cursor_execute', self._count_query):
+            event.listen(Engine, 'before_cursor_execute', self._count_query)
+
+        @inspect_command()
+        def task_stats(state):
+            """Task metrics recorded in this worker."""
+            return self.stats()
+
+    def _count_query(self, *args, **kwargs):
+        """Count a query executed by the running task, if any."""
+        if getattr(self._local, 'queries', None) is not None:
+            self._local.queries += 1
+
+    def _instrumented_call(self, app, task, base, args, kwargs):
+        """Run a task recording its metrics."""
+        started = time.time()
+
+        enqueued_at = task.request.get('enqueued_at')
+
+        if enqueued_at is None:
+            enqueued_at = (task.request.headers or {}).get('enqueued_at')
+
+        with self._task_context(app, task.reuse_app_context):
+            ready = time.time()
+            self._local.queries = 0
+
+            try:
+                return base.__call__(task, *args, **kwargs)
+
+            finally:
+                finished = time.time()
+                queries = self._local.queries
+                self._local.queries = None
+
+                metrics = {
+                    'context_setup': ready - started,
+                    'execution': finished - ready,
+                    'queries': queries,
+                }
+
+                if enqueued_at is not None:
+                    metrics['queue_wait'] = max(0, started - enqueued_at)
+
+                self._record(task.name, metrics)
+
+                threshold = app.config.get('CELERY_SLOW_TASK_THRESHOLD', 5)
+
+                if metrics['execution'] >= threshold:
+                    app.logger.warning(
+                        'Slow task %s (%s): %.3fs, %d queries' % (
+                            task.name,
+                            task.request.id,
+                            metrics['execution'],
+                            queries
+                        )
+                    )
+
+    def _record(self, name, metrics):
+        """Add task metrics to the histograms of the task."""
+        for metric, value in metrics.items():
+            self._histograms[metric].observe(value, task=name)
+
+
+def send_batch(messages):
+    """Send several emails reusing a single SMTP connection.
+
+    Each message is retried with exponential backoff, reconnecting to the
+    SMTP server whenever delivery fails. The following configuration
+    parameters are used:
+
+    - `MAIL_BATCH_RATE`: Maximum number of messages sent per second (defaults
+        to 0, no limit).
+    - `MAIL_BATCH_RETRIES`: Number of retries per message (defaults to 3).
+    - `MAIL_BATCH_BACKOFF`: Base delay in seconds between retries, doubled on
+        each attempt (defaults to 1).
+
+    Args:
+        messages (list): Dictionaries containing the `args` and `kwargs` that
+            should be passed to Flask-Mail's `Message`.
+
+    Returns:
+        List of the messages that could not be delivered.
+    """
+    from flask_app_template import mail
+
+    rate = current_app.config.get('MAIL_BATCH_RATE', 0)
+    retries = current_app.config.get('MAIL_BATCH_RETRIES', 3)
+    backoff = current_app.config.get('MAIL_BATCH_BACKOFF', 1)
+
+    interval = 1.0 / rate if rate else 0
+    next_send = 0
+    connection = None
+    failed = []
+
+    try:
+        for data in messages:
+            message = Message(*data.get('args', []), **data.get('kwargs', {}))
+            attempt = 0
+
+            while True:
+                # Throttle delivery
+                wait = next_send - time.monotonic()
+
+                if wait > 0:
+                    time.sleep(wait)
+
+                next_send = time.monotonic() + interval
+
+                try:
+                    if connection is None:
+                        connection = mail.connect().__enter__()
+
+                    connection.send(message)
+                    break
+
+                except Exception:
+                    current_app.logger.exception(
+                        'Failed to send email to %s' % message.recipients
+                    )
+
+                    # Reconnect on next attempt
+                    _close_mail_connection(connection)
+                    connection = None
+
+                    attempt += 1
+
+                    if attempt > retries:
+                        failed.append(data)
+                        break
+
+                    time.sleep(backoff * 2 ** (attempt - 1))
+
+    finally:
+        _close_mail_connection(connection)
+
+    return failed
+
+
+def log_undelivered(messages):
+    """Log emails that will not be delivered.
+
+    Args:
+        messages (list): Dictionaries as passed to `send_batch()`.
+    """
+    for data in messages:
+        current_app.logger.error(
+            'Giving up delivering email to %s' % (
+                data.get('kwargs', {}).get('recipients'),
+            )
+        )
+
+
+def _close_mail_connection(connection):
+    """Close a Flask-Mail connection, ignoring errors."""
+    if connection is None:
+        return
+
+    try:
+        connection.__exit__(None, None, None)
+
+    except Exception:
+        pass
+
+
+class MailBuffer(object):
+    """Buffer of emails delivered in batches.
+
+    Messages are accumulated and sent in chunks of `MAIL_BATCH_SIZE` (defaults
+    to 50) through the `async_mail_batch` task, or synchronously over a single
+    connection if Celery is not enabled. The buffer can be used as a context
+    manager so that remaining messages are flushed on exit:
+
+        with MailBuffer() as buffer:
+            for user in users:
+                send_email(subject, recipients=[user.email], buffer=buffer)
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size
+        self.messages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, *args, **kwargs):
+        """Add a message to the buffer.
+
+        All arguments are passed as-is to Flask-Mail's `Message`. The buffer
+        is flushed automatically when it reaches the batch size.
+        """
+        self.messages.append({'args': list(args), 'kwargs': kwargs})
+
+        batch_size = (
+            self.batch_size or current_app.config.get('MAIL_BATCH_SIZE', 50)
+        )
+
+        if len(self.messages) >= batch_size:
+            self.flush()
+
+    def flush(self):
+        """Deliver all the messages in the buffer."""
+        if not self.messages:
+            return
+
+        messages = self.messages
+        self.messages = []
+
+        if current_app.config.get('USE_CELERY', False):
+            from flask_app_template.async_tasks import async_mail_batch
+            async_mail_batch.delay(messages)
+
+        else:
+            log_undelivered(send_batch(messages))
+
+
+# REPLACE send_email()
+def send_email(*args, **kwargs):
+    """Send an email.
+
+    A `MailBuffer` may be provided through the `buffer` keyword argument in
+    order to deliver the email in a batch. Otherwise, if Celery is enabled,
+    the email is delivered by the `async_mail` task. If not, the email is
+    delivered as in the base template (in the event loop under ASGI, through
+    the `MailQueue` or synchronously). The time spent is recorded in the
+    `mail_send_duration_seconds` metric in all cases.
+
+    All other arguments are passed as-is to Flask-Mail.
+
+    Returns:
+        Mail send result or `None` if the email is delivered asynchronously.
+    """
+    from flask_app_template import async_mailer, mail, mail_queue, \
+        metrics_registry
+
+    buffer = kwargs.pop('buffer', None)
+
+    with metrics_registry.mail_duration.time():
+        if buffer is not None:
+            buffer.add(*args, **kwargs)
+            return None
+
+        if current_app.config.get('USE_CELERY', False):
+            from flask_app_template.async_tasks import async_mail
+            async_mail.delay(*args, **kwargs)
+            return None
+
+        message = Message(*args, **kwargs)
+
+        if async_mailer.running:
+            return async_mailer.put(message)
+
+        if mail_queue.enabled:
+            mail_queue.put(message)
+            return None
+
+        return mail.send(message)
@@ -0,0 +1,134 @@
+"""Measure Socket.IO fan-out throughput with and without coalescing.
+
+The message queue and the connected clients are replaced by in-process
+stand-ins: every emit is serialized and published to a local queue, and a
+consumer thread encodes one frame per client for every published message.
+
+Usage:
+
+    python bench_broadcast.py --events 20000 --rooms 10 --clients 50
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+import types
+
+from flask_app_template.broadcast import Broadcaster
+
+
+class QueueStandIn(object):
+    """Stand-in for a `SocketIO` instance using a message queue."""
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.queue = queue.Queue()
+        self.published = 0
+        self.frames = 0
+        self.events = 0
+
+    def emit(self, event, data=None, room=None, namespace=None):
+        self.published += 1
+        self.queue.put(json.dumps({
+            'event': event,
+            'data': data,
+            'room': room,
+            'namespace': namespace
+        }))
+
+    def start_background_task(self, target, *args, **kwargs):
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs)
+        thread.daemon = True
+        thread.start()
+
+        return thread
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def consume(self, batch_event):
+        """Fan out published messages until `None` is received."""
+        while True:
+            raw = self.queue.get()
+
+            if raw is None:
+                break
+
+            message = json.loads(raw)
+
+            if message['event'] == batch_event:
+                self.events += len(message['data'])
+
+            else:
+                self.events += 1
+
+            for _ in range(self.clients):
+                json.dumps([message['event'], message['data']])
+                self.frames += 1
+
+
+def run(args, window):
+    """Send events and wait until every one of them has been fanned out.
+
+    Returns:
+        Tuple with elapsed seconds and the stand-in instance.
+    """
+    stand_in = QueueStandIn(args.clients)
+    broadcaster = Broadcaster(stand_in)
+    broadcaster.init_app(types.SimpleNamespace(config={
+        'SOCKETIO_BATCH_WINDOW': window,
+        'SOCKETIO_BATCH_MAX_SIZE': args.max_size,
+    }))
+
+    consumer = threading.Thread(
+        target=stand_in.consume,
+        args=(broadcaster.event,)
+    )
+    consumer.start()
+
+    start = time.perf_counter()
+
+    for idx in range(args.events):
+        broadcaster.emit(
+            'update',
+            {'id': idx, 'value': idx * 0.5},
+            room='room-{}'.format(idx % args.rooms)
+        )
+
+    # Wait for pending batches
+    while stand_in.events < args.events:
+        broadcaster.flush()
+        time.sleep(0.001)
+
+    stand_in.queue.put(None)
+    consumer.join()
+
+    return time.perf_counter() - start, stand_in
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--window', type=float, default=0.05)
+    parser.add_argument('--max-size', type=int, default=100)
+    args = parser.parse_args()
+
+    for name, window in (('direct', 0), ('coalesced', args.window)):
+        elapsed, stand_in = run(args, window)
+
+        line = '{:>10}: {:>9.0f} events/s, {:>7} publishes, {:>9} frames'
+
+        print(line.format(
+            name,
+            args.events / elapsed,
+            stand_in.published,
+            stand_in.frames
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Compare JSON and MessagePack encoding of Socket.IO payloads.
+
+For every event shape, the script reports the time needed to encode the
+payload and the size of the resulting Socket.IO packet. MessagePack payloads
+are sent as a binary attachment, so their size includes the text header of
+the packet.
+
+Usage:
+
+    python bench_serializer.py --iterations 10000
+"""
+
+import argparse
+import json
+import random
+import time
+import types
+
+from flask_app_template.serializer import Serializer
+
+
+def event_shapes():
+    """Representative event payloads."""
+    rnd = random.Random(0)
+
+    return {
+        'notification': {
+            'type': 'info',
+            'message': 'Your report is ready to download'
+        },
+        'numeric_tick': {
+            'id': 1234,
+            'ts': 1571480000.123,
+            'values': [rnd.uniform(-100, 100) for _ in range(16)]
+        },
+        'integer_series': {
+            'id': 1234,
+            'values': [rnd.randint(0, 1000) for _ in range(256)]
+        },
+        'batch': [
+            ['update', {'id': idx, 'value': rnd.uniform(0, 1)}]
+            for idx in range(100)
+        ],
+    }
+
+
+def json_packet(event, data):
+    """Socket.IO text packet."""
+    return '42' + json.dumps([event, data])
+
+
+def binary_packet(serializer, event, data):
+    """Socket.IO binary packet (header and attachment)."""
+    attachment = serializer.dumps(data)
+    header = '451-' + json.dumps(
+        [event, {'_placeholder': True, 'num': 0}]
+    )
+
+    return header, attachment
+
+
+def measure(function, iterations):
+    """Microseconds per call."""
+    start = time.perf_counter()
+
+    for _ in range(iterations):
+        function()
+
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=10000)
+    args = parser.parse_args()
+
+    serializer = Serializer()
+    serializer.init_app(types.SimpleNamespace(
+        config={'SOCKETIO_SERIALIZER': 'msgpack'},
+        logger=None
+    ))
+
+    line = '{:>16} {:>10} {:>10} {:>10} {:>10}'
+
+    print(line.format('event', 'json us', 'json B', 'msgpack us', 'msgpack B'))
+
+    for name, data in event_shapes().items():
+        text = json_packet(name, data)
+        header, attachment = binary_packet(serializer, name, data)
+
+        print(line.format(
+            name,
+            '{:.2f}'.format(measure(
+                lambda: json_packet(name, data),
+                args.iterations
+            )),
+            len(text.encode('utf-8')),
+            '{:.2f}'.format(measure(
+                lambda: binary_packet(serializer, name, data),
+                args.iterations
+            )),
+            len(header.encode('utf-8')) + len(attachment)
+        ))
+
+
+if __name__ == '__main__':
+    main()
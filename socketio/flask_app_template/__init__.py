@@ -4,11 +4,18 @@
 
 from flask_socketio import SocketIO
 
+from flask_app_template.broadcast import Broadcaster
+from flask_app_template.presence import Presence
+from flask_app_template.serializer import Serializer
+
 # ...
 
 # INCLUDE BEFORE init_app()
 # Flask-SocketIO
 socketio = SocketIO()
+serializer = Serializer(socketio)
+broadcaster = Broadcaster(serializer)
+presence = Presence(serializer)
 
 
 def init_app():
@@ -21,6 +28,9 @@ def init_app():
         app,
         message_queue=app.config.get('ENGINEIO_MESSAGE_QUEUE')
     )
+    serializer.init_app(app)
+    broadcaster.init_app(app)
+    presence.init_app(app)
 
     # Force endpoint registration
     from flask_app_template import websockets
@@ -30,5 +40,6 @@ def init_app():
     js_bundle = Bundle(
         # AFTER ZEPTO
         'js/vendor/socket.io.js', # 2.2.0
+        'js/msgpack.js',
         # ...
     )
\ No newline at end of file
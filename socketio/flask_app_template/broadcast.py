@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""Coalesced broadcasting of Socket.IO events."""
+
+import threading
+
+
+class Broadcaster(object):
+    """Coalesce events sent to the same room into batched frames.
+
+    Events emitted through the broadcaster are delayed for a short window.
+    All the events for the same room and namespace received during that
+    window are sent as a single frame (and a single message queue publish)
+    containing a list of `[event, data]` pairs. The default layout dispatches
+    these frames to the regular event handlers in the client.
+
+    The broadcaster expects the following configuration parameters:
+
+    - `SOCKETIO_BATCH_WINDOW`: Seconds to wait for more events before
+        sending a frame (defaults to 0.05). Set to 0 to disable batching.
+    - `SOCKETIO_BATCH_MAX_SIZE`: Maximum number of events per frame (defaults
+        to 100).
+    - `SOCKETIO_BATCH_EVENT`: Name of the event used for batched frames
+        (defaults to `'batch'`).
+    """
+
+    def __init__(self, socketio=None):
+        self._socketio = socketio
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        self.window = 0.05
+        self.max_size = 100
+        self.event = 'batch'
+
+    def init_app(self, app, socketio=None):
+        """Initialize the broadcaster.
+
+        Args:
+            app: Application instance.
+            socketio: `SocketIO` instance used to emit the events. Only
+                required if not provided in the constructor.
+        """
+        if socketio is not None:
+            self._socketio = socketio
+
+        self.window = app.config.get('SOCKETIO_BATCH_WINDOW', 0.05)
+        self.max_size = app.config.get('SOCKETIO_BATCH_MAX_SIZE', 100)
+        self.event = app.config.get('SOCKETIO_BATCH_EVENT', 'batch')
+
+    def emit(self, event, data=None, room=None, namespace='/'):
+        """Emit an event to a room within the next batch.
+
+        Args:
+            event (str): Name of the event.
+            data: Event payload.
+            room (str): Room to send the event to. If not provided, the event
+                is sent to all the clients.
+            namespace (str): Socket.IO namespace.
+        """
+        if not self.window:
+            self._socketio.emit(event, data, room=room, namespace=namespace)
+            return
+
+        key = (room, namespace)
+
+        with self._lock:
+            events = self._pending.get(key)
+            schedule = events is None
+
+            if schedule:
+                events = self._pending[key] = []
+
+            events.append([event, data])
+            full = len(events) >= self.max_size
+
+            if full:
+                del self._pending[key]
+
+        if full:
+            self._send(key, events)
+
+        elif schedule:
+            self._socketio.start_background_task(
+                self._flush_later,
+                key,
+                events
+            )
+
+    def flush(self):
+        """Send all pending events immediately."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+
+        for key, events in pending.items():
+            self._send(key, events)
+
+    def _flush_later(self, key, events):
+        """Send a batch once the window has passed."""
+        self._socketio.sleep(self.window)
+
+        with self._lock:
+            # Batch may have been sent already
+            if self._pending.get(key) is not events:
+                return
+
+            del self._pending[key]
+
+        self._send(key, events)
+
+    def _send(self, key, events):
+        """Emit a batch of events."""
+        room, namespace = key
+
+        if len(events) == 1:
+            event, data = events[0]
+            self._socketio.emit(event, data, room=room, namespace=namespace)
+
+        else:
+            self._socketio.emit(
+                self.event,
+                events,
+                room=room,
+                namespace=namespace
+            )
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+
+"""Presence and room membership index for WebSocket connections."""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+
+class LocalPresenceBackend(object):
+    """In-process backend used to share presence events.
+
+    This is the default when no message queue is configured. Several
+    `Presence` instances may share the same bus in order to emulate multiple
+    workers (e.g. in tests or benchmarks).
+
+    Args:
+        bus (list): Subscribers shared with other backends.
+    """
+
+    def __init__(self, bus=None):
+        self._bus = bus if bus is not None else []
+
+    def publish(self, message):
+        """Deliver a message to all the subscribers."""
+        for callback in list(self._bus):
+            callback(message)
+
+    def start(self, callback, socketio, logger, on_connect=None):
+        """Subscribe to messages."""
+        self._bus.append(callback)
+
+
+class RedisPresenceBackend(object):
+    """Backend sharing presence events through Redis pub/sub.
+
+    Args:
+        url (str): Redis URL.
+        channel (str): Name of the pub/sub channel.
+    """
+
+    def __init__(self, url, channel):
+        # Redis is optional, import it here rather than globally
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._channel = channel
+
+    def publish(self, message):
+        """Publish a message to the channel."""
+        self._redis.publish(self._channel, json.dumps(message))
+
+    def start(self, callback, socketio, logger, on_connect=None):
+        """Subscribe to messages in a background task.
+
+        `on_connect` is called after every (re)connection, since messages
+        published while disconnected are lost.
+        """
+        socketio.start_background_task(
+            self._listen,
+            callback,
+            socketio,
+            logger,
+            on_connect
+        )
+
+    def _listen(self, callback, socketio, logger, on_connect):
+        delay = 1
+
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self._channel)
+
+                if on_connect:
+                    on_connect()
+
+                delay = 1
+
+                for item in pubsub.listen():
+                    if item['type'] == 'message':
+                        callback(json.loads(item['data']))
+
+            except Exception:
+                logger.exception('Presence channel disconnected')
+
+            socketio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+class _Shard(object):
+    """Portion of the presence index with its own lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # user ID -> set of sids
+        self.users = {}
+        # sid -> (user ID, server ID, expiration timestamp, principal)
+        self.sids = {}
+
+
+class Presence(object):
+    """Index of connected users and their sids.
+
+    The index is kept up to date through the connect and disconnect events
+    of each worker, which are shared with other workers through the message
+    queue. Entries are split in shards (each one with its own lock) and looked
+    up by user ID or sid in constant time.
+
+    Each worker periodically publishes a heartbeat with its connections.
+    Entries that are not refreshed within their TTL are removed, so that
+    connections of workers that died do not remain in the index. The
+    subscription and heartbeats of each process are started the first time
+    the index is used.
+
+    Connections of the current worker may also hold a principal (any object
+    describing the authenticated user, see `websockets.py`), which is not
+    shared with other workers.
+
+    The index expects the following configuration parameters:
+
+    - `PRESENCE_MESSAGE_QUEUE`: Redis URL used to share presence events
+        (defaults to `ENGINEIO_MESSAGE_QUEUE`). If not set, events are only
+        shared within the process.
+    - `PRESENCE_CHANNEL`: Name of the pub/sub channel (defaults to
+        `'flask_app_template_presence'`).
+    - `PRESENCE_SHARDS`: Number of shards of the index (defaults to 16).
+    - `PRESENCE_HEARTBEAT`: Seconds between heartbeats (defaults to 30).
+    - `PRESENCE_TTL`: Seconds after which connections that were not
+        refreshed are removed (defaults to 90).
+    """
+
+    def __init__(self, socketio=None):
+        self._socketio = socketio
+        self._logger = None
+        self._backend = None
+        self._shards = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+        self.server_id = None
+        self.heartbeat = 30
+        self.ttl = 90
+
+    def init_app(self, app, socketio=None, backend=None):
+        """Initialize the index.
+
+        Args:
+            app: Application instance.
+            socketio: `SocketIO` instance. Only required if not provided in
+                the constructor.
+            backend: Backend used to share presence events. If not provided,
+                it is created from the configuration.
+        """
+        if socketio is not None:
+            self._socketio = socketio
+
+        self._logger = app.logger
+        self.heartbeat = app.config.get('PRESENCE_HEARTBEAT', 30)
+        self.ttl = app.config.get('PRESENCE_TTL', 90)
+        self._shards = [
+            _Shard() for _ in range(app.config.get('PRESENCE_SHARDS', 16))
+        ]
+
+        if backend is None:
+            url = app.config.get(
+                'PRESENCE_MESSAGE_QUEUE',
+                app.config.get('ENGINEIO_MESSAGE_QUEUE')
+            )
+
+            if url:
+                backend = RedisPresenceBackend(
+                    url,
+                    app.config.get(
+                        'PRESENCE_CHANNEL',
+                        'flask_app_template_presence'
+                    )
+                )
+
+            else:
+                backend = LocalPresenceBackend()
+
+        self._backend = backend
+
+    def connect(self, user_id, sid, principal=None):
+        """Register a new connection of the current worker.
+
+        Args:
+            user_id (int): ID of the user.
+            sid (str): Socket.IO session ID.
+            principal: Information about the user kept with the connection.
+        """
+        self._start()
+        self._add(user_id, sid, self.server_id, principal)
+        self._backend.publish({
+            'op': 'connect',
+            'server': self.server_id,
+            'user_id': user_id,
+            'sid': sid
+        })
+
+    def disconnect(self, sid):
+        """Remove a connection of the current worker.
+
+        Args:
+            sid (str): Socket.IO session ID.
+        """
+        self._start()
+        self._remove(sid)
+        self._backend.publish({
+            'op': 'disconnect',
+            'server': self.server_id,
+            'sid': sid
+        })
+
+    def disconnect_user(self, user_id):
+        """Disconnect the sockets of a user in all the workers.
+
+        Args:
+            user_id (int): ID of the user.
+        """
+        self._start()
+        self._disconnect_local_user(user_id)
+        self._backend.publish({
+            'op': 'disconnect_user',
+            'server': self.server_id,
+            'user_id': user_id
+        })
+
+    def get_sids(self, user_id):
+        """Obtain the sids of a user.
+
+        Returns:
+            Set of sids (empty if the user is not connected).
+        """
+        self._start()
+        shard = self._user_shard(user_id)
+
+        with shard.lock:
+            return set(shard.users.get(user_id, ()))
+
+    def get_user(self, sid):
+        """Obtain the user of a connection.
+
+        Returns:
+            User ID or `None` if the sid is not known.
+        """
+        entry = self._get_entry(sid)
+
+        return entry[0] if entry else None
+
+    def get_principal(self, sid):
+        """Obtain the principal of a connection of the current worker.
+
+        Returns:
+            Principal given to `connect()` or `None` if the sid is not
+            connected to this worker.
+        """
+        entry = self._get_entry(sid)
+
+        return entry[3] if entry else None
+
+    def is_online(self, user_id):
+        """Check whether a user has at least one connection."""
+        self._start()
+        shard = self._user_shard(user_id)
+
+        with shard.lock:
+            return bool(shard.users.get(user_id))
+
+    def online_users(self):
+        """Obtain the IDs of all connected users.
+
+        Returns:
+            Set of user IDs.
+        """
+        self._start()
+        users = set()
+
+        for shard in self._shards:
+            with shard.lock:
+                users.update(shard.users)
+
+        return users
+
+    def emit_to_user(self, user_id, event, data=None, namespace='/'):
+        """Send an event to all the connections of a user.
+
+        Returns:
+            Number of connections the event was sent to.
+        """
+        sids = self.get_sids(user_id)
+
+        for sid in sids:
+            self._socketio.emit(event, data, room=sid, namespace=namespace)
+
+        return len(sids)
+
+    def expire(self, now=None):
+        """Remove connections whose TTL has passed."""
+        now = now or time.time()
+
+        for shard in self._shards:
+            with shard.lock:
+                expired = [
+                    sid for sid, entry in shard.sids.items()
+                    if entry[2] < now
+                ]
+
+            for sid in expired:
+                self._remove(sid)
+
+    def _start(self):
+        """Subscribe to events and start heartbeats for this process."""
+        pid = os.getpid()
+
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            # Each worker process is a different server
+            self.server_id = uuid.uuid4().hex
+
+            self._backend.start(
+                self._on_message,
+                self._socketio,
+                self._logger,
+                on_connect=self._publish_heartbeat
+            )
+            self._socketio.start_background_task(self._heartbeat_loop)
+
+            self._pid = pid
+
+    def _heartbeat_loop(self):
+        """Refresh own connections and remove expired ones."""
+        while True:
+            self._socketio.sleep(self.heartbeat)
+
+            # Keep running after errors (e.g. Redis being unavailable)
+            try:
+                self._publish_heartbeat()
+                self.expire()
+
+            except Exception:
+                self._logger.exception('Presence heartbeat failed')
+
+    def _publish_heartbeat(self):
+        """Refresh own connections and share them with other workers."""
+        connections = []
+
+        for shard in self._shards:
+            with shard.lock:
+                connections.extend(
+                    [sid, entry[0]] for sid, entry in shard.sids.items()
+                    if entry[1] == self.server_id
+                )
+
+        for sid, user_id in connections:
+            self._add(user_id, sid, self.server_id)
+
+        self._backend.publish({
+            'op': 'heartbeat',
+            'server': self.server_id,
+            'connections': connections
+        })
+
+    def _on_message(self, message):
+        """Apply presence events from other workers."""
+        server = message['server']
+
+        if server == self.server_id:
+            return
+
+        op = message['op']
+
+        if op == 'connect':
+            self._add(message['user_id'], message['sid'], server)
+
+        elif op == 'disconnect':
+            self._remove(message['sid'])
+
+        elif op == 'heartbeat':
+            for sid, user_id in message['connections']:
+                self._add(user_id, sid, server)
+
+        elif op == 'disconnect_user':
+            self._disconnect_local_user(message['user_id'])
+
+    def _disconnect_local_user(self, user_id):
+        """Disconnect the sockets of a user connected to this worker."""
+        local = []
+
+        for sid in self.get_sids(user_id):
+            entry = self._get_entry(sid)
+
+            if entry is not None and entry[1] == self.server_id:
+                local.append(sid)
+
+        for sid in local:
+            # Forget the principal before the socket is closed
+            self._remove(sid)
+            self._socketio.server.disconnect(sid, namespace='/')
+
+    def _add(self, user_id, sid, server, principal=None):
+        """Add or refresh a connection in the index."""
+        expires = time.time() + self.ttl
+
+        shard = self._sid_shard(sid)
+
+        with shard.lock:
+            entry = shard.sids.get(sid)
+
+            # Refreshing a connection keeps its principal
+            if principal is None and entry is not None:
+                principal = entry[3]
+
+            shard.sids[sid] = (user_id, server, expires, principal)
+
+        shard = self._user_shard(user_id)
+
+        with shard.lock:
+            shard.users.setdefault(user_id, set()).add(sid)
+
+    def _remove(self, sid):
+        """Remove a connection from the index."""
+        shard = self._sid_shard(sid)
+
+        with shard.lock:
+            entry = shard.sids.pop(sid, None)
+
+        if entry is None:
+            return
+
+        user_id = entry[0]
+        shard = self._user_shard(user_id)
+
+        with shard.lock:
+            sids = shard.users.get(user_id)
+
+            if sids is not None:
+                sids.discard(sid)
+
+                if not sids:
+                    del shard.users[user_id]
+
+    def _get_entry(self, sid):
+        """Obtain the entry of a connection, if any."""
+        self._start()
+        shard = self._sid_shard(sid)
+
+        with shard.lock:
+            return shard.sids.get(sid)
+
+    def _user_shard(self, user_id):
+        return self._shards[hash(user_id) % len(self._shards)]
+
+    def _sid_shard(self, sid):
+        return self._shards[hash(sid) % len(self._shards)]
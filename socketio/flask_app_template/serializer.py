@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""Serialization of Socket.IO payloads."""
+
+import functools
+
+
+class Serializer(object):
+    """Serialization layer on top of a `SocketIO` instance.
+
+    Payloads emitted through the serializer are packed with MessagePack and
+    sent as binary attachments, which are smaller and faster to encode than
+    JSON text for numeric data. Payloads that cannot be packed (or all of
+    them if MessagePack is not enabled) are sent as regular JSON. The default
+    layout decodes binary payloads before calling the event handlers.
+    Payloads sent by clients are always JSON, since the layout does not pack
+    them.
+
+    Any other attribute is taken from the wrapped `SocketIO` instance, so the
+    serializer may be used in its place (e.g. by `Broadcaster`).
+
+    The serializer expects the following configuration parameters:
+
+    - `SOCKETIO_SERIALIZER`: Either `'json'` or `'msgpack'` (defaults to
+        `'json'`). Using MessagePack requires the `msgpack` module.
+    """
+
+    def __init__(self, socketio=None):
+        self._socketio = socketio
+        self._packb = None
+
+    def __getattr__(self, attr):
+        """Wrap internal SocketIO attributes."""
+        return getattr(self._socketio, attr)
+
+    def init_app(self, app, socketio=None):
+        """Initialize the serializer.
+
+        Args:
+            app: Application instance.
+            socketio: `SocketIO` instance. Only required if not provided in
+                the constructor.
+        """
+        if socketio is not None:
+            self._socketio = socketio
+
+        self._packb = None
+
+        if app.config.get('SOCKETIO_SERIALIZER', 'json') != 'msgpack':
+            return
+
+        try:
+            # MessagePack is optional, import it here rather than globally
+            import msgpack
+
+        except ImportError:
+            app.logger.warning(
+                'msgpack is not installed, falling back to JSON payloads'
+            )
+            return
+
+        self._packb = functools.partial(msgpack.packb, use_bin_type=True)
+
+    def dumps(self, data):
+        """Serialize a payload.
+
+        Returns:
+            Packed `bytes` or the payload as-is if it should be sent as JSON.
+        """
+        if self._packb is None or data is None:
+            return data
+
+        try:
+            return self._packb(data)
+
+        except (TypeError, ValueError, OverflowError):
+            # Unsupported types
+            return data
+
+    def emit(self, event, data=None, **kwargs):
+        """Serialize a payload and emit it.
+
+        All keyword arguments are passed as-is to `SocketIO.emit()`.
+        """
+        self._socketio.emit(event, self.dumps(data), **kwargs)
@@ -0,0 +1,152 @@
+/**
+ * Minimal MessagePack decoder for binary Socket.IO payloads.
+ *
+ * Supports nil, booleans, integers, floats, strings, binary data, arrays and
+ * maps. Extension types are returned as `Uint8Array` instances.
+ *
+ * @param buffer ArrayBuffer (or typed array) containing the packed data.
+ *
+ * @return decoded value.
+ */
+function msgpackDecode(buffer) {
+    var bytes = buffer instanceof ArrayBuffer ? new Uint8Array(buffer) : buffer;
+    var view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    var offset = 0;
+
+    function readString(length) {
+        var chunk = bytes.subarray(offset, offset + length);
+        offset += length;
+
+        if (typeof TextDecoder !== 'undefined') {
+            return new TextDecoder('utf-8').decode(chunk);
+        }
+
+        var encoded = '';
+
+        for (var i = 0; i < chunk.length; i++) {
+            encoded += '%' + ('0' + chunk[i].toString(16)).slice(-2);
+        }
+
+        return decodeURIComponent(encoded);
+    }
+
+    function readBytes(length) {
+        var chunk = bytes.slice(offset, offset + length);
+        offset += length;
+
+        return chunk;
+    }
+
+    function readArray(length) {
+        var result = new Array(length);
+
+        for (var i = 0; i < length; i++) {
+            result[i] = read();
+        }
+
+        return result;
+    }
+
+    function readMap(length) {
+        var result = {};
+
+        for (var i = 0; i < length; i++) {
+            var key = read();
+            result[key] = read();
+        }
+
+        return result;
+    }
+
+    function readUint64() {
+        var value = view.getUint32(offset) * 4294967296 + view.getUint32(offset + 4);
+        offset += 8;
+
+        return value;
+    }
+
+    function readInt64() {
+        var value = view.getInt32(offset) * 4294967296 + view.getUint32(offset + 4);
+        offset += 8;
+
+        return value;
+    }
+
+    function read() {
+        var type = bytes[offset++];
+        var value;
+
+        // Fixed types
+        if (type < 0x80) {
+            return type;
+        }
+
+        if (type < 0x90) {
+            return readMap(type & 0x0f);
+        }
+
+        if (type < 0xa0) {
+            return readArray(type & 0x0f);
+        }
+
+        if (type < 0xc0) {
+            return readString(type & 0x1f);
+        }
+
+        if (type >= 0xe0) {
+            return type - 0x100;
+        }
+
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+
+            // Binary
+            case 0xc4: value = bytes[offset]; offset += 1; return readBytes(value);
+            case 0xc5: value = view.getUint16(offset); offset += 2; return readBytes(value);
+            case 0xc6: value = view.getUint32(offset); offset += 4; return readBytes(value);
+
+            // Extensions
+            case 0xc7: value = bytes[offset]; offset += 2; return readBytes(value);
+            case 0xc8: value = view.getUint16(offset); offset += 3; return readBytes(value);
+            case 0xc9: value = view.getUint32(offset); offset += 5; return readBytes(value);
+            case 0xd4: offset += 1; return readBytes(1);
+            case 0xd5: offset += 1; return readBytes(2);
+            case 0xd6: offset += 1; return readBytes(4);
+            case 0xd7: offset += 1; return readBytes(8);
+            case 0xd8: offset += 1; return readBytes(16);
+
+            // Floats
+            case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+            case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+
+            // Unsigned integers
+            case 0xcc: value = bytes[offset]; offset += 1; return value;
+            case 0xcd: value = view.getUint16(offset); offset += 2; return value;
+            case 0xce: value = view.getUint32(offset); offset += 4; return value;
+            case 0xcf: return readUint64();
+
+            // Signed integers
+            case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+            case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+            case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+            case 0xd3: return readInt64();
+
+            // Strings
+            case 0xd9: value = bytes[offset]; offset += 1; return readString(value);
+            case 0xda: value = view.getUint16(offset); offset += 2; return readString(value);
+            case 0xdb: value = view.getUint32(offset); offset += 4; return readString(value);
+
+            // Arrays and maps
+            case 0xdc: value = view.getUint16(offset); offset += 2; return readArray(value);
+            case 0xdd: value = view.getUint32(offset); offset += 4; return readArray(value);
+            case 0xde: value = view.getUint16(offset); offset += 2; return readMap(value);
+            case 0xdf: value = view.getUint32(offset); offset += 4; return readMap(value);
+        }
+
+        throw new Error('Unknown MessagePack type: 0x' + type.toString(16));
+    }
+
+    return read();
+}
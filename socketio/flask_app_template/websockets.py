@@ -2,21 +2,44 @@
 
 """WebSocket endpoints."""
 
+import collections
 import functools
 
 from flask import request
 from flask_login import current_user
 from flask_socketio import disconnect
 from flask_wtf.csrf import validate_csrf
+from sqlalchemy import event, inspect
 
-from flask_app_template import socketio
+from flask_app_template import db, presence, socketio
+from flask_app_template.models import User
+
+
+# Authenticated connections, stored in the presence index
+Principal = collections.namedtuple(
+    'Principal',
+    ['user_id', 'username', 'roles']
+)
+
+
+def ws_principal():
+    """Obtain the principal of the current WebSocket connection.
+
+    Returns:
+        `Principal` instance or `None` if the connection is not authenticated.
+    """
+    return presence.get_principal(request.sid)
 
 
 def ws_authenticated(f):
-    """Decorator to require login when connecting to WebSocket endpoints."""
+    """Decorator to require login when handling WebSocket events.
+
+    The user is authorized against the principal cached when the connection
+    was established, so no database queries are performed.
+    """
     @functools.wraps(f)
     def wrapped(*args, **kwargs):
-        if not current_user.is_authenticated:
+        if ws_principal() is None:
             disconnect()
 
         else:
@@ -25,10 +48,50 @@ def ws_authenticated(f):
     return wrapped
 
 
+def invalidate_user(user_id):
+    """Remove cached principals of a user and disconnect their sockets.
+
+    Sockets of the user connected to other workers are disconnected through
+    the presence message queue.
+
+    Args:
+        user_id (int): ID of the user.
+    """
+    presence.disconnect_user(user_id)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _track_deactivated_users(session, flush_context):
+    """Remember users deactivated in the current transaction."""
+    for instance in session.dirty:
+        if not isinstance(instance, User) or instance.is_active:
+            continue
+
+        if inspect(instance).attrs.is_active.history.deleted:
+            session.info.setdefault('deactivated_users', set()).add(
+                instance.id
+            )
+
+
+@event.listens_for(db.session, 'after_commit')
+def _drop_deactivated_users(session):
+    """Drop connections of users once their deactivation is committed."""
+    for user_id in session.info.pop('deactivated_users', ()):
+        invalidate_user(user_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_deactivated_users(session):
+    session.info.pop('deactivated_users', None)
+
+
 @socketio.on('connect')
-@ws_authenticated
 def conn_proxy():
     """Only allow logged in users to connect."""
+    if not current_user.is_authenticated or not current_user.is_active:
+        disconnect()
+        return
+
     # Check for CSRF token before allowing connection
     token = request.args.get('token')
 
@@ -38,3 +101,17 @@ def conn_proxy():
     except:
         # Simply disconnect the user
         disconnect()
+        return
+
+    principal = Principal(
+        current_user.id,
+        current_user.username,
+        frozenset(current_user.role_names)
+    )
+    presence.connect(current_user.id, request.sid, principal)
+
+
+@socketio.on('disconnect')
+def disconn_proxy():
+    """Forget the principal of the connection."""
+    presence.disconnect(request.sid)